@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""Benchmark of the rejection and combination in saltcombine
+
+The fused combine in saltcombine.FusedCombine is timed against the
+original RejectArray and CombineArray, which worked on the full cube at
+once, and the peak memory that each uses above the input cubes is
+measured in units of the data cube, so it is the number of cube-sized
+temporaries.  Each test is run in its own process so that it starts
+without any memory from the other tests.
+
+Usage: python benchmarks/bench_saltcombine.py [nimages ny nx]
+"""
+import os
+import sys
+import time
+import resource
+import multiprocessing as mp
+
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(here, '..', 'saltred'), os.path.join(here, '..', 'lib')]
+
+import saltcombine
+
+
+def oldcombine(arr, method='average', reject=None, var=None, bpm=None,
+               lthresh=3, hthresh=3, gain=1, rdnoise=5):
+    """The rejection and combination of the original RejectArray and
+       CombineArray in hducombine
+
+       returns the combined data, combined variance, sum of the weights
+    """
+    ivar = None
+    if var is not None:
+        ivar = 1.0 / var
+
+    if reject == 'ccdclip':
+        mean_arr = arr.mean(axis=0)
+        sigma = var
+        if sigma is None:
+            sigma = arr.copy()
+            for i in range(len(sigma)):
+                sigma[i] = sigma[i] * gain[i] + rdnoise[i] ** 2
+        mask = np.ma.mask_or((arr - mean_arr < -lthresh * sigma),
+                             (arr - mean_arr > hthresh * sigma))
+        bpm = 1 * np.ma.mask_or((bpm == 1), mask)
+    elif reject == 'sigclip':
+        mean_arr = arr.mean(axis=0)
+        std_arr = arr.std(axis=0)
+        mask = np.ma.mask_or((arr - mean_arr < -lthresh * std_arr),
+                             (arr - mean_arr > hthresh * std_arr))
+        bpm = 1 * np.ma.mask_or((bpm == 1), mask)
+
+    def combinearray(arr, ivar, bpm):
+        if bpm is None:
+            bpm = arr * 0.0 + 1.0
+            wei = None
+        else:
+            if ivar is None:
+                ivar = arr * 0.0 + 1.0
+            wei = ivar * (1 - bpm)
+            check_wei = wei.sum(axis=0)
+            wei[0][check_wei == 0] = wei.min()
+        if method == 'average':
+            return np.average(arr, axis=0, weights=wei, returned=True)
+        return np.median(arr, axis=0), bpm.sum(axis=0)
+
+    c_arr, s_arr = combinearray(arr, ivar, bpm)
+    v_arr = None
+    if var is not None:
+        v_arr, tmp = combinearray(var, ivar, bpm)
+    return c_arr, v_arr, s_arr
+
+
+def makecube(shape, seed):
+    """Return a simulated data cube with bright pixels, its variance cube
+       and the gain and read noise of each image
+    """
+    rs = np.random.RandomState(seed)
+    data = rs.normal(1000, 30, shape)
+    bright = rs.randint(0, data.size, data.size // 1000)
+    data.flat[bright] += rs.exponential(3000, len(bright))
+    var = data + 25.0
+    return data, var, np.ones(shape[0]), 5 * np.ones(shape[0])
+
+
+def benchrun(queue, kernel, shape, method, reject, seed):
+    """Run one test and put the time and the peak memory above the input
+       cubes, in units of the data cube, in queue
+    """
+    data, var, gain, rdnoise = makecube(shape, seed)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.time()
+    if kernel == 'fused':
+        saltcombine.FusedCombine(data, method=method, reject=reject, var=var,
+                                 gain=gain, rdnoise=rdnoise)
+    else:
+        oldcombine(data, method=method, reject=reject, var=var, gain=gain,
+                   rdnoise=rdnoise)
+    t = time.time() - t0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    queue.put((t, 1024.0 * peak / data.nbytes))
+
+
+def benchcombine(shape=(20, 1000, 1000), method='average',
+                 reject=[None, 'sigclip', 'ccdclip', 'minmax'], seed=1):
+    """Time and measure the memory of each rejection method for the old
+       and the fused combine
+
+       returns a list of (reject, kernel, time, number of cubes)
+    """
+    results = []
+    print '%8s %6s %9s %6s' % ('reject', 'kernel', 'time (s)', 'cubes')
+    for r in reject:
+        for kernel in ['old', 'fused']:
+            if kernel == 'old' and r == 'minmax':
+                continue
+            queue = mp.Queue()
+            p = mp.Process(target=benchrun,
+                           args=(queue, kernel, shape, method, r, seed))
+            p.start()
+            t, ncube = queue.get()
+            p.join()
+            print '%8s %6s %9.3f %6.2f' % (r, kernel, t, ncube)
+            results.append((r, kernel, t, ncube))
+    return results
+
+
+def comparecombine(shape=(7, 50, 40), seed=0):
+    """Print the largest difference between the old and the fused combine
+       for the methods they have in common
+    """
+    data, var, gain, rdnoise = makecube(shape, seed)
+    for r in [None, 'sigclip', 'ccdclip']:
+        a = saltcombine.FusedCombine(data, reject=r, var=var, gain=gain,
+                                     rdnoise=rdnoise)
+        b = oldcombine(data, reject=r, var=var, gain=gain, rdnoise=rdnoise)
+        print '%8s max difference: data %g variance %g weights %g' % \
+            (r, abs(a[0] - b[0]).max(), abs(a[1] - b[1]).max(),
+             abs(a[2] - b[2]).max())
+
+
+if __name__ == '__main__':
+    shape = (20, 1000, 1000)
+    if len(sys.argv) == 4:
+        shape = tuple([int(x) for x in sys.argv[1:]])
+    comparecombine()
+    benchcombine(shape)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""Benchmark of the clipped statistics in saltstat
+
+iterstat is timed on simulated images with a gaussian background and a
+fraction of bright pixels, and the approximate statistics are compared
+to the exact ones.  The errors are given in units of the clipped
+standard deviation.
+
+Usage: python benchmarks/bench_saltstat.py [ny nx]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(here, '..', 'lib')]
+
+import saltstat
+
+
+def benchstat(shapes=[(100, 100), (1024, 1024), (4102, 1024)], sig=3,
+              niter=5, nsample=[1000, 10000, 100000], nrepeat=5, seed=1):
+    """Time iterstat for each method and subsample size
+
+       returns a list of (shape, method, nsample, time, mean error,
+       median error, std error) for each test
+    """
+    rs = np.random.RandomState(seed)
+    results = []
+    print '%12s %7s %8s %10s %9s %9s %9s' % \
+        ('shape', 'method', 'nsample', 'time (ms)', 'mean err', 'med err',
+         'std err')
+    for shape in shapes:
+        arr = rs.normal(1000, 10, shape)
+        bright = rs.randint(0, arr.size, arr.size // 100)
+        arr.flat[bright] += rs.exponential(1000, len(bright))
+        tests = [('exact', arr.size)] + \
+            [('approx', n) for n in nsample if n < arr.size]
+        for method, n in tests:
+            t0 = time.time()
+            for i in range(nrepeat):
+                stats = saltstat.iterstat(arr, sig, niter, method=method,
+                                          nsample=n)
+            t = 1000.0 * (time.time() - t0) / nrepeat
+            if method == 'exact':
+                exact = stats
+            err = [(stats[k] - exact[k]) / exact[2] for k in range(3)]
+            print '%12s %7s %8i %10.3f %9.4f %9.4f %9.4f' % \
+                ('x'.join([str(x) for x in shape]), method, n, t, err[0],
+                 err[1], err[2])
+            results.append((shape, method, n, t, err[0], err[1], err[2]))
+    return results
+
+
+if __name__ == '__main__':
+    shapes = [(100, 100), (1024, 1024), (4102, 1024)]
+    if len(sys.argv) == 3:
+        shapes = [tuple([int(x) for x in sys.argv[1:]])]
+    benchstat(shapes)
@@ -307,6 +307,68 @@ class interfit(curfit):
             self.mask = (weights>0)
 
 
+def batchfit(x, y, function='poly', order=3, thresh=3, niter=5):
+    """Fit the same function to several data arrays that share the same x
+       values, rejecting points in the same way as interfit.interfit
+
+    * x - array of x data of length npts
+    * y - array of y data with shape (nfit, npts)
+    * function - function to be fit to the data:
+                 options include polynomial, legendre, or chebyshev
+    * order - order of the function that is fit
+    * thresh - threshold for rejection
+    * niter - number of times to iterate
+
+    All of the arrays are fit at the same time by solving their normal
+    equations together.  If too few points are left in an array to fit
+    the function, the previous fit is kept for that array.
+
+    returns an array with the fit evaluated at x for each array of y
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    nfit, npts = y.shape
+    ncoef = order + 1
+
+    # set up the basis functions on x mapped to [-1, 1]
+    xmin, xmax = x.min(), x.max()
+    if xmax > xmin:
+        xnorm = (2 * x - xmin - xmax) / (xmax - xmin)
+    else:
+        xnorm = 0.0 * x
+    if function == 'poly' or function == 'polynomial' or function == 'power':
+        basis = np.polynomial.polynomial.polyvander(xnorm, order)
+    elif function == 'legendre':
+        basis = np.polynomial.legendre.legvander(xnorm, order)
+    elif function == 'chebyshev':
+        basis = np.polynomial.chebyshev.chebvander(xnorm, order)
+    else:
+        msg = '%s is not a valid function' % function
+        raise SaltError(msg)
+    # products of the basis functions for the normal equations
+    bprod = (basis[:, :, None] * basis[:, None, :]).reshape(npts, -1)
+
+    weights = np.ones((nfit, npts))
+    yfit = np.zeros((nfit, npts))
+    for i in range(max(niter, 1)):
+        # do a linear least squares fit
+        good = (weights.sum(axis=1) >= ncoef)
+        if not good.any():
+            break
+        a = np.dot(weights[good], bprod).reshape(-1, ncoef, ncoef)
+        b = np.dot(weights[good] * y[good], basis)
+        coef = np.linalg.solve(a, b[:, :, None])[:, :, 0]
+        yfit[good] = np.dot(coef, basis.T)
+
+        # recalculate the weights from the normalized residuals
+        r = y - yfit
+        s = np.median(abs(r - np.median(r, axis=1)[:, None]), axis=1) / 0.6745
+        s[s == 0] = np.inf
+        weights = 1.0 * (abs(r / s[:, None]) < thresh)
+
+    return yfit
+
+
 def poly(x, y, order, rej_lo, rej_hi, niter):
     """linear least square polynomial fit with sigma-clipping
 
@@ -11,13 +11,15 @@ All calls to IO functions should go through this module.
 **Note** this is a replacement for the `saltio` module.
 """
 
-import os, glob, shutil, re, tempfile
+import os, glob, shutil, re, tempfile, mmap, hashlib
 from time import strftime
 import smtplib 
 from email.mime.text import MIMEText
+from collections import OrderedDict
 
 
 from astropy.io import fits
+from multiprocessing.pool import ThreadPool
 import numpy as np
 
 from salterror import SaltIOError
@@ -51,6 +53,20 @@ def readlist(param):
 
     return output
 
+# FITS data types for each value of BITPIX
+fitsdtypes={8:'u1', 16:'>i2', 32:'>i4', 64:'>i8', -32:'>f4', -64:'>f8'}
+
+# exposure indexes and memory maps of the files that have been read.  Each
+# memory map keeps a file open, so only the maxmaps most recently used maps
+# are kept and the others are closed
+exposureindexes={}
+exposuremaps=OrderedDict()
+maxmaps=32
+
+# directory where the exposure indexes are written so that later sessions
+# can use them.  If it is None, the indexes are only kept in memory
+indexdir=None
+
 def get_exposure(files, number=1):
     """Given a list of fits files returns exposure data as numpy array.
 
@@ -58,56 +74,36 @@ def get_exposure(files, number=1):
     If *number* parameter is given it will browse the file list until
     the requested exposure number is found.
 
-    Because of this browing `get_exposure` is only fast for small exposure
-    *number*. If the exposure numbers are always big or if you need to
-    access a lot of exposures you should use `build_exposure_index` and
-    `get_indexed_exposure` instead.
+    Each file is only scanned for its exposures once, see 
+    `indexfits`, so browsing the file list is fast even for big exposure
+    *number*.  If you need to access a lot of exposures you can also use 
+    `build_exposure_index` and `get_indexed_exposure`.
     """
 
-    try:
-        f=fits.open(files[0])
-
-        # Check if primary HDU contains data
-        if f[0].data is None:
-            N=len(f)-1
-            offset=1
-        else:
-            N=len(f)
-            offset=0
+    for name in files:
+        index=indexfits(name)
+        if number<=len(index):
+            return readexposure(index[number-1])
+        number-=len(index)
 
-        # Check if requested exposure number is in current file
-        if number<=N:
-            print 'Exposure found in file ',files[0]
-            output=np.asarray(f[number-1+offset].data)
-        else:
-            output=get_exposure(files[1:],number-N)
-
-        f.close()
-    except IOError:
-        raise SaltIOError('Cannot open FITS file '+str(files[0]))
-
-    return output
+    raise SaltIOError('Exposure %i is not in the list of files' % (number))
 
 def build_exposure_index(files):
     """Given a list of fits files returns an index of exposures for use
     with `get_indexed_exposure`.
+
+    Each entry in the index is (name, hdu, header offset, data offset, 
+    BITPIX, shape, BSCALE, BZERO), where the shape is in numpy order.
     """
 
     index=[]
 
     for name in files:
-        try:
-            f=fits.open(name)
-
-            index+=[(name,number) for number in range(len(f)) if f[number].data is not None]
-
-            f.close()
-        except IOError:
-            raise SaltIOError('Cannot open FITS file '+str(name))
+        index+=indexfits(name)
 
     return index
 
-def get_indexed_exposure(files,index,number=1):
+def get_indexed_exposure(files,index,number=1,frame=None):
     """Given a list of fits files and a index generated by
     `build_exposure_index` it returns the requested exposure as a numpy array.
 
@@ -115,22 +111,428 @@ def get_indexed_exposure(files,index,number=1):
     If *number* parameter is given it will browse the file list until
     the requested exposure number is found.
 
-    The index consumes a lot of memory. Only use `get_indexed_exposure`
-    when you need to access a large number of exposures fast, or when the
-    exposure number is always big.
-    Otherwise you should use `get_exposure` instead.
+    The exposure is read with a single slice of a memory map of the file,
+    so any exposure can be read quickly.  If the exposure is a cube of 
+    frames, *frame* selects a single frame of the cube.
     """
 
     try:
-        f=fits.open(index[number-1][0])
+        entry=index[number-1]
+    except IndexError:
+        raise SaltIOError('Exposure %i is not in the index' % number)
 
-        output=np.asarray(f[index[number-1][1]].data)
+    return readexposure(entry, frame)
 
-        f.close()
+def get_indexed_header(index, number=1):
+    """Given an index generated by `build_exposure_index` it returns the 
+    header of the requested exposure.
+    """
+
+    try:
+        entry=index[number-1]
+    except IndexError:
+        raise SaltIOError('Exposure %i is not in the index' % number)
+
+    mm=mapfits(entry[0], entry[3])
+    try:
+        return fits.Header.fromstring(mm[entry[2]:entry[3]])
+    except Exception, e:
+        raise SaltIOError('Cannot read the header of exposure %i because %s' % (number, e))
+
+def get_indexed_keyword(index, keyword):
+    """Given an index generated by `build_exposure_index` it returns the
+    value of a keyword in the header of every exposure in the index.
+
+    The values are found in the header records of the memory mapped files
+    without parsing the headers, so it is fast even for a large number of
+    exposures.  String values are returned without the quotes, other
+    values are returned as the string in the header and None is returned
+    if the keyword is not in a header.
+    """
+
+    key='%-8s= ' % keyword
+    values=[]
+    for entry in index:
+        mm=mapfits(entry[0], entry[3])
+        header=mm[entry[2]:entry[3]]
+        pos=header.find(key)
+        while pos>=0 and pos%80:
+            pos=header.find(key, pos+1)
+        if pos<0:
+            values.append(None)
+            continue
+        values.append(splitcard(header[pos:pos+80])[0])
+    return values
+
+def splitcard(card):
+    """Split an 80 character header record into its value and comment.
+    String values are returned without the quotes.
+
+    returns value, comment
+    """
+    value=card[10:].strip()
+    comment=''
+    if value.startswith("'"):
+        end=value.find("'", 1)
+        while end>0 and value[end+1:end+2]=="'":
+            end=value.find("'", end+2)
+        if end<0: end=len(value)
+        if '/' in value[end+1:]:
+            comment=value[end+1:].split('/', 1)[1].strip()
+        value=value[1:end].replace("''", "'").rstrip()
+    elif '/' in value:
+        value, comment=[v.strip() for v in value.split('/', 1)]
+    return value, comment
+
+def fitscard(keyword, value, comment=None):
+    """Return the 80 character header record for a keyword.  The value can
+    be a string, bool, int or float.  For HISTORY and COMMENT keywords the
+    value is the text of the record.  Text longer than the 72 characters 
+    of a record is continued in further records of the same keyword, so 
+    the string returned is then a multiple of 80 characters long.
+    """
+    if keyword in ['HISTORY', 'COMMENT']:
+        value=str(value)
+        return ''.join(['%-8s%-72s' % (keyword, value[i:i+72]) 
+                        for i in range(0, max(len(value), 1), 72)])
+    else:
+        if isinstance(value, bool):
+            value='%20s' % 'FT'[value]
+        elif isinstance(value, basestring):
+            value='%-20s' % ("'%-8s'" % value.replace("'", "''"))
+        elif isinstance(value, (int, long, np.integer)):
+            value='%20i' % value
+        else:
+            value=repr(float(value)).upper()
+            if '.' not in value and 'E' not in value: value+='.0'
+            value='%20s' % value
+        card='%-8s= %s' % (keyword, value)
+        if comment: card+=' / '+comment
+    return card[:80].ljust(80)
+
+def updatefitsheaders(name, updates):
+    """Update keywords in the headers of a fits file in place.
+
+    *updates* is a list of (header offset, cards), where cards is a list
+    of (keyword, value, comment).  The value of a keyword that is already
+    in the header is replaced, and its comment is kept if the comment is
+    None.  New keywords and HISTORY records are added at the end of the
+    header, and long HISTORY and COMMENT text is split over several records.
+
+    Only the header records are written, so a large number of headers can
+    be updated without reading or writing the data.  If a header would
+    need more records than it has room for, nothing is written and False
+    is returned so that the file can be updated with `updatefits` instead.
+
+    returns True if the headers have been updated
+    """
+
+    blank=' '*80
+    endcard='END'.ljust(80)
+    headers=[]
+    try:
+        fin=open(name, 'r+b')
     except IOError:
-        raise SaltIOError('Cannot open FITS file '+str(index[number-1]))
+        raise SaltIOError('Cannot open FITS file %s for update' % name)
 
-    return output
+    try:
+        for hoffset, cards in updates:
+            # read the header records
+            fin.seek(hoffset)
+            header=''
+            end=-1
+            while end<0:
+                record=fin.read(2880)
+                if len(record)<2880:
+                    raise SaltIOError('Cannot find the end of the header at %i in %s' % (hoffset, name))
+                header+=record
+                end=header.find(endcard, len(header)-2880)
+                while end>=0 and end%80:
+                    end=header.find(endcard, end+1)
+            nbytes=len(header)
+            records=[header[i:i+80] for i in range(0, end, 80)]
+            while records and records[-1]==blank:
+                records.pop()
+
+            # update the records
+            keys={}
+            for i, card in enumerate(records):
+                if card[8:10]=='= ': keys.setdefault(card[:8].rstrip(), i)
+            for keyword, value, comment in cards:
+                i=keys.get(keyword)
+                if i is None or keyword in ['HISTORY', 'COMMENT']:
+                    keys[keyword]=len(records)
+                    card=fitscard(keyword, value, comment)
+                    records.extend([card[j:j+80] for j in range(0, len(card), 80)])
+                    continue
+                if comment is None:
+                    comment=splitcard(records[i])[1]
+                records[i]=fitscard(keyword, value, comment)
+            records.append(endcard)
+
+            header=''.join(records)
+            header+=' '*(-len(header)%2880)
+            if len(header)>nbytes:
+                return False
+            headers.append((hoffset, header))
+
+        # write the headers
+        for hoffset, header in headers:
+            fin.seek(hoffset)
+            fin.write(header)
+    finally:
+        fin.close()
+
+    return True
+
+def indexfits(name):
+    """Return the index of the exposures in a fits file.  The index is kept
+    in memory and, if indexdir is set, in a file in indexdir, and it is 
+    only created again if the fits file has changed.
+
+    returns list of (name, hdu, header offset, data offset, BITPIX, shape,
+    BSCALE, BZERO)
+    """
+
+    try:
+        st=os.stat(name)
+    except OSError:
+        raise SaltIOError('Cannot open FITS file '+str(name))
+    stamp='%i %r' % (st.st_size, st.st_mtime)
+
+    # check if the file has already been indexed
+    if name in exposureindexes and exposureindexes[name][0]==stamp:
+        return exposureindexes[name][1]
+    closemaps(name)
+
+    index=readindexfile(name, stamp)
+    if index is None:
+        index=scanfits(name)
+        writeindexfile(name, stamp, index)
+
+    exposureindexes[name]=(stamp, index)
+    return index
+
+def indexfile(name):
+    """Return the name of the file in indexdir for the index of a fits file,
+    or None if indexdir is not set
+    """
+    if not indexdir: return None
+    key=hashlib.md5(os.path.abspath(name)).hexdigest()[:16]
+    return os.path.join(indexdir, '%s.%s.idx' % (os.path.basename(name), key))
+
+def readindexfile(name, stamp):
+    """Read the index of a fits file from indexdir.  
+
+    returns the index or None if there is no index for this version of the
+    file
+    """
+    idxfile=indexfile(name)
+    if idxfile is None: return None
+    try:
+        fin=open(idxfile)
+        try:
+            if fin.readline().strip()!=stamp: return None
+            index=[]
+            for line in fin:
+                v=line.split()
+                index.append((name, int(v[0]), int(v[1]), int(v[2]), int(v[3]), 
+                              tuple([int(n) for n in v[6:]]), float(v[4]), float(v[5])))
+        finally:
+            fin.close()
+    except (IOError, ValueError, IndexError):
+        return None
+    return index
+
+def writeindexfile(name, stamp, index):
+    """Write the index of a fits file to indexdir if it is set.  The index is
+    written to a temporary file first so other processes never read a part
+    of an index.
+    """
+    idxfile=indexfile(name)
+    if idxfile is None: return
+    try:
+        if not os.path.isdir(indexdir): os.makedirs(indexdir)
+        fd, tmpname=tempfile.mkstemp(dir=indexdir, suffix='.tmp')
+        fout=os.fdopen(fd, 'w')
+        fout.write(stamp+'\n')
+        for entry in index:
+            fout.write('%i %i %i %i %r %r %s\n' % (entry[1], entry[2], entry[3], entry[4],
+                       entry[6], entry[7], ' '.join([str(n) for n in entry[5]])))
+        fout.close()
+        os.rename(tmpname, idxfile)
+    except (IOError, OSError):
+        pass
+
+def scanfits(name):
+    """Find the header and data offsets of each exposure in a fits file.
+    The file is read in one sequential pass, which only reads the headers 
+    and skips over the data.
+
+    returns list of (name, hdu, header offset, data offset, BITPIX, shape,
+    BSCALE, BZERO)
+    """
+    index=[]
+    try:
+        fin=open(name, 'rb')
+    except IOError:
+        raise SaltIOError('Cannot open FITS file '+str(name))
+
+    try:
+        hdu=0
+        hoffset=0
+        while True:
+            # read the header of the next HDU
+            cards=readhducards(fin)
+            if cards is None:
+                if hdu>0 and fin.tell()==hoffset: return index
+                raise SaltIOError('Cannot find the end of HDU %i in %s' % (hdu, name))
+            doffset=fin.tell()
+
+            # find the size of the data
+            bitpix=int(cards['BITPIX'])
+            shape, nbytes=hdusize(cards)
+            if nbytes>0 and cards.get('XTENSION', "'IMAGE'").strip("' ") in ['IMAGE', '']:
+                bscale=float(cards.get('BSCALE', 1))
+                bzero=float(cards.get('BZERO', 0))
+                index.append((name, hdu, hoffset, doffset, bitpix, shape, bscale, bzero))
+
+            # skip over the data
+            hdu+=1
+            hoffset=doffset+int(np.ceil(nbytes/2880.0))*2880
+            fin.seek(hoffset)
+    except (KeyError, ValueError), e:
+        raise SaltIOError('Cannot read HDU %i in %s because %s' % (hdu, name, e))
+    finally:
+        fin.close()
+
+def fitscomplete(name):
+    """Return True if a fits file is complete, that is if the header of 
+    every HDU ends with an END record, the data of the last HDU are all in 
+    the file and, if the primary header has NEXTEND, all of the extensions
+    are in the file.  Only the headers are read, so it is a quick check 
+    that a file is not still being written.
+    """
+    try:
+        size=os.path.getsize(name)
+        fin=open(name, 'rb')
+    except (IOError, OSError):
+        return False
+
+    try:
+        hdu=0
+        hoffset=0
+        nextend=0
+        while hoffset<size:
+            fin.seek(hoffset)
+            cards=readhducards(fin)
+            if cards is None: return False
+            if hdu==0: nextend=int(cards.get('NEXTEND', 0))
+            shape, nbytes=hdusize(cards)
+            if fin.tell()+nbytes>size: return False
+            hdu+=1
+            hoffset=fin.tell()+int(np.ceil(nbytes/2880.0))*2880
+        return hdu>nextend
+    except (IOError, KeyError, ValueError):
+        return False
+    finally:
+        fin.close()
+
+def readhducards(fin):
+    """Read the header of an HDU from the current position of an open fits
+    file, which is left at the start of the data.
+
+    returns dictionary of the keyword values as strings, or None if the 
+    file ends before the END record
+    """
+    cards={}
+    while True:
+        record=fin.read(2880)
+        if len(record)<2880: return None
+        for i in range(0, 2880, 80):
+            key=record[i:i+8].strip()
+            if key=='END': return cards
+            if record[i+8:i+10]=='= ':
+                cards[key]=record[i+10:i+80].split('/')[0].strip()
+
+def hdusize(cards):
+    """Return the shape of the data of an HDU in numpy order and the number
+    of bytes of data, without the padding, given its header cards
+    """
+    bitpix=int(cards['BITPIX'])
+    naxis=int(cards['NAXIS'])
+    shape=tuple([int(cards['NAXIS%i' % (i+1)]) for i in range(naxis)][::-1])
+    size=0
+    if naxis>0:
+        size=int(np.prod(shape))
+        if 'XTENSION' in cards:
+            size=int(cards.get('GCOUNT', 1))*(int(cards.get('PCOUNT', 0))+size)
+    return shape, abs(bitpix)/8*size
+
+def mapfits(name, end):
+    """Return a read only memory map of a fits file that extends to at 
+    least the byte end.  The map is only valid until the next call to 
+    mapfits, which may close it, so any data must be copied out of it.
+    """
+    mm=exposuremaps.pop(name, None)
+    if mm is not None and len(mm)<end:
+        mm.close()
+        mm=None
+    if mm is None:
+        try:
+            fin=open(name, 'rb')
+            mm=mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+            fin.close()
+        except (IOError, ValueError, mmap.error), e:
+            raise SaltIOError('Cannot open FITS file %s because %s' % (name, e))
+
+    # keep the map as the most recently used and close the oldest maps
+    exposuremaps[name]=mm
+    while len(exposuremaps)>maxmaps:
+        exposuremaps.popitem(last=False)[1].close()
+    return mm
+
+def closemaps(name=None):
+    """Close the memory map of a fits file, or of all of the files if name
+    is None
+    """
+    if name is None:
+        names=exposuremaps.keys()
+    else:
+        names=[name]
+    for n in names:
+        mm=exposuremaps.pop(n, None)
+        if mm is not None: mm.close()
+
+def readexposure(entry, frame=None):
+    """Read an exposure from a fits file given its entry in an exposure
+    index.  The data are scaled in the same way as by astropy.  If frame
+    is given and the exposure is a cube, only that frame of the cube is 
+    read.
+
+    returns numpy array
+    """
+    name, hdu, hoffset, doffset, bitpix, shape, bscale, bzero=entry
+    dtype=np.dtype(fitsdtypes[bitpix])
+    if frame is not None:
+        if frame<0 or frame>=shape[0]:
+            raise SaltIOError('Frame %i is not in the cube in %s' % (frame, name))
+        shape=shape[1:]
+        doffset+=frame*int(np.prod(shape))*dtype.itemsize
+    size=int(np.prod(shape))
+    mm=mapfits(name, doffset+size*dtype.itemsize)
+    data=np.frombuffer(mm, dtype=dtype, count=size, offset=doffset).reshape(shape)
+
+    if bscale==1 and bzero==0:
+        return data.astype(dtype.newbyteorder('='))
+    if bitpix in [16, 32] and bscale==1 and bzero==2**(bitpix-1):
+        # unsigned integers
+        return (data.astype(np.int64)+int(bzero)).astype('u%i' % (bitpix/8))
+    if bitpix in [8, 16, -32]:
+        ftype=np.float32
+    else:
+        ftype=np.float64
+    return data.astype(ftype)*ftype(bscale)+ftype(bzero)
 
 def openbinary(file, type):
     """Open binary file."""
@@ -195,6 +597,53 @@ def openfits(infile, mode='copyonwrite', memmap=False):
         struct = None
     return struct
 
+def readprimaryheader(infile):
+    """Read only the primary header of a FITS file.  The file is read one 
+       2880 byte record at a time until the END card is found, so none of
+       the extensions or data are read.
+
+       returns fits.Header
+    """
+    try:
+        fin = open(infile, 'rb')
+    except Exception, e:
+        raise SaltIOError('Cannot open %s because %s' % (infile, e))
+
+    records = []
+    try:
+        while True:
+            record = fin.read(2880)
+            if len(record) < 2880:
+                raise SaltIOError('Cannot find the end of the primary header in %s' % infile)
+            records.append(record)
+            if any([record[i:i+8] == 'END     ' for i in range(0, 2880, 80)]):
+                break
+    finally:
+        fin.close()
+
+    try:
+        header = fits.Header.fromstring(''.join(records))
+    except Exception, e:
+        raise SaltIOError('Cannot read the primary header of %s because %s' % (infile, e))
+    return header
+
+def readprimaryheaders(infiles, nthreads=1):
+    """Read the primary header of each file in infiles.  If nthreads is 
+       more than one, the files are read by a pool of threads, which helps 
+       when the files are on a network filesystem.
+
+       returns list of fits.Header in the same order as infiles
+    """
+    if nthreads > 1 and len(infiles) > 1:
+        pool = ThreadPool(min(nthreads, len(infiles)))
+        try:
+            headers = pool.map(readprimaryheader, infiles)
+        finally:
+            pool.close()
+            pool.join()
+        return headers
+    return [readprimaryheader(infile) for infile in infiles]
+
 def openupdatefits(infile):
     """open FITS file for updating"""
     try:
@@ -22,7 +22,10 @@
 """
 
 import os
-from pyraf import iraf
+try:
+    from pyraf import iraf
+except ImportError:
+    iraf = None
 import string
 import saltsafeio
 from salterror import SaltError, SaltIOError
@@ -33,7 +33,7 @@
 # perform string functions on a list
 # -----------------------------------------------------------
 
-import os, string
+import os, re, string
 from salterror import SaltError
 
 def listfunc(oldlist,proc):
@@ -191,3 +191,15 @@ def secsplit(sec):
         raise SaltError(message)
 
     return x, y
+
+def parsemem(mem):
+    """Return the number of bytes given by a memory size such as '2GB', 
+       '500 MB' or a number of bytes
+    """
+    units={'':1, 'B':1, 'KB':1e3, 'MB':1e6, 'GB':1e9, 'TB':1e12}
+    try:
+        value, unit=re.match('^([0-9.]+)\s*([A-Z]*)$', str(mem).strip().upper()).groups()
+        return int(float(value)*units[unit])
+    except:
+        message = 'Cannot convert %s to a memory size' % mem
+        raise SaltError(message)
@@ -124,21 +124,103 @@ def median2dclip(arr, mean, std, sig):
         median=-1
     return median
 
-def iterstat(arr, sig, niter, verbose=False):
+def iterstat(arr, sig, niter, verbose=False, method='exact', nsample=10000):
     """iterstas calculates an arrays statistics using
     a sigma clipped values
+
+    In each iteration, the values within sig standard deviations of the
+    mean are kept and the mean and standard deviation of those values are
+    found.  The iterations stop early if the values kept do not change.
+    The statistics are calculated with clipstat, either exactly or from a
+    subsample of nsample values if method='approx'.
+
+    returns mean, median, std
     """
-    mean=arr.mean()
-    std=arr.std()
-    median=np.median(arr)
-    if verbose:  print mean, median, std
+    clip=clipstat(arr, method=method, nsample=nsample)
+    mean, std=clip.stats()
+    if verbose:  print mean, clip.median(), std
     for i in range(niter):
-        mask=(abs(arr-mean)<sig*std)
-        mean=arr[mask].mean()
-        std=arr[mask].std()
-        median=np.median(arr[mask])
-        if verbose:  print i,mask.sum(), mean, median, std
-    return mean, median, std
+        clip.select(mean, sig*std)
+        last=(mean, std)
+        mean, std=clip.stats()
+        if verbose:  print i, clip.count(), mean, clip.median(), std
+        if (mean, std)==last: break
+    return mean, clip.median(), std
+
+class clipstat:
+    """Calculate the statistics of the values in an array that are within
+       a window around a given value, as used for sigma clipping.
+
+       The array is flattened once and the same work buffers are used to
+       select the values in each window, so that repeated clipping does not
+       allocate a new mask and copy for every statistic.  Only the mean and
+       standard deviation are calculated for each window; the median needs
+       a partial sort and is only found when it is asked for.
+
+       For method='approx', a regular subsample of about nsample values is
+       used instead of the whole array.  The errors on the mean and median
+       are then about std/sqrt(nsample) and 1.25*std/sqrt(nsample), and the
+       relative error on the standard deviation is about 1/sqrt(2*nsample).
+    """
+    def __init__(self, arr, method='exact', nsample=10000):
+        arr=np.asarray(arr)
+        if method=='approx':
+            arr=subsample(arr, nsample)
+        elif method!='exact':
+            raise SaltError('%s is not a valid method for clipped statistics' % method)
+        self.data=np.asarray(arr, dtype=float).ravel()
+        self.values=self.data
+        self.buffer=np.empty(self.data.size)
+        self.mask=np.empty(self.data.size, dtype=bool)
+
+    def select(self, center, width):
+        """Select the values with abs(value-center) < width"""
+        np.subtract(self.data, center, out=self.buffer)
+        np.abs(self.buffer, out=self.buffer)
+        np.less(self.buffer, width, out=self.mask)
+        self.values=self.data[self.mask]
+
+    def count(self):
+        """Return the number of selected values"""
+        return self.values.size
+
+    def stats(self):
+        """Return the mean and standard deviation of the selected values"""
+        n=self.values.size
+        if n==0: return np.nan, np.nan
+        mean=self.values.mean()
+        diff=np.subtract(self.values, mean, out=self.buffer[:n])
+        return mean, (np.dot(diff, diff)/n)**0.5
+
+    def median(self):
+        """Return the median of the selected values"""
+        n=self.values.size
+        if n==0: return np.nan
+        work=self.buffer[:n]
+        work[:]=self.values
+        k=[(n-1)//2, n//2]
+        work.partition(k)
+        return 0.5*(work[k[0]]+work[k[1]])
+
+def subsample(arr, nsample):
+    """Return about nsample values taken at a regular step through the
+       flattened array.  The step is chosen to have no common factor with
+       the length of the rows so that the subsample does not follow the
+       columns of an image.
+    """
+    arr=np.asarray(arr)
+    if arr.size <= nsample: return arr.ravel()
+    step=arr.size//nsample
+    if arr.ndim > 1:
+        nx=arr.shape[-1]
+        while gcd(step, nx) > 1: step+=1
+    return arr.ravel()[::step]
+
+def gcd(a, b):
+    """Return the greatest common divisor of two integers"""
+    while b:
+        a, b=b, a % b
+    return a
 
 def median_combine(arrays, logfile=None, axis=0):
     """Median combine a set of arrays
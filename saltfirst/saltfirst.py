@@ -55,6 +55,7 @@ from fpcal import fpcal
 from findcal import findcal
 from fastmode import runfast
 from sdbloadfits import sdbloadfits
+from saltobslog import ObslogIndex
 
 from saltgui import ImageDisplay, MplCanvas
 from saltsafelog import logging
@@ -72,6 +73,9 @@ from ObsLogWidget import headerList, printList
 
 debug=True
 
+#number of threads used to read the headers of existing data
+headerthreads=4
+
 # -----------------------------------------------------------
 # core routine
 
@@ -135,6 +139,7 @@ class FirstWindow(QtGui.QMainWindow):
         self.update=update
         self.headfiles=[]
         self.pickle_file='%s_obslog.p' % self.obsdate
+        self.index_file='%s_obslog.db' % self.obsdate
 
         # Setup widget
         QtGui.QMainWindow.__init__(self)
@@ -220,6 +225,14 @@ class FirstWindow(QtGui.QMainWindow):
        else:
           self.obsdict = OrderedDict()
 
+       #the header details of each file are kept in an index so they are 
+       #only read once, even if saltfirst is restarted
+       try:
+          self.obsindex = ObslogIndex(self.index_file, table='obsdict')
+       except Exception, e:
+          print 'Not using the observing log index due to: %s' % (str(e))
+          self.obsindex = None
+
    def updateextract(self, y1, y2):
        print y1, y2
        name=self.specTab.name
@@ -517,12 +530,30 @@ class FirstWindow(QtGui.QMainWindow):
 
 
        self.allfiles=self.scamfiles+self.rssfiles+self.hrsfiles+self.hrbfiles
+
+       #read the primary headers of the new fits files.  Files that are 
+       #still being written are left to addtoobsdict, which waits for them
+       newfiles=[f for f in self.allfiles if f[-5:]==".fits" and f.count(self.obsdate) 
+                 and os.path.basename(f) not in self.obsdict.keys()]
+       newfiles=[f for f in newfiles if saltio.fitscomplete(f)]
+       try:
+           imlists=dict(zip(newfiles, self.readheaderdetails(newfiles)))
+       except Exception:
+           #read the files one at a time so only the files that fail are
+           #read again by addtoobsdict
+           imlists={}
+           for f in newfiles:
+               try:
+                   imlists[f]=self.readheaderdetails([f])[0]
+               except Exception:
+                   pass
+
        #create the obsdict
        for i in range(len(self.allfiles)):
            if self.allfiles[i][-5:]==".fits" and self.allfiles[i].count(self.obsdate):
              name=os.path.basename(self.allfiles[i])
              if name not in self.obsdict.keys(): # or not os.path.isfile('mbxp'+name): 
-               name=self.addtoobsdict(self.allfiles[i])
+               name=self.addtoobsdict(self.allfiles[i], imlist=imlists.get(self.allfiles[i]))
                if self.imreduce:
                    self.obsdict[name]=self.cleandata(self.allfiles[i], iminfo=self.obsdict[name],
                              clobber=self.clobber)
@@ -540,7 +571,23 @@ class FirstWindow(QtGui.QMainWindow):
                msg="Sorry I can't handle slotmode files like %s, yet" % self.allfiles[i]
                print msg
 
-   def addtoobsdict(self, infile):
+   def readheaderdetails(self, infiles):
+       """Return the header details of each file in infiles from their 
+          primary headers, using the obslog index if there is one
+       """
+       if self.obsindex is not None:
+           return self.obsindex.records(infiles, getheaderdetails, nthreads=headerthreads)
+       headers=saltio.readprimaryheaders(infiles, nthreads=headerthreads)
+       return [getheaderdetails(f, h) for f, h in zip(infiles, headers)]
+
+   def addtoobsdict(self, infile, imlist=None):
+       #if the header details have already been read and the file is 
+       #complete, only add them
+       if imlist is not None and saltio.fitscomplete(infile):
+           name=os.path.basename(infile)
+           self.obsdict[name]=imlist
+           return name
+
        try:
            warnings.warn('error')
            self.hdu=saltio.openfits(infile)
@@ -740,12 +787,16 @@ def getbasename(hdu):
 def getimagedetails(hdu):
    """Return all the pertinant image header details"""
    filename=hdu._HDUList__file.name
+   return getheaderdetails(filename, hdu[0].header)
+
+def getheaderdetails(filename, header):
+   """Return all the pertinant image header details from a primary header"""
    imlist=[filename]
    print filename
    for k in headerList[1:]:
        try:
-           value=saltkey.get(k, hdu[0])
-       except SaltIOError:
+           value=header[k]
+       except KeyError:
            value=''
        imlist.append(value)
    return imlist
@@ -2,6 +2,7 @@
 import math
 import numpy as np
 import scipy.ndimage as nd
+from scipy import optimize
 
 from saltfit import interfit
 from salterror import SaltError, SaltIOError
@@ -141,11 +142,12 @@ def findcenter(data, ring, method, niter=5, conv=0.05):
    elif method == 'MAX':
       i=0
       c=conv+1
+      profile=RingProfile(data, ring.xc, ring.yc, ring.prad, 10)
       while i < niter and c>conv:
-         xc,yc=maxflux_center(data, ring.xc, ring.yc, ring.prad, 10, maxiter=20)
+         xc,yc=maxflux_center(data, ring.xc, ring.yc, ring.prad, 10, maxiter=20, profile=profile)
          c=((ring.xc-xc)**2+(ring.yc-yc)**2)**0.5
          i+=1
-         rad, rad_err=findradius(data, xc, yc, ring.prad, 10)
+         rad, rad_err=findradius(data, xc, yc, ring.prad, 10, profile=profile)
          ring.xc=xc
          ring.yc=yc
          ring.prad=rad
@@ -163,59 +165,211 @@ def findcenter(data, ring, method, niter=5, conv=0.05):
       raise SaltError('%s is not a valid method' % method)
    return ring
 
-def maxflux_center(data, axc=None, ayc=None,radmax=450, radstep=5, maxiter=100):
+class RingProfile:
+   """Binned radial profiles of the pixels around a ring.  
+
+      The pixels within radstep+margin of the ring are selected once, 
+      and their offsets from the centre used for the selection are kept.
+      The profile about any trial centre close to that centre is then 
+      found from the offsets with np.bincount, so the centre and radius
+      of a ring can be measured without going back to the full image.
+      The pixels are shared between the bins on either side of their 
+      radius, so the profile changes smoothly with the centre.
+
+      Parameters
+      ----------
+      data: ndarray
+         Image of the ring
+      xc, yc: float
+         Starting centre of the ring
+      radmax: float
+         Starting radius of the ring
+      radstep: float
+         Half width of the annulus used to measure the ring
+      binsize: float
+         Size of the radial bins
+      margin: float
+         How far the centre and radius can move before the pixels have
+         to be selected again
+   """
+   def __init__(self, data, xc, yc, radmax, radstep, binsize=0.25, margin=5):
+       self.data=data
+       self.radstep=radstep
+       self.binsize=binsize
+       self.margin=margin
+       self.select(xc, yc, radmax)
+
+   def select(self, xc, yc, radmax):
+       """Select the pixels within radstep+margin of a ring"""
+       ylen,xlen=self.data.shape
+       rout=radmax+self.radstep+self.margin
+       rin=max(radmax-self.radstep-self.margin, 0)
+       x1=max(int(xc-rout), 0)
+       x2=min(int(xc+rout)+2, xlen)
+       y1=max(int(yc-rout), 0)
+       y2=min(int(yc+rout)+2, ylen)
+       y,x=np.ogrid[y1-yc:y2-yc, x1-xc:x2-xc]
+       r2=x**2+y**2
+       mask=(r2>=rin**2)*(r2<=rout**2)
+       yi,xi=np.nonzero(mask)
+       self.x=(xi+x1)-xc
+       self.y=(yi+y1)-yc
+       self.values=self.data[y1:y2,x1:x2][mask].astype(float)
+       if len(self.values)==0:
+          raise SaltError('No pixels around the ring at %.1f, %.1f' % (xc, yc))
+       self.xc=xc
+       self.yc=yc
+       self.radmax=radmax
+       self.nbins=int((rout+2*self.margin)/self.binsize)+2
+       self.total=((self.values-self.values.mean())**2).sum()
+       self.sum2=self.values.sum()**2/len(self.values)
+       self.cache={}
+
+   def update(self, xc, yc, radmax):
+       """Select the pixels again if the ring has moved too far"""
+       shift=((xc-self.xc)**2+(yc-self.yc)**2)**0.5+abs(radmax-self.radmax)
+       if shift>0.5*self.margin:
+          self.select(xc, yc, radmax)
+          return True
+       return False
+
+   def inside(self, xc, yc):
+       return ((xc-self.xc)**2+(yc-self.yc)**2)**0.5<=self.margin
+
+   def profile(self, xc, yc):
+       """Return the flux and number of pixels in each radial bin about 
+          a centre
+       """
+       key=(xc, yc)
+       if key not in self.cache:
+          r=np.hypot(self.x-(xc-self.xc), self.y-(yc-self.yc))/self.binsize-0.5
+          k=np.floor(r)
+          w=r-k
+          k=k.astype(int)+1
+          n=self.nbins
+          flux=np.bincount(k, self.values*(1-w), n)[:n]+np.bincount(k+1, self.values*w, n)[:n]
+          npix=np.bincount(k, 1-w, n)[:n]+np.bincount(k+1, w, n)[:n]
+          if len(self.cache)>100: self.cache={}
+          self.cache[key]=(flux, npix)
+       return self.cache[key]
+
+   def flux(self, xc, yc, rad, radstep=None):
+       """Return the flux between rad-radstep and rad+radstep"""
+       if radstep is None: radstep=self.radstep
+       flux,npix=self.profile(xc, yc)
+       cflux=np.concatenate(([0], np.cumsum(flux)))
+       edges=np.array([rad-radstep, rad+radstep])/self.binsize+1
+       f1, f2=np.interp(edges, np.arange(len(cflux)), cflux)
+       return f2-f1
+
+   def mean(self, xc, yc, rad):
+       """Return the mean value of the pixels at a radius"""
+       flux,npix=self.profile(xc, yc)
+       mask=(npix>0)
+       index=np.arange(self.nbins)-0.5
+       return np.interp(rad/self.binsize, index[mask], flux[mask]/npix[mask])
+
+   def merit(self, xc, yc):
+       """Return the fraction of the variance of the pixels that is 
+          explained by the radial profile about a centre.  This is largest
+          when the profile is sharpest, which is when the centre is the
+          centre of the ring.
+       """
+       if not self.inside(xc, yc): return 0
+       if self.total<=0: return 0
+       flux,npix=self.profile(xc, yc)
+       mask=(npix>0)
+       return ((flux[mask]**2/npix[mask]).sum()-self.sum2)/self.total
+
+def maxflux_center(data, axc=None, ayc=None,radmax=450, radstep=5, maxiter=100, profile=None):
    """Find the center of the data by trying to maximize the flux in the radial distribution
+
+      The centre is first moved in whole pixel steps to the neighbouring
+      pixel with the sharpest radial profile, and then refined to a fraction
+      of a pixel by maximizing the sharpness of the profile with the simplex
+      method.  A RingProfile can be given to reuse the pixels it has 
+      selected.
    """
 
    ylen,xlen=data.shape
    if axc is None: axc=0.5*xlen
    if ayc is None: ayc=0.5*ylen
+   if profile is None: profile=RingProfile(data, axc, ayc, radmax, radstep)
 
-   mflux=0
    niter=0
    found=True
    bxc=axc
    byc=ayc
+   profile.update(bxc, byc, radmax)
+   mflux=profile.merit(bxc, byc)
    while found and niter<maxiter:
     niter+=1
     found=False
+    if profile.update(bxc, byc, radmax):
+       mflux=profile.merit(bxc, byc)
     for i in [-1,0,1]:
      axc=bxc+i
      for j in [-1,0,1]:
       ayc=byc+j
-      flux=calcflux(data, axc, ayc, radmax, radstep)
+      flux=profile.merit(axc, ayc)
       if mflux< flux:
          bxc=axc
          byc=ayc
          mflux=flux
          found=True
-         #print bxc, byc, flux
-         continue
+
+   #refine the centre.  The offsets are scaled so that the starting 
+   #simplex has a size of half a pixel
+   if profile.update(bxc, byc, radmax):
+      mflux=profile.merit(bxc, byc)
+   scale=10.0
+   def call(p):
+       return -profile.merit(bxc+scale*(p[0]-1), byc+scale*(p[1]-1))
+   p=optimize.fmin(call, [1.0, 1.0], xtol=0.001, ftol=1e-10, disp=0)
+   if -call(p)>mflux:
+      bxc=bxc+scale*(p[0]-1)
+      byc=byc+scale*(p[1]-1)
    return bxc, byc
 
-def findradius(data, axc=None, ayc=None,radmax=450, radstep=5, maxiter=100, rstep=0.25):
-   """Find the radius of the ring by trying to maximum the value"""
+def findradius(data, axc=None, ayc=None,radmax=450, radstep=5, maxiter=100, rstep=0.25, profile=None):
+   """Find the radius of the ring by trying to maximum the value
+
+      The mean radial profile about the centre is climbed from radmax in
+      steps of rstep to the peak of the ring, and the peak is then refined
+      by fitting a parabola to the profile around it.  The profile is only
+      calculated once, and a RingProfile can be given to reuse the pixels
+      it has selected.
+   """
    ylen,xlen=data.shape
    if axc is None: axc=0.5*xlen
    if ayc is None: ayc=0.5*ylen
+   if profile is None: profile=RingProfile(data, axc, ayc, radmax, radstep)
+   profile.update(axc, ayc, radmax)
 
-   mflux=calcflux(data, axc, ayc, radmax, radstep)
    niter=0
    found=True
    brad=radmax
-   brad_err=max(brad*(mflux/mflux**2)**0.5,1.0)
-   while found and niter<100:
+   mflux=profile.mean(axc, ayc, brad)
+   while found and niter<maxiter:
     niter+=1
     found=False
+    if profile.update(axc, ayc, brad):
+       mflux=profile.mean(axc, ayc, brad)
     for i in [-rstep,rstep]:
       rad=brad+i
-      flux=calcflux(data, axc, ayc, rad, radstep)
+      flux=profile.mean(axc, ayc, rad)
       if mflux< flux:
          brad=rad
-         brad_err=(rad*(flux/flux**2)**0.5)
          mflux=flux
          found=True
-         continue
+
+   #fit a parabola to the peak
+   f1,f2,f3=[profile.mean(axc, ayc, brad+i) for i in [-rstep, 0, rstep]]
+   if f1-2*f2+f3<0:
+      brad+=rstep*min(max(0.5*(f1-f3)/(f1-2*f2+f3), -1), 1)
+
+   flux=profile.flux(axc, ayc, brad, radstep)
+   brad_err=brad*(flux/flux**2)**0.5
    return brad, brad_err
 
 def calcflux(data, axc, ayc, radmax, radstep):
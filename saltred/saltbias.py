@@ -85,7 +85,8 @@ from matplotlib import font_manager
 def saltbias(images,outimages,outpref,subover=True,trim=True,subbias=False,
              masterbias='bias.fits', median=False, function='polynomial', 
              order=3, rej_lo=3, rej_hi=3, niter=10, plotover=False, 
-             turbo=False, clobber=False, logfile='salt.log', verbose=True):
+             turbo=False, dtype='auto', clobber=False, logfile='salt.log', 
+             verbose=True):
 
    status = 0
    ifil = 0
@@ -149,7 +150,7 @@ def saltbias(images,outimages,outpref,subover=True,trim=True,subbias=False,
            struct=bias(struct,subover=subover, trim=trim, subbias=subbias, 
                        bstruct=bstruct, median=median, function=function,
                        order=order, rej_lo=rej_lo, rej_hi=rej_hi, niter=niter,
-                       plotover=plotover, log=log, verbose=verbose)
+                       plotover=plotover, dtype=dtype, log=log, verbose=verbose)
 
            #write the file out
            # housekeeping keywords
@@ -163,7 +164,7 @@ def saltbias(images,outimages,outpref,subover=True,trim=True,subbias=False,
 
 def bias(struct,subover=True,trim=True, subbias=False, bstruct=None, 
          median=False, function='polynomial',order=3,rej_lo=3,rej_hi=3,niter=10,
-         plotover=False, log=None, verbose=True):
+         plotover=False, dtype='auto', log=None, verbose=True):
    """Bias subtracts the bias levels from a frame.  It will fit and subtract the overscan
       region, trim the images, and subtract a master bias if required.
 
@@ -178,6 +179,7 @@ def bias(struct,subover=True,trim=True, subbias=False, bstruct=None,
       rej_lo--sigma  of low points to reject in the fit
       rej_hi--sigma of high points to reject in the fit
       niter--number of iterations
+      dtype--data type of the overscan subtracted data: auto, double, or real
       log--saltio log for recording information
       verbose--whether to print to stdout 
    """
@@ -210,61 +212,56 @@ def bias(struct,subover=True,trim=True, subbias=False, bstruct=None,
        plt.ion()
 
 
+   #measure the overscan region of each amplifier
+   odict={}
+   if subover:
+       for i in range(1,nsciext+1):
+         if struct[i].name=='SCI':
+           biassec = saltkey.get('BIASSEC',struct[i])
+           y1,y2,x1,x2 = saltio.getSection(biassec, iraf_format=True)
+           if median:
+              odata=np.median((struct[i].data[y1:y2,x1:x2]),axis=1)
+              olevel=np.median((struct[i].data[y1:y2,x1:x2]))
+              saltkey.new('OVERSCAN','%f' % (olevel),'Overscan median value', struct[i])
+           else:
+              odata=np.mean((struct[i].data[y1:y2,x1:x2]),axis=1)
+              olevel=np.mean((struct[i].data[y1:y2,x1:x2]))
+              saltkey.new('OVERSCAN','%f' % (olevel),'Overscan mean value', struct[i])
+           odict[i]=[y1, y2, odata, olevel]
+
+   #fit the overscan regions of all the amplifiers with the same rows together
+   ofits=fitoverscan(odict, function=function, order=order, thresh=rej_hi, niter=niter)
+
    #loop through the extensions and subtract the bias
    for i in range(1,nsciext+1):
      if struct[i].name=='SCI':
 
-       #get the bias section
-       biassec = saltkey.get('BIASSEC',struct[i])
-       y1,y2,x1,x2 = saltio.getSection(biassec, iraf_format=True)
        #get the data section
        datasec = saltkey.get('DATASEC',struct[i])
        dy1,dy2, dx1, dx2 = saltio.getSection(datasec, iraf_format=True)
   
-       #setup the overscan region
+       #subtract the overscan region
        if subover:
+           y1, y2, odata, olevel=odict[i]
            yarr=np.arange(y1,y2, dtype=float)
-           data=struct[i].data
-           odata=struct[i].data[y1:y2,x1:x2]
-           if median:
-              odata=np.median((struct[i].data[y1:y2,x1:x2]),axis=1)
-              olevel=np.median((struct[i].data[y1:y2,x1:x2]))
-              saltkey.new('OVERSCAN','%f' % (olevel),'Overscan median value', struct[i])
-           else:
-              odata=np.mean((struct[i].data[y1:y2,x1:x2]),axis=1)
-              olevel=np.mean((struct[i].data[y1:y2,x1:x2]))
-              saltkey.new('OVERSCAN','%f' % (olevel),'Overscan mean value', struct[i])
-
-           #fit the overscan region
-           ifit=saltfit.interfit(yarr, odata, function=function, \
-                                 order=order, thresh=rej_hi, niter=niter)
+           ofit=ofits[i]
            try:
-               ifit.interfit()
-               coeffs=ifit.coef
-               ofit=ifit(yarr)
                omean, omed, osigma=saltstat.iterstat((odata-ofit), sig=3, niter=5)
-           except ValueError:
-               #catch the error if it is a zero array
-               ofit=np.array(yarr)*0.0
-               osigma=0.0
-           except TypeError:
+           except (ValueError, TypeError):
                #catch the error if it is a zero array
-               ofit=np.array(yarr)*0.0
                osigma=0.0
 
            #if it hasn't been already, convert image to
-           #double format
-           struct[i].data = 1.0 * struct[i].data
+           #floating point format
+           struct[i].data = asfloat(struct[i].data, dtype)
            try:
                struct[i].header.remove('BZERO')
                struct[i].header.remove('BSCALE')
            except:
                pass
 
-
            #subtract the overscan region
-           for j in range(len(struct[i].data[0])):
-               struct[i].data[y1:y2,j] -= ofit
+           struct[i].data[y1:y2] -= ofit[:,np.newaxis]
 
            #report the information 
            if log:
@@ -279,10 +276,9 @@ def bias(struct,subover=True,trim=True, subbias=False, bstruct=None,
            if saltkey.found('VAREXT', struct[i]):
                vhdu=saltkey.get('VAREXT', struct[i])
                try:
-                   vdata=struct[vhdu].data
+                   vdata=asfloat(struct[vhdu].data, dtype)
                    #The bias level should not be included in the noise from the signal
-                   for j in range(len(struct[i].data[0])):
-		       vdata[y1:y2,j] -= ofit
+                   vdata[y1:y2] -= ofit[:,np.newaxis]
                    #add a bit to make sure that the minimum error is the rednoise
                    rdnoise= saltkey.get('RDNOISE',struct[i])
                    vdata[vdata<rdnoise**2]=rdnoise**2
@@ -339,6 +335,51 @@ def bias(struct,subover=True,trim=True, subbias=False, bstruct=None,
 
    return struct
 
+def fitoverscan(odict, function='polynomial', order=3, thresh=3, niter=10):
+   """Fit the overscan levels of all the amplifiers.  The amplifiers that
+      share the same overscan rows are fit together with saltfit.batchfit,
+      which rejects points in the same way as saltfit.interfit.
+
+      odict--dictionary of [y1, y2, odata, olevel] for each extension
+      function--form to fit to the overscan region
+      order--order for the function
+      thresh--sigma of points to reject in the fit
+      niter--number of iterations
+
+      returns a dictionary of the fit to each extension
+   """
+   groups={}
+   for i in odict:
+       y1, y2=odict[i][:2]
+       groups.setdefault((y1,y2), []).append(i)
+
+   ofits={}
+   for (y1,y2), extlist in groups.items():
+       yarr=np.arange(y1,y2, dtype=float)
+       odata=np.array([odict[i][2] for i in extlist])
+       yfit=saltfit.batchfit(yarr, odata, function=function, order=order,
+                             thresh=thresh, niter=niter)
+       for i, ofit in zip(extlist, yfit):
+           ofits[i]=ofit
+   return ofits
+
+def asfloat(data, dtype='auto'):
+   """Convert the data to floating point.  For dtype='auto', floating
+      point data keep their type and integer data become double precision.
+      Otherwise, the data are converted to 'double' or 'real' (single
+      precision).  The data are only copied if the type changes.
+   """
+   if dtype=='auto':
+       if data.dtype.kind=='f': return data
+       return data.astype(np.float64)
+   elif dtype=='double':
+       return data.astype(np.float64, copy=False)
+   elif dtype=='real':
+       return data.astype(np.float32, copy=False)
+   else:
+       msg='%s is not a valid data type' % dtype
+       raise SaltError(msg)
+
 # -----------------------------------------------------------
 # main code
 
@@ -59,6 +59,7 @@ Todo
 from __future__ import with_statement
 
 import sys,glob, os, shutil, time
+import multiprocessing as mp
 import numpy as np
 from astropy.io import fits
 
@@ -71,8 +72,8 @@ from saltgain import gain
 from saltxtalk  import xtalk
 from saltbias import bias
 from saltflat import flat
-from saltcombine import saltcombine 
-from saltmosaic import saltmosaic
+from saltcombine import imcombine
+from saltmosaic import make_mosaic, read_geometry, set_cachedir
 
 import saltsafestring as saltstring
 import saltsafekey as saltkey
@@ -93,12 +94,28 @@ flatheader_list=['INSTRUME', 'DETMODE', 'CCDSUM', 'GAINSET', 'ROSPEED', 'FILTER'
 def saltclean(images, outpath, obslogfile=None, gaindb=None,xtalkfile=None, 
 	geomfile=None,subover=True,trim=True,masbias=None, 
         subbias=False, median=False, function='polynomial', order=5,rej_lo=3,
-        rej_hi=3,niter=5,interp='linear', clobber=False, logfile='salt.log', 
-        verbose=True):
+        rej_hi=3,niter=5,interp='linear', geotran=True, cachedir='', keepint=False, nproc=1, 
+        obsindex=None, clobber=False, logfile='salt.log', verbose=True):
    """SALTCLEAN will provide basic CCD reductions for a set of data.  It will 
       sort the data, and first process the biases, flats, and then the science 
       frames.  It will record basic quality control information about each of 
       the steps.
+
+      Each raw frame is read once and kept in memory through all of the 
+      steps up to the mosaic.  The processed but not mosaicked frames are 
+      only written for the bias frames, for fast modes or if keepint is set.
+      The flat frames that go into a master flat are otherwise written to 
+      temporary files, which are removed once the master flat is made, so
+      that the master frames are combined from disk in strips.
+
+      The frames are processed by nproc worker processes, or by as many 
+      processes as there are CPUs if nproc is None.  Each master frame is
+      combined as soon as all of its frames are finished.  The worker 
+      processes can not run IRAF tasks, so if there is more than one process
+      the frames are always mosaicked in memory rather than with geotran.
+
+      If obsindex is given, the header records for the observation log are
+      kept in that index so only new or changed files are read again.
    """
    plotover=False
 
@@ -136,7 +153,7 @@ def saltclean(images, outpath, obslogfile=None, gaindb=None,xtalkfile=None,
            msg='The observing log already exists.  Please either delete it or run saltclean with clobber=yes'
            raise SaltError(msg)
        else:
-           headerDict=obslog(infiles, log)
+           headerDict=obslog(infiles, log, indexfile=saltio.checkfornone(obsindex))
            obsstruct=createobslogfits(headerDict)
            saltio.writefits(obsstruct, obslogfile)
 
@@ -145,144 +162,205 @@ def saltclean(images, outpath, obslogfile=None, gaindb=None,xtalkfile=None,
        detmode=obsstruct.data.field('DETMODE')
        ccdtype=obsstruct.data.field('CCDTYPE')
 
-       #set the bias list of objects
+       #set up the processing of each frame.  The log can not be passed to
+       #the worker processes, so the frames are only logged in detail when
+       #they are processed serially
+       fname, hist=history(level=1, wrap=False, exclude=['images', 'outimages', 'outpref'])
+       serial=(nproc is not None and nproc<=1)
+
+       #the worker processes are forked from this session and would share 
+       #its IRAF subprocesses, which is not safe, so they mosaic the frames
+       #in memory
+       if geotran and not serial:
+           geotran=False
+           msg='The frames are mosaicked in memory as geotran can not be used with nproc>1'
+           log.warning(msg, with_stdout=verbose)
+       pars=dict(dblist=dblist, xdict=xdict, subover=subover, trim=trim, median=median, 
+                 function=function, order=order, rej_lo=rej_lo, rej_hi=rej_hi, niter=niter,
+                 plotover=plotover, log=log if serial else None, verbose=verbose)
+       geometry=read_geometry(geomfile)
+
+       #the mosaic plans are set up before the worker processes are started
+       #so they also read and write the plans in cachedir
+       set_cachedir(cachedir)
+
+       #group the calibration frames by their setup.  The keywords used
+       #for the groups are in the primary header of the raw frames so the 
+       #groups are known before any of the frames are processed
        biaslist=filename[ccdtype=='ZERO']
+       flatlist=filename[ccdtype=='FLAT']
        masterbias_dict={}
+       masterflat_dict={}
        for img in infiles:
-           if os.path.basename(img) in biaslist:
-               #open the image
-               struct=fits.open(img)
-               bimg=outpath+'bxgp'+os.path.basename(img)
-
-               #print the message
-               if log:
-                   message='Processing Zero frame %s' % img
-                   log.message(message, with_stdout=verbose)
-
-               #process the image
-               struct=clean(struct, createvar=False, badpixelstruct=None, mult=True, 
-                            dblist=dblist, xdict=xdict, subover=subover, trim=trim, subbias=False,
-                            bstruct=None, median=median, function=function, order=order,
-                            rej_lo=rej_lo, rej_hi=rej_hi, niter=niter, plotover=plotover, log=log,
-                            verbose=verbose)
-
-               #write the file out
-               # housekeeping keywords
-               fname, hist=history(level=1, wrap=False, exclude=['images', 'outimages', 'outpref'])
-               saltkey.housekeeping(struct[0],'SPREPARE', 'Images have been prepared', hist)
-               saltkey.new('SGAIN',time.asctime(time.localtime()),'Images have been gain corrected',struct[0])
-               saltkey.new('SXTALK',time.asctime(time.localtime()),'Images have been xtalk corrected',struct[0])
-               saltkey.new('SBIAS',time.asctime(time.localtime()),'Images have been de-biased',struct[0])
-
-               # write FITS file
-               saltio.writefits(struct,bimg, clobber=clobber)
-               saltio.closefits(struct)
-
-               #add files to the master bias list
-               masterbias_dict=compareimages(struct, bimg, masterbias_dict, keylist=biasheader_list)
-
-       #create the master bias frame
+           nimg=os.path.basename(img)
+           if nimg in biaslist:
+               struct=[fits.PrimaryHDU(header=saltio.readprimaryheader(img))]
+               masterbias_dict=compareimages(struct, outpath+'bxgp'+nimg, masterbias_dict, keylist=biasheader_list)
+           elif nimg in flatlist:
+               struct=[fits.PrimaryHDU(header=saltio.readprimaryheader(img))]
+               masterflat_dict=compareimages(struct, outpath+'bxgp'+nimg, masterflat_dict, keylist=flatheader_list)
+
+       #set up the master frames and the number of frames each one needs
+       masters=[]
        for i in masterbias_dict.keys():
-           bkeys=masterbias_dict[i][0]
            blist=masterbias_dict[i][1:]
-           mbiasname=outpath+createmasterbiasname(blist, bkeys)
-           bfiles=','.join(blist)
-           saltcombine(bfiles, mbiasname, method='median', reject='sigclip', mask=False, 
-                       weight=False, blank=0, scale=None, statsec=None, lthresh=3,    \
-                       hthresh=3, clobber=False, logfile=logfile,verbose=verbose)
-
-           
-
-       #create the list of flatfields and process them
-       flatlist=filename[ccdtype=='FLAT']
-       masterflat_dict={}
-       for img in infiles:
-           if os.path.basename(img) in flatlist:
-               #open the image
-               struct=fits.open(img)
-               fimg=outpath+'bxgp'+os.path.basename(img)
-
-               #print the message
-               if log:
-                   message='Processing Flat frame %s' % img
-                   log.message(message, with_stdout=verbose)
-
-               #process the image
-               struct=clean(struct, createvar=False, badpixelstruct=None, mult=True, 
-                            dblist=dblist, xdict=xdict, subover=subover, trim=trim, subbias=False,
-                            bstruct=None, median=median, function=function, order=order,
-                            rej_lo=rej_lo, rej_hi=rej_hi, niter=niter, plotover=plotover, log=log,
-                            verbose=verbose)
-
-               #write the file out
-               # housekeeping keywords
-               fname, hist=history(level=1, wrap=False, exclude=['images', 'outimages', 'outpref'])
-               saltkey.housekeeping(struct[0],'SPREPARE', 'Images have been prepared', hist)
-               saltkey.new('SGAIN',time.asctime(time.localtime()),'Images have been gain corrected',struct[0])
-               saltkey.new('SXTALK',time.asctime(time.localtime()),'Images have been xtalk corrected',struct[0])
-               saltkey.new('SBIAS',time.asctime(time.localtime()),'Images have been de-biased',struct[0])
-
-               # write FITS file
-               saltio.writefits(struct,fimg, clobber=clobber)
-               saltio.closefits(struct)
-
-               #add files to the master bias list
-               masterflat_dict=compareimages(struct, fimg, masterflat_dict,  keylist=flatheader_list)
-
-       #create the master flat frame
+           masters.append((outpath+createmasterbiasname(blist, masterbias_dict[i][0]), blist))
        for i in masterflat_dict.keys():
-           fkeys=masterflat_dict[i][0]
            flist=masterflat_dict[i][1:]
-           mflatname=outpath+createmasterflatname(flist, fkeys)
-           ffiles=','.join(flist)
-           saltcombine(ffiles, mflatname, method='median', reject='sigclip', mask=False, 
-                       weight=False, blank=0, scale=None, statsec=None, lthresh=3,    \
-                       hthresh=3, clobber=False, logfile=logfile,verbose=verbose)
-
-       #process the science data
+           masters.append((outpath+createmasterflatname(flist, masterflat_dict[i][0]), flist))
+       calframes={}
+       tmpfiles=[]
+       for mname, mlist in masters:
+           for m in mlist: calframes[m]=None
+
+       #create the list of frames to process.  None of the frames depend on 
+       #each other, so they can be processed in any order.  The calibration 
+       #frames are queued first so the masters can be made as soon as possible
+       tasks=[]
+       for img in infiles:
+           nimg=os.path.basename(img)
+           if nimg in biaslist: tasks.append((img, 'ZERO'))
+       for img in infiles:
+           nimg=os.path.basename(img)
+           if nimg in flatlist: tasks.append((img, 'FLAT'))
        for img in infiles:
            nimg=os.path.basename(img)
-           #print nimg, nimg in flatlist, nimg in biaslist
-           if not (nimg in biaslist):
-               #open the image
-               struct=fits.open(img)
-               simg=outpath+'bxgp'+os.path.basename(img)
+           if not (nimg in biaslist or nimg in flatlist): tasks.append((img, 'OBJECT'))
+       tasks=[(img, ftype, outpath, hist, pars, geometry, interp, geotran, keepint, clobber) 
+              for img, ftype in tasks]
+
+       if not serial:
+           pool=mp.Pool(nproc)
+           results=pool.imap_unordered(runframe, tasks)
+       else:
+           pool=None
+           results=(runframe(t) for t in tasks)
 
-               #print the message
+       #as each frame is finished, create any master frame that now has 
+       #all of its frames
+       try:
+           for img, ftype, calfile in results:
                if log:
-                   message='Processing science frame %s' % img
+                   message='Processed %s frame %s' % (ftype, img)
                    log.message(message, with_stdout=verbose)
+               bimg=outpath+'bxgp'+os.path.basename(img)
+               if calfile is not None and calfile!=bimg: tmpfiles.append(calfile)
+               if bimg not in calframes: continue
+               calframes[bimg]=calfile
+               for mname, mlist in masters:
+                   if bimg in mlist and all([calframes[m] is not None for m in mlist]):
+                       combinemaster([calframes[m] for m in mlist], mname, log=log, verbose=verbose)
+                       for m in mlist: 
+                           if calframes[m] in tmpfiles: 
+                               saltio.delete(calframes[m])
+                               tmpfiles.remove(calframes[m])
+                           calframes[m]=None
+       finally:
+           if pool is not None:
+               pool.close()
+               pool.join()
+           for f in tmpfiles:
+               if os.path.isfile(f): os.remove(f)
+
+
+def runframe(task):
+   """Process a single frame.  task is a tuple of the arguments for
+      processframe.  This is the function that is run by the worker 
+      processes.
+   """
+   return processframe(*task)
 
-               #process the image
-               struct=clean(struct, createvar=False, badpixelstruct=None, mult=True, 
-                            dblist=dblist, xdict=xdict, subover=subover, trim=trim, subbias=False,
-                            bstruct=None, median=median, function=function, order=order,
-                            rej_lo=rej_lo, rej_hi=rej_hi, niter=niter, plotover=plotover, log=log,
-                            verbose=verbose)
 
-               #write the file out
-               # housekeeping keywords
-               fname, hist=history(level=1, wrap=False, exclude=['images', 'outimages', 'outpref'])
-               saltkey.housekeeping(struct[0],'SPREPARE', 'Images have been prepared', hist)
-               saltkey.new('SGAIN',time.asctime(time.localtime()),'Images have been gain corrected',struct[0])
-               saltkey.new('SXTALK',time.asctime(time.localtime()),'Images have been xtalk corrected',struct[0])
-               saltkey.new('SBIAS',time.asctime(time.localtime()),'Images have been de-biased',struct[0])
+def processframe(img, ftype, outpath, hist, pars, geometry, interp='linear', geotran=True, 
+                 keepint=False, clobber=False):
+   """Process a single raw frame through the full chain and write out its 
+      products.  ZERO frames are written after they are bias corrected and
+      all other frames are mosaicked unless they are in a fast mode.
 
-               # write FITS file
-               saltio.writefits(struct,simg, clobber=clobber)
-               saltio.closefits(struct)
+      The processed ZERO and FLAT frames are needed for the master frames, 
+      so the name of a file holding each of them before it is mosaicked is
+      returned.  This is the processed frame itself if it is written, and
+      otherwise a temporary file that should be deleted once the master
+      frame has been made.  The frames are passed on through files rather
+      than in memory so that the master frames can be combined in strips.
 
-               #mosaic the files--currently not in the proper format--will update when it is
-               if not saltkey.fastmode(saltkey.get('DETMODE', struct[0])):
-                   mimg=outpath+'mbxgp'+os.path.basename(img)
-                   saltmosaic(images=simg, outimages=mimg,outpref='',geomfile=geomfile,
-                        interp=interp,cleanup=True,clobber=clobber,logfile=logfile,
-                        verbose=verbose)
+      returns img, ftype, calfile
+   """
+   struct=cleanframe(img, hist, **pars)
+   simg=outpath+'bxgp'+os.path.basename(img)
+
+   #the processed frame is the final product for ZERO frames and fast 
+   #modes, otherwise it is only written if intermediate files are kept
+   fastmode=saltkey.fastmode(saltkey.get('DETMODE', struct[0]))
+   if ftype=='ZERO' or fastmode or keepint:
+       saltio.writefits(struct,simg, clobber=clobber)
+
+   #keep a copy of the calibration frames before they are mosaicked
+   calfile=None
+   if ftype in ['ZERO', 'FLAT']:
+       if ftype=='ZERO' or fastmode or keepint:
+           calfile=simg
+       else:
+           calfile=saltio.tmpfile(outpath)+'.fits'
+           struct.writeto(calfile)
+
+   #mosaic the files
+   if ftype!='ZERO' and not fastmode:
+       gap, xshift, yshift, rotation = geometry
+       mimg=outpath+'mbxgp'+os.path.basename(img)
+       mstruct=make_mosaic(struct, gap, xshift, yshift, rotation, interp_type=interp,
+                           geotran=geotran, fill=False, cleanup=True, log=pars.get('log'), 
+                           verbose=pars.get('verbose', True))
+       saltkey.housekeeping(mstruct[0], 'SMOSAIC', 'Images have been mosaicked', hist)
+       mstruct.writeto(mimg, clobber=clobber, output_verify='ignore')
+       saltio.closefits(mstruct)
+   saltio.closefits(struct)
+   return img, ftype, calfile
+
+
+
+def cleanframe(img, hist, dblist=None, xdict=None, subover=True, trim=True, median=False, 
+               function='polynomial', order=3, rej_lo=3, rej_hi=3, niter=10, plotover=False, 
+               log=None, verbose=True):
+   """Read in a raw image, prepare, gain, xtalk and bias correct it and add the 
+      housekeeping keywords for each of those steps
+
+      returns struct
+   """
+   struct=fits.open(img)
+   struct=clean(struct, createvar=False, badpixelstruct=None, mult=True, 
+                dblist=dblist, xdict=xdict, subover=subover, trim=trim, subbias=False,
+                bstruct=None, median=median, function=function, order=order,
+                rej_lo=rej_lo, rej_hi=rej_hi, niter=niter, plotover=plotover, log=log,
+                verbose=verbose)
+
+   # housekeeping keywords
+   saltkey.housekeeping(struct[0],'SPREPARE', 'Images have been prepared', hist)
+   saltkey.new('SGAIN',time.asctime(time.localtime()),'Images have been gain corrected',struct[0])
+   saltkey.new('SXTALK',time.asctime(time.localtime()),'Images have been xtalk corrected',struct[0])
+   saltkey.new('SBIAS',time.asctime(time.localtime()),'Images have been de-biased',struct[0])
+   return struct
 
-                   #remove the intermediate steps
-                   saltio.delete(simg)
 
+def combinemaster(structs, outimage, log=None, verbose=True):
+   """Median combine a list of processed structures or files into a master 
+      calibration frame and write it to outimage
+   """
+   if log:
+       message='Combining %i frames into %s' % (len(structs), outimage)
+       log.message(message, with_stdout=verbose)
+
+   outstruct=imcombine(structs, method='median', reject='sigclip', mask=False, 
+                       weight=False, blank=0, scale=None, statsec=None, lthresh=3,    \
+                       hthresh=3)
+
+   # housekeeping keywords
+   fname, hist=history(level=1, wrap=False, exclude=['structs'])
+   saltkey.housekeeping(outstruct[0],'SCOMBINE', 'File Combined by SALTCOMBINE', hist)
 
+   # write FITS file               
+   saltio.writefits(outstruct, outimage)
+   saltio.closefits(outstruct)
 
 
 def compareimages(struct, oimg, imdict, keylist):
@@ -40,6 +40,7 @@ from pyraf import iraf
 
 import saltsafekey as saltkey
 import saltsafeio as saltio
+import saltsafestring as saltstring
 from saltsafelog import logging, history
 
 from salterror import SaltError
@@ -52,7 +53,8 @@ debug=True
 
 def saltcombine(images,outimage, method='average', reject=None, mask=True,     \
                 weight=True, blank=0, scale=None, statsec=None, lthresh=3,    \
-                hthresh=3, clobber=False, logfile='salt.log',verbose=True):
+                hthresh=3, niter=1, nlow=1, nhigh=1, maxmem='0.2GB', clobber=False, \
+                logfile='salt.log',verbose=True):
 
    with logging(logfile,debug) as log:
 
@@ -74,7 +76,8 @@ def saltcombine(images,outimage, method='average', reject=None, mask=True,     \
        #Fast combine the images
        outstruct=imcombine(infiles, method=method, reject=reject, mask=mask, \
                            weight=weight, blank=blank, scale=scale,          \
-                           statsec=statsec, lthresh=lthresh, hthresh=hthresh)
+                           statsec=statsec, lthresh=lthresh, hthresh=hthresh,\
+                           niter=niter, nlow=nlow, nhigh=nhigh, maxmem=maxmem)
 
        # housekeeping keywords
        fname, hist=history(level=1, wrap=False)
@@ -84,19 +87,26 @@ def saltcombine(images,outimage, method='average', reject=None, mask=True,     \
        saltio.writefits(outstruct, outimage)
 
 def imcombine(infiles, method='average', reject=None, mask=True,  weight=True, \
-              blank=0, scale=None, statsec=None, lthresh=3,  hthresh=3):
+              blank=0, scale=None, statsec=None, lthresh=3,  hthresh=3, niter=1, \
+              nlow=1, nhigh=1, maxmem='0.2GB'):
    """Fast combine is for special circumstances where the files and the combination 
        can be down one by one and not all of the data need to be read in all at once.
        It computes the average of the files input in infile
 
+       The files are memory mapped and each extension is combined in strips
+       of rows.  The number of rows in a strip is set so that the data, 
+       variance and BPM cubes for a strip fit in maxmem.  The cubes are 
+       allocated once for each extension and reused for every strip.
+
        Input Variables:
-       infiles:  List of files to combine
+       infiles:  List of files or HDULists to combine
 
        method:  Combination method to use, either average or median
 
        reject:  Reject outliers using different methods
                 -ccdclip--reject the pixels according to the CCD parameters
                 -sigclip--reject the pixels according to a sigma clipping
+                -minmax--reject the nlow lowest and nhigh highest pixels
                 
        mask:  Whether to correct the data using the BPM frame
 
@@ -112,65 +122,77 @@ def imcombine(infiles, method='average', reject=None, mask=True,  weight=True, \
       
        hthresh: high rejection threshold
 
+       niter: number of iterations for sigclip and ccdclip
+
+       nlow, nhigh: number of low and high pixels to reject for minmax
+
+       maxmem: memory to use for the cubes, e.g. '2GB'
+
        Return Variables:
        
        hdustruct:  Output struct 
    """
    hdu_list=[]
+   opened=[]
 
    #read in all of the data
    for infile in infiles:
-       #hdu_list.append(saltio.openfits(infile))
-       hdu_list.append(fits.open(infile, memmap=True))
+       if isinstance(infile, fits.HDUList):
+           hdu_list.append(infile)
+       else:
+           #hdu_list.append(saltio.openfits(infile))
+           hdu_list.append(fits.open(infile, memmap=True))
+           opened.append(len(hdu_list)-1)
 
    #Copy the first image and create the HDU for the other images
    try:
-       outhdu=hdu_list[0]
+       outhdu=fits.HDUList([hdu.copy() for hdu in hdu_list[0]])
    except Exception, e:
        message='Cannot create output hduList because %s' % e
        raise SaltError(message)
-   #determine the size of a single extension.  Assumes all arrays are the same size
-   hdu=hdu_list[0]
 
    #For each science extension, construct the array of arrays to go into that
    #Three arrays need to be constructed including one for the data array,
    #one for the inv variance array, and one for the BPM
 
-
    #This assumes all the data are the same shape and size
    nimages=len(hdu_list)
 
-   mem_lim=0.2
-   if reject or weight or mask: 
-      mem_lim=mem_lim/4.0
+   #set the memory available for the cubes
+   maxmem=saltstring.parsemem(maxmem)
   
    for i in range(len(outhdu)):
        if outhdu[i].name=='SCI':
-           nb=outhdu[i].data.nbytes
-           outhdu[i].data *= 0.0
-           #let's set the limit at 0.2 GB of memory
-           if nb*nimages/1e9>mem_lim: 
-              imod=int((nb*nimages/1e9)/mem_lim)+1
-              y2,x2=outhdu[i].data.shape
-              ystep=y2/imod
-              xstep=x2/imod
-              for j in range(imod):
-                for k in range(imod):
-                  datasec=[j*ystep, min(y2,(j+1)*ystep), k*xstep, min(x2, (k+1)*xstep)]
-                  outhdu=hducombine(hdu_list, outhdu, ext=i, method=method, datasec=datasec,
+           y2,x2=outhdu[i].data.shape
+
+           #determine how many rows can be combined at once.  Each row needs
+           #a data cube, the variance cube and the bpm or rejection mask.
+           #The temporary arrays in FusedCombine are only the size of a block
+           ncube=1.5
+           if weight and saltkey.found('VAREXT', outhdu[i]): ncube += 1
+           rowbytes=nimages*x2*np.dtype(float).itemsize*ncube
+           nrows=int(max(1, min(y2, maxmem/rowbytes)))
+
+           #calculate the scale for each image from the whole extension
+           scales=None
+           if scale:
+              scales=[CalculateScale(hdu_list[j][i].data, scale, statsec) for j in range(nimages)]
+
+           cubes={}
+           for y1 in range(0, y2, nrows):
+              datasec=[y1, min(y2, y1+nrows), 0, x2]
+              outhdu=hducombine(hdu_list, outhdu, ext=i, method=method, datasec=datasec,
                          reject=reject, mask=mask,weight=weight, scale=scale, statsec=statsec, blank=blank,
-                         lthresh=lthresh, hthresh=hthresh) 
-              #this step is needed to remove data arrays that are read into memory
-              #--not sure what object they are linked to, but this works
-              try:
-                 for j in range(nimages): del hdu_list[j][i].data
-              except:
-                 pass
-           else:  
-              outhdu=hducombine(hdu_list, outhdu, ext=i, method=method, datasec=None, 
-                         reject=reject, mask=mask,weight=weight, scale=scale, statsec=statsec, 
-                         lthresh=lthresh, hthresh=hthresh)
-           
+                         lthresh=lthresh, hthresh=hthresh, niter=niter, nlow=nlow, nhigh=nhigh, 
+                         scales=scales, cubes=cubes) 
+           del cubes
+
+           #this step is needed to remove data arrays that are read into memory
+           #--not sure what object they are linked to, but this works
+           try:
+              for j in opened: del hdu_list[j][i].data
+           except:
+              pass
 
    #Add any header frames
    saltkey.new('NCOMBINE',nimages,'Number of images combines', outhdu[0])
@@ -178,15 +200,31 @@ def imcombine(infiles, method='average', reject=None, mask=True,  weight=True, \
    return outhdu
 
 
-def hducombine(hdu_list, outhdu, ext, method='average', datasec=None, reject=None, mask=False, weight=False, scale=None, statsec=None, blank=0, lthresh=3, hthresh=3):
+def getcube(cubes, name, nimages, shape, dtype):
+   """Return a (nimages, ny, nx) array for a strip of the given shape.  If 
+      cubes is a dictionary, the array is a view of a cube stored in cubes
+      so that the memory is only allocated once and reused for each strip.
+   """
+   if cubes is None: 
+      return np.zeros((nimages, shape[0], shape[1]), dtype=dtype)
+   cube=cubes.get(name, None)
+   if cube is None or cube.dtype!=dtype or cube.shape[1]<shape[0] or cube.shape[2]!=shape[1]:
+      cube=np.zeros((nimages, shape[0], shape[1]), dtype=dtype)
+      cubes[name]=cube
+   return cube[:,:shape[0],:]
+
+def hducombine(hdu_list, outhdu, ext, method='average', datasec=None, reject=None, mask=False, weight=False, scale=None, statsec=None, blank=0, lthresh=3, hthresh=3, niter=1, nlow=1, nhigh=1, scales=None, cubes=None):
    """Combine a set of images in imlist 
 
+      scales: list of the scale for each image.  If None, they are calculated
+              from the extension in each image
+
+      cubes: dictionary of cubes to reuse between calls (see getcube)
    """
    #set up i as the extionsion variable as  shortcut
    i=ext
    nimages=len(hdu_list)
    #set all the data arrays
-   data_list=[]
    gain=np.zeros(nimages)
    rdnoise=np.zeros(nimages)
    varext=None
@@ -195,7 +233,6 @@ def hducombine(hdu_list, outhdu, ext, method='average', datasec=None, reject=Non
 
    #set the datasec in case it is none as the full image
    if datasec is None:
-      sh=outhdu[ext].data.shape
       y1,x1=(0,0)
       y2,x2=outhdu[i].data.shape
    else:
@@ -208,29 +245,36 @@ def hducombine(hdu_list, outhdu, ext, method='average', datasec=None, reject=Non
    #check for variance frame
    if saltkey.found('VAREXT', outhdu[i]) and weight:
        varext=saltkey.get('VAREXT', outhdu[i])
-       var_list=[]
+       var_arr=getcube(cubes, 'var', nimages, dshape, float)
+   else:
+       var_arr=None
+
    #check for bad pixel mask
    if saltkey.found('BPMEXT', outhdu[i]) and mask:
        bpmext=saltkey.get('BPMEXT',outhdu[i])
-       bpm_list=[]
+       bpm_arr=getcube(cubes, 'bpm', nimages, dshape, outhdu[bpmext].data.dtype)
+   else:
+       bpm_arr=None
 
-   #create the lists of arrays and scale the arrays if requests
+   #fill the cubes and scale the arrays if requests
+   if scale and scales is None:
+       scales=[CalculateScale(hdu_list[j][i].data, scale, statsec) for j in range(nimages)]
    mean_scale=0
-   data_arr=np.zeros((nimages, dshape[0], dshape[1]), dtype=dtype)
+   data_arr=getcube(cubes, 'data', nimages, dshape, dtype)
    for j in range(nimages):
-       data_arr[j,:,:]=hdu_list[j][i].data[y1:y2,x1:x2]
+       data_arr[j]=hdu_list[j][i].data[y1:y2,x1:x2]
        #calculate the scale 
        if scale:
-          scale_val=CalculateScale(data_arr, scale, statsec)
+          scale_val=scales[j]
           mean_scale += scale_val
        else:
           scale_val=1
           mean_scale+=1
 
        if varext:
-           var_list.append(hdu_list[j][varext].data[y1:y2,x1:x2]/scale_val)
+           np.divide(hdu_list[j][varext].data[y1:y2,x1:x2], scale_val, out=var_arr[j])
        if bpmext:
-           bpm_list.append(hdu_list[j][bpmext].data[y1:y2,x1:x2])
+           bpm_arr[j]=hdu_list[j][bpmext].data[y1:y2,x1:x2]
 
        #get the gain and rdnoise
        if reject=='ccdclip':
@@ -240,25 +284,10 @@ def hducombine(hdu_list, outhdu, ext, method='average', datasec=None, reject=Non
                gain[j]=saltkey.get('GAIN', hdu_list[j][i])
            rdnoise[j]=saltkey.get('RDNOISE', hdu_list[j][i])
 
-   #convert the lists to arrays
-   if varext:
-       var_arr=np.array(var_list)
-       ivar_arr=1.0/var_arr
-   else:
-       var_arr=None
-       ivar_arr=None
-
-   if bpmext:
-       bpm_arr=np.array(bpm_list)
-   else:
-       bpm_arr=None
-   
-   #reject outliers if set
-   bpm_arr=RejectArray(data_arr, reject=reject, var=var_arr, bpm=bpm_arr, \
-                       lthresh=lthresh, hthresh=hthresh, gain=gain, rdnoise=rdnoise)
-
-   #calculate the average values
-   outdata, outwei=CombineArray(data_arr, method=method, ivar=ivar_arr, bpm=bpm_arr)
+   #reject outliers and combine the data and variance in a single pass
+   outdata, outvar, outwei, bpm_arr=FusedCombine(data_arr, method=method, reject=reject, var=var_arr, \
+                       bpm=bpm_arr, lthresh=lthresh, hthresh=hthresh, gain=gain, rdnoise=rdnoise, \
+                       niter=niter, nlow=nlow, nhigh=nhigh)
    outhdu[i].data[y1:y2,x1:x2]=outdata
    if scale is not None:
        mean_scale = mean_scale/nimages
@@ -266,10 +295,9 @@ def hducombine(hdu_list, outhdu, ext, method='average', datasec=None, reject=Non
 
    #create the combine variance frame
    if varext:
-       outhdu[varext].data[y1:y2,x1:x2], tmp_arr=CombineArray(var_arr, method=method, ivar=ivar_arr, bpm=bpm_arr)
-       del tmp_arr
+       outhdu[varext].data[y1:y2,x1:x2]=outvar
        if scale is not None:
-           outhdu[varext].data *= mean_scale
+           outhdu[varext].data[y1:y2,x1:x2] *= mean_scale
 
    #check to see if any of the pixels have no values and replace with blank
    #if wei_arr.any()==0:
@@ -279,7 +307,7 @@ def hducombine(hdu_list, outhdu, ext, method='average', datasec=None, reject=Non
 
    #create the combine BPM frames
    if bpmext:
-       outhdu[bpmext].data=1.0*(wei_arr==0)
+       outhdu[bpmext].data[y1:y2,x1:x2]=1.0*(wei_arr==0)
 
    return outhdu
   
@@ -300,9 +328,9 @@ def CalculateScale(arr, scale=None, statsec=None):
  
   if statsec is None:
      y1,y2,x1,x2=[0,len(arr),0,len(arr[0])]
-     data=arr[y1:y2,x1:x2]
   else:
-     data=arr
+     y1,y2,x1,x2=statsec
+  data=arr[y1:y2,x1:x2]
 
   if scale=='average':
        return np.mean(data)
@@ -314,7 +342,8 @@ def CalculateScale(arr, scale=None, statsec=None):
 
 
 
-def RejectArray(arr, reject=None, var=None, bpm=None, lthresh=3, hthresh=3, gain=1, rdnoise=5):
+def RejectArray(arr, reject=None, var=None, bpm=None, lthresh=3, hthresh=3, gain=1, rdnoise=5, \
+                niter=1, nlow=1, nhigh=1):
    """reject outliers in an array.  
       Input Variables:
          arr: Input data array
@@ -322,32 +351,27 @@ def RejectArray(arr, reject=None, var=None, bpm=None, lthresh=3, hthresh=3, gain
          reject:  Method for reject bad pixels
             ccdclip--use information about the gain and variance of the array to reject outliers
             sigclip--calculates the average and then rejects either high or low values
+            minmax--rejects the nlow lowest and nhigh highest values
         
+         niter: number of iterations for ccdclip and sigclip
+
       Returns:
-         bpm:  Data array with bad pixesl set to zero
+         bpm:  Data array with bad pixesl set to one
    """
    #return bpm if reject is None
    if reject is None: return bpm
 
-   #reject the pixels
-   if reject=='ccdclip':
-      #create mean array
-      mean_arr=arr.mean(axis=0)
-      #create variance array
-      if var is None:
-         var=arr.copy()
-         for i in range(len(var)):
-             var[i]=var[i]*gain[i]+rdnoise[i]**2
-      mask=np.ma.mask_or((arr-mean_arr<-lthresh*var),(arr-mean_arr>hthresh*var))
-      return 1*np.ma.mask_or((bpm==1),mask)
-   elif reject=='sigclip':
-      mean_arr=arr.mean(axis=0)
-      std_arr=arr.std(axis=0)
-      mask=np.ma.mask_or((arr-mean_arr<-lthresh*std_arr),(arr-mean_arr>hthresh*std_arr))
-      return 1*np.ma.mask_or((bpm==1),mask)
-   else:
-       msg='%s is currently not a supported rejection method' % reject
-       raise SaltError(msg)
+   checkreject(reject)
+   gain, rdnoise=ccdarrays(arr, gain, rdnoise)
+   if bpm is None: bpm=np.zeros(arr.shape, dtype=np.uint8)
+   for y1, y2 in rowblocks(arr.shape):
+      good=(bpm[:,y1:y2]==0)
+      v=None
+      if var is not None: v=var[:,y1:y2]
+      good=rejectblock(np.asarray(arr[:,y1:y2], dtype=float), good, reject, v, lthresh, hthresh, \
+                       gain, rdnoise, niter, nlow, nhigh)
+      bpm[:,y1:y2][~good]=1
+   return bpm
 
 def CombineArray(arr, method='average', ivar=None, bpm=None):
    """Combine--Combine an array of arrays.  The 
@@ -359,27 +383,170 @@ def CombineArray(arr, method='average', ivar=None, bpm=None):
     bpm:  bad pixel mask array
 
    """
-   if bpm is None:
-       bpm=arr*0.0+1.0
-       wei=None
-   else:
-       # correct the weights for the bad pixel mask
-       if ivar is None: ivar=arr*0.0+1.0
-       wei=ivar*(1-bpm)
-       #TODO: need to add a check to make sure that there are is a place
-       #to make sure that one of the weights is at least zero
-       check_wei=wei.sum(axis=0)
-       wei[0][check_wei==0]=wei.min()
-  
-   if method=='average':
-       c_arr, s_arr=np.average(arr, axis=0, weights=wei, returned=True)
-       return c_arr, s_arr
-   elif method=='median':
-       return np.median(arr, axis=0), bpm.sum(axis=0)
-   else: 
+   checkmethod(method)
+   c_arr=np.zeros(arr.shape[1:])
+   s_arr=np.zeros(arr.shape[1:])
+   for y1, y2 in rowblocks(arr.shape):
+      if bpm is None:
+         good=np.ones(arr[:,y1:y2].shape, dtype=bool)
+      else:
+         good=(bpm[:,y1:y2]==0)
+      w=None
+      if ivar is not None: w=ivar[:,y1:y2]
+      c_arr[y1:y2], s_arr[y1:y2]=combineblock(np.asarray(arr[:,y1:y2], dtype=float), good, method, w)
+   return c_arr, s_arr
+
+def FusedCombine(arr, method='average', reject=None, var=None, bpm=None, lthresh=3, hthresh=3, \
+                 gain=1, rdnoise=5, niter=1, nlow=1, nhigh=1, nchunk=2**20):
+   """Reject outliers and combine an array of arrays in a single pass.  
+
+      The arrays are processed in blocks of rows of about nchunk pixels so
+      the temporary arrays are the size of a block rather than the size of 
+      the full array of arrays.  The rejected pixels are set in bpm, which 
+      is updated in place.  If bpm is None, a uint8 mask is created, and it
+      is the only temporary array the size of arr.
+
+      arr: array of arrays to combine
+
+      method: type of combination--either average or median
+
+      reject: None, ccdclip, sigclip or minmax (see RejectArray)
+
+      var: variance array.  If given, the variance array is also combined.
+           If there is a bpm or reject is set, the data are weighted by the
+           inverse variance.  Otherwise, as in CombineArray without a bpm,
+           the arrays are averaged with equal weights
+
+      bpm: bad pixel mask array
+
+      niter: number of iterations for ccdclip and sigclip
+
+      nlow, nhigh: number of low and high values to reject for minmax
+
+      returns the combined data, combined variance, sum of the weights, bpm
+   """
+   checkmethod(method)
+   if reject is not None: checkreject(reject)
+   gain, rdnoise=ccdarrays(arr, gain, rdnoise)
+
+   #the inverse variance weights are only used if pixels can be masked
+   weighted=(var is not None and (bpm is not None or reject is not None))
+
+   c_arr=np.zeros(arr.shape[1:])
+   s_arr=np.zeros(arr.shape[1:])
+   v_arr=None
+   if var is not None: v_arr=np.zeros(arr.shape[1:])
+   if bpm is None: bpm=np.zeros(arr.shape, dtype=np.uint8)
+
+   for y1, y2 in rowblocks(arr.shape, nchunk):
+      data=np.asarray(arr[:,y1:y2], dtype=float)
+      good=(bpm[:,y1:y2]==0)
+      v=None
+      w=None
+      if var is not None: 
+         v=var[:,y1:y2]
+         if weighted: w=1.0/v
+
+      #reject the outliers
+      if reject is not None:
+         good=rejectblock(data, good, reject, v, lthresh, hthresh, gain, rdnoise, niter, nlow, nhigh)
+         bpm[:,y1:y2][~good]=1
+
+      #combine the data and the variance frames
+      c_arr[y1:y2], s_arr[y1:y2]=combineblock(data, good, method, w)
+      if var is not None:
+         v_arr[y1:y2], tmp=combineblock(v, good, method, w)
+
+   return c_arr, v_arr, s_arr, bpm
+
+def checkmethod(method):
+   """Check that method is a method for combining arrays"""
+   if method not in ['average', 'median']:
        msg='%s is not a method for combining arrays' % method
        raise SaltError(msg)
 
+def checkreject(reject):
+   """Check that reject is a supported rejection method"""
+   if reject not in ['ccdclip', 'sigclip', 'minmax']:
+       msg='%s is currently not a supported rejection method' % reject
+       raise SaltError(msg)
+
+def ccdarrays(arr, gain, rdnoise):
+   """Return the gain and read noise of each array as arrays that broadcast
+      against a block of arr
+   """
+   gain=np.resize(np.asarray(gain, dtype=float), len(arr)).reshape(-1,1,1)
+   rdnoise=np.resize(np.asarray(rdnoise, dtype=float), len(arr)).reshape(-1,1,1)
+   return gain, rdnoise
+
+def rowblocks(shape, nchunk=2**20):
+   """Return a list of (y1, y2) for blocks of rows in an array of arrays with
+      shape such that each block has about nchunk pixels
+   """
+   nrows=max(1, int(nchunk/max(1, shape[0]*np.prod(shape[2:]))))
+   return [(y1, min(y1+nrows, shape[1])) for y1 in range(0, shape[1], nrows)]
+
+def rejectblock(data, good, reject, var, lthresh, hthresh, gain, rdnoise, niter=1, nlow=1, nhigh=1):
+   """Reject the outliers in a block of an array of arrays.  
+
+      good: mask of the pixels which can be used.  The rejected pixels
+            are removed from it
+
+      returns good
+   """
+   if reject=='minmax':
+      #rank the good pixels from lowest to highest.  The bad pixels are
+      #sorted to the end
+      ngood=good.sum(axis=0)
+      rank=np.argsort(np.argsort(np.where(good, data, np.inf), axis=0), axis=0)
+      bad=(rank<nlow) | ((rank>=ngood-nhigh) & (rank<ngood))
+      good &= ~(bad & (ngood>nlow+nhigh))
+      return good
+
+   #the rejection threshold for ccdclip.  For sigclip it is updated with 
+   #the standard deviation on each iteration
+   if reject=='ccdclip':
+      if var is None:
+         sigma=data*gain+rdnoise**2
+      else:
+         sigma=var
+
+   for k in range(max(1, niter)):
+      ngood=np.maximum(good.sum(axis=0), 1)
+      mean=np.where(good, data, 0).sum(axis=0)/ngood
+      resid=data-mean
+      if reject=='sigclip':
+         sigma=np.sqrt((np.where(good, resid, 0)**2).sum(axis=0)/ngood)
+      bad=good & ((resid<-lthresh*sigma) | (resid>hthresh*sigma))
+      if not bad.any(): break
+      good &= ~bad
+   return good
+
+def combineblock(data, good, method='average', wei=None):
+   """Combine a block of an array of arrays using only the good pixels.  If
+      none of the pixels are good, all of them are used.
+
+      wei: weights for the average
+
+      returns the combined block and the sum of the weights
+   """
+   #use all of the pixels if none are good
+   ngood=good.sum(axis=0)
+   good=good | (ngood==0)
+
+   if method=='average':
+      if wei is None:
+         wei=1.0*good
+      else:
+         wei=wei*good
+      wsum=wei.sum(axis=0)
+      return (data*wei).sum(axis=0)/wsum, wsum
+   elif method=='median':
+      if good.all(): 
+         return np.median(data, axis=0), 1.0*ngood
+      return np.nanmedian(np.where(good, data, np.nan), axis=0), 1.0*ngood
+
+
 # -----------------------------------------------------------
 # main code 
 if not iraf.deftask('saltcombine'):
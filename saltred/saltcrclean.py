@@ -56,7 +56,7 @@ Updates
 from __future__ import with_statement
 
 
-import os, time
+import os, time, tempfile, atexit
 import numpy as np
 
 try:
@@ -119,7 +119,7 @@ def saltcrclean(images,outimages,outpref,crtype='fast',thresh=5,mbox=3,
            #clean the cosmic rays
            if multithread and len(struct)>1:
                struct=multicrclean(struct, crtype, thresh, mbox, bbox, bthresh, flux_ratio, \
-                          gain, rdnoise, bfactor, fthresh, gbox, maxiter, log, verbose=verbose)
+                          gain, rdnoise, bfactor, fthresh, gbox, maxiter, update, log, verbose=verbose)
            else:
                struct=crclean(struct, crtype, thresh, mbox, bbox, bthresh, flux_ratio, \
                           gain, rdnoise, bfactor, fthresh, gbox, maxiter, update, log, verbose=verbose)
@@ -142,12 +142,20 @@ def saltcrclean(images,outimages,outpref,crtype='fast',thresh=5,mbox=3,
            saltio.closefits(struct)
 
 def multicrclean(struct, crtype='fast', thresh=5, mbox=5, bbox=11, bthresh=3, flux_ratio=0.2, \
-              gain=1, rdnoise=5, bfactor=2, fthresh=5, gbox=0, maxiter=1, update=True, log=None, verbose=True):
+              gain=1, rdnoise=5, bfactor=2, fthresh=5, gbox=0, maxiter=1, update=True, log=None, verbose=True,
+              nproc=None, tsize=512):
    """MULTICRCLEAN cleans SALT-like data of cosmic rays.  The user has 
       three different choices for the type of cosmic ray cleaning being
       fast, median, and edge.   The process is set up to use multithreading for 
       quick processing of the data.  
 
+      Each SCI extension is split into strips of tsize rows with a halo of
+      rows on either side large enough for the cleaning boxes.  The strips 
+      are cleaned by a worker pool that is kept between calls (see getpool) 
+      and the data are passed to the workers through memory mapped files 
+      rather than by pickling the arrays.  The extensions are cleaned one 
+      at a time so only the files for one extension exist at once.
+
            crytpe--type of cosmic ray cleaning. Either fast, median, or 
            thresh--threshold for detecting cosmic rays
            mbox--box for median cleaning
@@ -160,6 +168,8 @@ def multicrclean(struct, crtype='fast', thresh=5, mbox=5, bbox=11, bthresh=3, fl
            fthresh--threshold for excluding compact sources (edge only)
            gbox--Window size to grow sources.  gbox=0 for no growth of cosmic rays
            maxiter--maximum number of iterations
+           nproc--number of worker processes.  None uses all of the cpus
+           tsize--number of rows in each strip
 
            return struct
    """
@@ -179,49 +189,151 @@ def multicrclean(struct, crtype='fast', thresh=5, mbox=5, bbox=11, bthresh=3, fl
        log.message('      ---------------------------------------------------', \
             with_header=False, with_stdout=verbose)
 
-   
-   task_list=[]
-   nproc=0
-   for hdu in struct:
-       if hdu.name=='SCI':
-           task_list.append((hdu.data, crtype, thresh, mbox, bbox, bthresh, flux_ratio, gain, rdnoise, bfactor , fthresh, gbox, maxiter))
-           nproc+=1
+   #set up the halo around each strip.  For the median method the strips
+   #are aligned with the background boxes
+   halo=max(mbox, bbox, gbox, 11)+max(1, maxiter)*max(mbox, 3)
+   if crtype=='median':
+       step=max(bbox, 10)
+       halo=step*int(np.ceil(1.0*halo/step))
+       tsize=step*int(np.ceil(1.0*tsize/step))
 
    #set up the multi-thread
-   p=mp.Pool()
+   p=getpool(nproc)
 
+   #clean each extension in turn, so only the memory mapped files of one
+   #extension exist at a time
+   for i, hdu in enumerate(struct):
+       if hdu.name!='SCI': continue
+
+       #for the edge method, get the gain and rdnoise from the fits header
+       #if they are not set
+       hgain=gain
+       hrdnoise=rdnoise
+       if crtype=='edge':
+           if gain==None: hgain=saltkey.get('GAIN',hdu)
+           if rdnoise==None: hrdnoise=saltkey.get('RDNOISE',hdu)
+
+       #the statistics for the fast method are for the whole extension
+       arr=np.asarray(hdu.data, dtype=float)
+       stats=None
+       if crtype=='fast':
+           stats=saltstat.iterstat(arr, bthresh, maxiter)
+
+       #hand out the strips of the extension
+       mapnames=[]
+       try:
+           sciname=mapfile(arr)
+           mapnames.append(sciname)
+           crname=mapfile(np.zeros(arr.shape))
+           mapnames.append(crname)
+           args=(crtype, thresh, mbox, bbox, bthresh, flux_ratio, hgain, hrdnoise, bfactor , fthresh, gbox, maxiter)
+           results=[]
+           for y1, y2, h1, h2 in striprows(arr.shape[0], tsize, halo):
+               results.append(p.apply_async(cleanstrip, (sciname, crname, arr.shape, y1, y2, h1, h2, stats, args)))
+           for r in results: r.get()
 
-   results=[p.apply_async(cleancosmicrays, i) for i in task_list]
-   p.close()
+           #set up the cosmic ray array
+           crarr=np.array(np.memmap(crname, dtype=float, mode='r', shape=arr.shape))
+       finally:
+           for f in mapnames:
+               if os.path.isfile(f): os.remove(f)
 
+       #update the frame for the various values
+       mask=(crarr>0)
+       if update: struct[i].data[mask]=crarr[mask]
+
+       #track the number of cosmic rays
+       ncr=mask.sum()
+       totcr += ncr
+
+       #if verbose print out information
+       if log:
+           message='%25s[%1d]  %i' % (infile, i, ncr)
+           log.message(message, with_header=False, with_stdout=verbose)
+
+       #correct the BPM frame
+       if saltkey.found('BPMEXT', struct[i]):
+            b_i=saltkey.get('BPMEXT', struct[i])
+            try:
+               struct[b_i].data[mask]=1
+            except Exception, e:
+               msg='Cannot update the BPM frame in %s[%i] because %s' % (infile, b_i, e)
+               raise SaltError(msg)
 
-   for i, hdu in enumerate(struct):
-       if hdu.name=='SCI':
-           #set up the cosmic ray array
-           crarr=results[i-1].get()
+   return struct
 
-           #update the frame for the various values
-           mask=(crarr>0)
-           if update: struct[i].data[mask]=crarr[mask]
+#-----------------------------------------------------------
+# persistent worker pool for multicrclean
 
-           #track the number of cosmic rays
-           ncr=mask.sum()
-           totcr += ncr
-           
-           #if verbose print out information
-           if log:
-               message='%25s[%1d]  %i' % (infile, i, ncr)
-               log.message(message, with_header=False, with_stdout=verbose)
+_pool=None
+_nproc=None
 
-           #correct the BPM frame
-           if saltkey.found('BPMEXT', struct[i]):
-                b_i=saltkey.get('BPMEXT', struct[i])
-                try:
-                   struct[b_i].data[mask]=1
-                except Exception, e:
-                   msg='Cannot update the BPM frame in %s[%i] because %s' % (infile, b_i, e)
-                   raise SaltError(msg)
-   return struct
+def getpool(nproc=None):
+   """Return the worker pool used by multicrclean.  The pool is started on the
+      first call and then reused by later calls so that processing many files
+      does not start a new set of processes for each file.  A new pool is only
+      started if a different number of processes is requested.
+   """
+   global _pool, _nproc
+   if nproc is None: nproc=mp.cpu_count()
+   if _pool is not None and nproc==_nproc: return _pool
+   closepool()
+   _pool=mp.Pool(nproc)
+   _nproc=nproc
+   return _pool
+
+def closepool():
+   """Shut down the worker pool used by multicrclean"""
+   global _pool, _nproc
+   if _pool is not None:
+       _pool.close()
+       _pool.join()
+   _pool=None
+   _nproc=None
+
+atexit.register(closepool)
+
+def mapfile(arr):
+   """Write arr to a memory mapped file that can be shared with the worker
+      processes and return the name of the file.  The file is placed in
+      shared memory if it is available and has room for it and one more
+      array of the same size, otherwise in the default temporary directory.
+   """
+   path=None
+   if os.path.isdir('/dev/shm'):
+       st=os.statvfs('/dev/shm')
+       if st.f_bavail*st.f_frsize > 2*arr.size*np.dtype(float).itemsize: path='/dev/shm'
+   fd, fname=tempfile.mkstemp(prefix='saltcr', suffix='.dat', dir=path)
+   os.close(fd)
+   marr=np.memmap(fname, dtype=float, mode='w+', shape=arr.shape)
+   marr[:]=arr
+   marr.flush()
+   del marr
+   return fname
+
+def striprows(ylen, tsize, halo):
+   """Split ylen rows into strips of tsize rows.  Returns a list of 
+      (y1, y2, h1, h2) where y1:y2 are the rows of the strip and h1:h2 the rows
+      including the halo
+   """
+   strips=[]
+   for y1 in range(0, ylen, tsize):
+       y2=min(y1+tsize, ylen)
+       strips.append((y1, y2, max(0, y1-halo), min(ylen, y2+halo)))
+   return strips
+
+def cleanstrip(sciname, crname, shape, y1, y2, h1, h2, stats, args):
+   """Clean the rows h1:h2 of the memory mapped array in sciname and write the
+      cosmic rays for rows y1:y2 to the memory mapped array in crname
+   """
+   arr=np.memmap(sciname, dtype=float, mode='r', shape=shape)
+   crarr=cleancosmicrays(np.array(arr[h1:h2]), *args, stats=stats)
+   del arr
+
+   out=np.memmap(crname, dtype=float, mode='r+', shape=shape)
+   out[y1:y2]=crarr[y1-h1:y2-h1]
+   out.flush()
+   del out
 
 def crclean(struct, crtype='fast', thresh=5, mbox=5, bbox=11, bthresh=3, flux_ratio=0.2, \
               gain=1, rdnoise=5, bfactor=2, fthresh=5, gbox=0, maxiter=1, update=True, log=None, verbose=True):
@@ -303,8 +415,11 @@ def crclean(struct, crtype='fast', thresh=5, mbox=5, bbox=11, bthresh=3, flux_ra
 # Clean cosmic rays
 
 def cleancosmicrays(arr, crtype='fast', thresh=5, mbox=3, bbox=5, bthresh=5, flux_ratio=0.2, gain=1, \
-                    rdnoise=5, b_factor=2, fthresh=3, gbin=0, max_iter=1):
+                    rdnoise=5, b_factor=2, fthresh=3, gbin=0, max_iter=1, stats=None):
    """Clean the cosmic rays from an input array using three different types of methods
+
+      stats--(mean, median, std) of the array for the fast method.  If None,
+             they are measured from arr
    """
    niter=0
    npix=1
@@ -320,7 +435,8 @@ def cleancosmicrays(arr, crtype='fast', thresh=5, mbox=3, bbox=5, bthresh=5, flu
    #measure the mean values for the image--leaving this outside 
    #because it doesn't need to be done on each iter loop
    if crtype=='fast':
-       mean, midpt, bsigma=saltstat.iterstat(arr, bthresh, max_iter)
+       if stats is None: stats=saltstat.iterstat(arr, bthresh, max_iter)
+       mean, midpt, bsigma=stats
 
    #set up the array
    crarr=arr*0.0
@@ -386,9 +502,15 @@ def idcray(arr, flux_ratio, y, x, ylen, xlen, mbox):
 #-----------------------------------------------------------
 # Fast clean of the cosmic rays
 
-def crfast(arr, mean, bsigma, thresh, mbox, flux_ratio):
+def crfast(arr, mean, bsigma, thresh, mbox, flux_ratio, nchunk=65536):
     """Provide fast cosmic ray rejection based on identifying isolated peaks 
 
+       All of the candidate pixels are tested together rather than one at a 
+       time with idcray.  Candidates are grouped by the shape of their box
+       (which is only different near the edges of the frame, see setbox) and 
+       the boxes in each group are gathered into an (n, npix) array in blocks
+       of nchunk candidates so the peak test and the median are computed in
+       a single call for each block.
 
        crarr--array with zero for non-cosmic rays and positive value 
               equal to the median of the surrounding pixels if a cosmic ray
@@ -409,14 +531,42 @@ def crfast(arr, mean, bsigma, thresh, mbox, flux_ratio):
  
     #Detect all possible objects on the image
     rarr=arr-mean
-    darr= np.where(rarr>bsigma*thresh)
-          
-    #Out of those detections, eliminate those that aren't cosmic rays
-    for i in range(len(darr[0])):
-        y=darr[0][i]
-        x=darr[1][i]
-        y, x, mpix=idcray(rarr, flux_ratio, y, x, ylen, xlen, mbox)
-        if mpix is not None: crarr[y,x]=mpix+mean
+    yc, xc= np.where(rarr>bsigma*thresh)
+    if len(yc)==0: return crarr
+
+    #set up the edges of the box around each candidate
+    y1=np.maximum(0, yc-mbox)-yc
+    y2=np.minimum(yc+mbox+1, ylen-1)-yc
+    x1=np.maximum(0, xc-mbox)-xc
+    x2=np.minimum(xc+mbox+1, xlen-1)-xc
+
+    #group the candidates with the same box
+    box=((y1+mbox)*(2*mbox+2)+(y2+mbox))*(2*mbox+2)**2+(x1+mbox)*(2*mbox+2)+(x2+mbox)
+    for b in np.unique(box):
+        gid=np.where(box==b)[0]
+        g=gid[0]
+        dy, dx=np.mgrid[y1[g]:y2[g], x1[g]:x2[g]]
+        dy=dy.ravel()
+        dx=dx.ravel()
+
+        for i in range(0, len(gid), nchunk):
+            y=yc[gid[i:i+nchunk]]
+            x=xc[gid[i:i+nchunk]]
+            pix=rarr[y,x]
+            barr=rarr[y[:,None]+dy, x[:,None]+dx]
+
+            #is the source the brightest in the box
+            mask=~(pix < barr.max(axis=1))
+            y=y[mask]
+            x=x[mask]
+            pix=pix[mask]
+            if len(y)==0: continue
+
+            #If the pixel to median flux  is less than
+            # the flux ratio, reject the objects as a comsic ray
+            median_pix=np.median(barr[mask], axis=1)
+            mask=~(abs(median_pix)/pix > flux_ratio)
+            crarr[y[mask],x[mask]]=median_pix[mask]+mean
 
     return crarr
 
@@ -455,10 +605,20 @@ def crmedian(arr, thresh, mbox, bbox):
     barr=arr*0.0+arr.std()
     xlen=len(arr[0])
     ylen=len(arr)
+    xcov=np.zeros(xlen, dtype=bool)
+    ycov=np.zeros(ylen, dtype=bool)
     for i in range(mbox,xlen,bbox):
      for j in range(mbox,ylen,bbox):
          x1,x2,y1,y2=setbox(i,j,cbox, xlen, ylen)
          barr[y1:y2,x1:x2]=sigma_func(arr[y1:y2,x1:x2])
+         xcov[x1:x2]=True
+         ycov[y1:y2]=True
+
+    #the rows and columns that are not covered by a background box take
+    #the value of the nearest box, so that they only depend on the pixels
+    #around them and not on the whole array
+    if xcov.any() and ycov.any():
+        barr=barr[nearestindex(ycov)][:,nearestindex(xcov)]
 
     #Median smooth the image
     marr=saltstat.median_image(arr, mbox)
@@ -471,6 +631,17 @@ def crmedian(arr, thresh, mbox, bbox):
 
     return crarr
 
+def nearestindex(covered):
+    """For each element of the boolean array covered, return the index of
+       the nearest element that is True
+    """
+    cidx=np.where(covered)[0]
+    idx=np.arange(len(covered))
+    k=np.searchsorted(cidx, idx)
+    lower=cidx[np.maximum(k-1, 0)]
+    upper=cidx[np.minimum(k, len(cidx)-1)]
+    return np.where(abs(idx-lower) <= abs(upper-idx), lower, upper)
+
 #-----------------------------------------------------------
 # Edge clean the cosmic rays
 
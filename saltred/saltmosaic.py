@@ -22,14 +22,19 @@ Updates
 """
 
 import os
+import glob
+import tempfile
 import time
+import hashlib
 import numpy
 from scipy import ndimage as nd
 from astropy.io import fits
-from pyraf import iraf
+try:
+    from pyraf import iraf
+except ImportError:
+    iraf = None
 
 from math import cos, sin, pi
-from scipy.ndimage import geometric_transform
 
 import saltsafekey as saltkey
 import saltsafeio as saltio
@@ -45,12 +50,15 @@ debug = True
 # core routine
 
 def saltmosaic(images, outimages, outpref, geomfile, interp='linear',
-               geotran=True, fill=False, cleanup=True, clobber=False,
-               logfile=None, verbose=True):
+               geotran=True, fill=False, cachedir='', cleanup=True,
+               clobber=False, logfile=None, verbose=True):
 
     # Start the logging
     with logging(logfile, debug) as log:
 
+        # set the directory where the mosaic plans are kept
+        set_cachedir(cachedir)
+
         # Check the input images
         infiles = saltio.argunpack('Input', images)
 
@@ -68,7 +76,7 @@ def saltmosaic(images, outimages, outpref, geomfile, interp='linear',
         xshift = [0, 0]
         yshift = [0, 0]
         rotation = [0, 0]
-        gap, xshift, yshift, rotation = saltio.readccdgeom(geomfile)
+        gap, xshift, yshift, rotation = read_geometry(geomfile)
 
         # open each raw image file and apply the transformation to it
         for img, oimg in zip(infiles, outfiles):
@@ -109,11 +117,38 @@ def saltmosaic(images, outimages, outpref, geomfile, interp='linear',
             ostruct.close()
 
 
+# CCD geometry read from each geometry file.  It is keyed by the name,
+# size and modification time of the file so repeated mosaics reuse it
+geometry_cache = {}
+
+
+def read_geometry(geomfile):
+    """Read the CCD geometry from geomfile, or return the geometry from
+       the previous read if the file has not changed
+
+       Returns
+       -------
+       gap, xshift, yshift, rotation
+    """
+    st = os.stat(geomfile)
+    key = (os.path.abspath(geomfile), st.st_size, st.st_mtime)
+    if key not in geometry_cache:
+        geometry_cache[key] = saltio.readccdgeom(geomfile)
+    gap, xshift, yshift, rotation = geometry_cache[key]
+    return gap, list(xshift), list(yshift), list(rotation)
+
+
 def make_mosaic(struct, gap, xshift, yshift, rotation, interp_type='linear',
                 boundary='constant', constant=0, geotran=True, fill=False,
                 cleanup=True, log=None, verbose=False):
     """Given a SALT image struct, combine each of the individual amplifiers and
         apply the geometric CCD transformations to the image
+
+        If geotran is True, the transformations are applied by the IRAF
+        geotran task through temporary files.  Otherwise, they are applied
+        in memory and no temporary files are written.  The coordinates of
+        the in memory transformations are kept in plan_cache so frames
+        with the same setup only need to be interpolated.
     """
 
     # get the name of the file
@@ -204,7 +239,10 @@ def make_mosaic(struct, gap, xshift, yshift, rotation, interp_type='linear',
         if x1 != 0:
             msg = 'The data in %s have not been trimmed prior to mosaicking.' \
                   % infile
-            log.error(msg)
+            if log:
+                log.error(msg)
+            else:
+                raise SaltError(msg)
         if xsh[i + 1] < 0:
             x1 += int(abs(xsh[i + 1] / xbin))
         x2 = x1 + xdsec1[1]
@@ -277,9 +315,31 @@ def make_mosaic(struct, gap, xshift, yshift, rotation, interp_type='linear',
             message += str(ydsec2[0]) + ':' + str(ydsec2[1]) + ']'
             log.message(message, with_stdout=verbose, with_header=False)
 
-    # write temporary file of tiled CCDs
-    hdulist = fits.HDUList(tilehdu)
-    hdulist.writeto(tilefile)
+    # the sinc interpolant is only available with geotran
+    if not geotran and interp_type not in INTERP_ORDERS:
+        if log:
+            log.message('%s interpolation is only available with geotran, '
+                        'so geotran is used for %s' % (interp_type, infile),
+                        with_stdout=verbose)
+        geotran = True
+
+    # write temporary file of tiled CCDs for geotran
+    if geotran:
+        if iraf is None:
+            raise SaltError('IRAF is not available to run geotran. ' +
+                            'Set geotran=False to transform the data in memory')
+        hdulist = fits.HDUList(tilehdu)
+        hdulist.writeto(tilefile)
+    else:
+        # get the precomputed transformations for this setup
+        order = interp_order(interp_type)
+        key = plan_key(instrume, saltkey.get('CCDSUM', struct[0]),
+                       [tilehdu[c].data.shape for c in range(1, nccds + 1)],
+                       gap, xshift, yshift, rotation, order)
+        plan = plan_cache.get(key)
+        newplan = plan is None
+        if newplan:
+            plan = MosaicPlan(key, order)
 
     # iterate over CCDs, transform and rotate images
     yrot = [None] * 4
@@ -331,7 +391,8 @@ def make_mosaic(struct, gap, xshift, yshift, rotation, interp_type='linear',
                 message += 'fluxconserve=\'yes\' nxblock=2048 '
                 message += 'nyblock=2048 interpolant=\'' + \
                     interp_type + '\' boundary=\'constant\' constant=0'
-                log.message(message, with_stdout=verbose)
+                if log:
+                    log.message(message, with_stdout=verbose)
 
                 yd, xd = tilehdu[ccd].data.shape
                 ncols = 'INDEF'  # ncols=xd+abs(xsh[ccd]/xbin)
@@ -412,59 +473,37 @@ def make_mosaic(struct, gap, xshift, yshift, rotation, interp_type='linear',
                             nccds])[0].data
 
             else:
-                log.message(
-                    "Transform CCD #%i using dx=%s, dy=%s, rot=%s" %
-                    (ccd,
-                     xsh[ccd] /
-                        2.0,
-                        ysh[ccd] /
-                        2.0,
-                        xrot[ccd]),
-                    with_stdout=verbose,
-                    with_header=False)
-                tranhdu[hdu] = geometric_transform(
-                    tilehdu[ccd].data,
-                    tran_func,
-                    prefilter=False,
-                    order=1,
-                    extra_arguments=(
-                        xsh[ccd] / 2,
-                        ysh[ccd] / 2,
-                        1,
-                        1,
-                        xrot[ccd],
-                        yrot[ccd]))
-                tstruct = fits.PrimaryHDU(tranhdu[hdu])
-                tstruct.writeto(tranfile[hdu])
+                geo_xshift = xsh[ccd] + (2 - ccd) * dxshift / xbin
+                geo_yshift = ysh[ccd] / ybin
+                if log:
+                    log.message(
+                        "Transform CCD #%i using dx=%s, dy=%s, rot=%s" %
+                        (ccd, geo_xshift, geo_yshift, xrot[ccd]),
+                        with_stdout=verbose, with_header=False)
+                if ccd not in plan.coords:
+                    plan.add(ccd, tilehdu[ccd].data.shape, geo_xshift,
+                             geo_yshift, xrot[ccd], yrot[ccd])
+                tranhdu[hdu] = plan.transform(ccd, tilehdu[ccd].data)
                 if varframe:
-                    tranhdu[hdu + nccds] = geometric_transform(
-                        tilehdu[hdu + 3].data,
-                        tran_func,
-                        prefilter=False,
-                        order=1,
-                        extra_arguments=(
-                            xsh[ccd] / 2, ysh[ccd] / 2,
-                            1, 1,
-                            xrot[ccd], yrot[ccd]))
-                    tranhdu[hdu + 2 * nccds] = geometric_transform(
-                        tilehdu[hdu + 6].data,
-                        tran_func,
-                        prefilter=False,
-                        order=1,
-                        extra_arguments=(
-                            xsh[ccd] / 2, ysh[ccd] / 2,
-                            1, 1,
-                            xrot[ccd], yrot[ccd]))
+                    tranhdu[hdu + nccds] = plan.transform(
+                        ccd, tilehdu[ccd + nccds].data)
+                    tranhdu[hdu + 2 * nccds] = plan.transform(
+                        ccd, tilehdu[ccd + 2 * nccds].data)
 
         else:
-            log.message(
-                "Transform CCD #%i using dx=%s, dy=%s, rot=%s" %
-                (ccd, 0, 0, 0), with_stdout=verbose, with_header=False)
+            if log:
+                log.message(
+                    "Transform CCD #%i using dx=%s, dy=%s, rot=%s" %
+                    (ccd, 0, 0, 0), with_stdout=verbose, with_header=False)
             tranhdu[hdu] = tilehdu[ccd].data
             if varframe:
                 tranhdu[hdu + nccds] = tilehdu[ccd + nccds].data
                 tranhdu[hdu + 2 * nccds] = tilehdu[ccd + 2 * nccds].data
 
+    # keep the transformations for the next frame with the same setup
+    if not geotran and newplan:
+        plan_cache.put(plan)
+
     # open outfile
     if varframe:
         outlist = 4 * [None]
@@ -588,6 +627,11 @@ def make_mosaic(struct, gap, xshift, yshift, rotation, interp_type='linear',
 def fill_gaps(data, mask):
     """Interpolate in the gaps in the data
 
+       Each row is linearly interpolated across the masked pixels using the
+       nearest good pixel on either side, as numpy.interp would do row by
+       row.  Pixels next to a masked pixel are also replaced.  Rows without
+       any good pixels are not changed.
+
        Parameters
        ----------
        data: np.ndarray
@@ -602,28 +646,314 @@ def fill_gaps(data, mask):
     ys, xs = data.shape
     if isinstance(mask, numpy.ndarray):
         mask = (mask == 0)
-        for i in range(ys):
-            x = numpy.arange(xs)
-            rdata = data[i, :]
-            rmask = mask[i, :]
-            rmask = nd.minimum_filter(rmask, size=3)
-            if rmask.any() == True:
-                rdata = numpy.interp(x, x[rmask], rdata[rmask])
-                data[i, rmask == 0] = rdata[rmask == 0]
     else:
         mask = (data != mask)
-        for i in range(ys):
-            x = numpy.arange(xs)
-            rdata = data[i, :]
-            rmask = mask[i, :]
-            rmask = nd.minimum_filter(rmask, size=3)
-            if rmask.any() == True:
-                rdata = numpy.interp(x, x[rmask], rdata[rmask])
-                data[i, rmask == 0] = rdata[rmask == 0]
-
+    mask = nd.minimum_filter(mask, size=(1, 3))
+
+    # find the runs of masked pixels in each row.  Rows without any good
+    # pixels are not filled.  The rows are padded on either side so that 
+    # a run never continues onto the next row
+    bad = numpy.zeros((ys, xs + 2), dtype=numpy.int8)
+    bad[:, 1:-1] = ~mask
+    bad[mask.any(axis=1) == 0] = 0
+    edges = numpy.diff(bad.ravel())
+    start = numpy.flatnonzero(edges == 1) + 1
+    end = numpy.flatnonzero(edges == -1) + 1
+    if len(start) == 0:
+        return data
+
+    # the good pixels on either side of each run.  Runs at the start or end
+    # of a row take the value of the nearest good pixel
+    row = start // (xs + 2)
+    left = start % (xs + 2) - 2
+    right = end % (xs + 2) - 1
+    left = numpy.where(left < 0, right, left)
+    right = numpy.where(right >= xs, left, right)
+    fl = data[row, left].astype(float)
+    fr = data[row, right].astype(float)
+
+    # interpolate across each run
+    nrun = end - start
+    run = numpy.repeat(numpy.arange(len(start)), nrun)
+    x = numpy.arange(nrun.sum()) - numpy.repeat(numpy.cumsum(nrun) - nrun, nrun)
+    x = x + numpy.repeat(start % (xs + 2) - 1, nrun)
+    dx = numpy.maximum(right - left, 1)
+    fill = fl[run] + (fr - fl)[run] / dx[run] * (x - left[run])
+    fill = numpy.where((right == left)[run], fl[run], fill)
+    data[row[run], x] = fill
     return data
 
 
+# spline orders of the geotran interpolants that can be done in memory
+INTERP_ORDERS = {'nearest': 0, 'linear': 1, 'poly3': 3, 'spline3': 3,
+                 'poly5': 5}
+
+
+def interp_order(interp_type):
+    """Return the spline order used by scipy.ndimage for one of the
+       geotran interpolants
+    """
+    try:
+        return INTERP_ORDERS[interp_type]
+    except KeyError:
+        raise SaltError('%s interpolation is only available with geotran' %
+                        interp_type)
+
+
+def transform_matrix(shape, xshift, yshift, xrot, yrot, xmag=1, ymag=1):
+    """Return the matrix and offset that map the output pixel coordinates
+       onto the input pixel coordinates of an image of the given shape
+
+       This is the linear transformation of geotran without a database:
+       the center of the input image is moved by xshift, yshift in the
+       output image and the x and y axes are rotated and magnified about
+       it, so that relative to the center
+
+          xin = xmag * cos(xrot) * xout - ymag * sin(yrot) * yout
+          yin = xmag * sin(xrot) * xout + ymag * cos(yrot) * yout
+
+       The matrix and offset are in the (y, x) order of numpy arrays.
+    """
+    matrix = numpy.array([[ymag * cos(yrot * pi / 180.0),
+                           xmag * sin(xrot * pi / 180.0)],
+                          [-ymag * sin(yrot * pi / 180.0),
+                           xmag * cos(xrot * pi / 180.0)]])
+    center = 0.5 * (numpy.array(shape) - 1)
+    offset = center - numpy.dot(matrix, center + numpy.array([yshift, xshift]))
+    return matrix, offset
+
+
+def transform_image(data, xshift, yshift, xrot, yrot, xmag=1, ymag=1,
+                    order=1, constant=0, fluxconserve=True):
+    """Apply the shift, rotation and magnification of geotran to an image
+       in memory
+
+       The transformation is the one of transform_matrix, which is applied
+       about the center of the image as geotran does by default, and the
+       flux is scaled by the determinant of the transformation as geotran
+       does with fluxconserve=yes.
+
+       Parameters
+       ----------
+       data: np.ndarray
+          image to be transformed
+
+       xshift, yshift: float
+          shift in pixels of the image in x and y
+
+       xrot, yrot: float
+          rotation in degrees of the x and y axes
+
+       xmag, ymag: float
+          magnification in x and y
+
+       order: int
+          order of the spline interpolation
+
+       constant: float
+          value for pixels outside of the input image
+
+       fluxconserve: bool
+          conserve the flux in the image
+
+       Returns
+       -------
+       tdata: np.ndarray
+          transformed image
+    """
+    matrix, offset = transform_matrix(data.shape, xshift, yshift, xrot, yrot,
+                                      xmag, ymag)
+    tdata = nd.affine_transform(data, matrix, offset=offset, order=order,
+                                mode='constant', cval=constant,
+                                prefilter=(order > 1))
+    if fluxconserve:
+        tdata *= abs(numpy.linalg.det(matrix))
+    return tdata
+
+
+class MosaicPlan:
+
+    """MosaicPlan holds the precomputed transformations of the CCD images
+    for one instrument setup.  For each CCD that is transformed, it stores
+    the input pixel coordinates of every output pixel and the flux scaling
+    so that transforming a frame is a single interpolation of each plane
+    at the stored coordinates.  Plans are identified by a key from
+    plan_key and are kept in a PlanCache.
+    """
+
+    def __init__(self, key, order=1):
+        self.key = key
+        self.order = order
+        self.coords = {}
+        self.flux = {}
+
+    def add(self, ccd, shape, xshift, yshift, xrot, yrot, xmag=1, ymag=1):
+        """Compute the coordinates for a CCD image of the given shape"""
+        matrix, offset = transform_matrix(shape, xshift, yshift, xrot, yrot,
+                                          xmag, ymag)
+        y = numpy.arange(shape[0], dtype=float)[:, None]
+        x = numpy.arange(shape[1], dtype=float)[None, :]
+        coords = numpy.empty((2,) + tuple(shape))
+        coords[0] = matrix[0, 0] * y + matrix[0, 1] * x + offset[0]
+        coords[1] = matrix[1, 0] * y + matrix[1, 1] * x + offset[1]
+        self.coords[ccd] = coords
+        self.flux[ccd] = abs(numpy.linalg.det(matrix))
+
+    def transform(self, ccd, data, constant=0):
+        """Transform the image of a CCD"""
+        tdata = nd.map_coordinates(data, self.coords[ccd], order=self.order,
+                                   mode='constant', cval=constant,
+                                   prefilter=(self.order > 1),
+                                   output=data.dtype)
+        tdata *= self.flux[ccd]
+        return tdata
+
+    def save(self, filename):
+        """Write the plan to a numpy .npz file.  The plan is written to a
+           temporary file in the same directory, which is then renamed, so
+           other processes never read a partly written plan.
+        """
+        arrays = {'key': numpy.array(self.key), 
+                  'order': numpy.array(self.order)}
+        for ccd in self.coords:
+            arrays['coords%i' % ccd] = self.coords[ccd]
+            arrays['flux%i' % ccd] = numpy.array(self.flux[ccd])
+        fd, tmpname = tempfile.mkstemp(suffix='.tmp', 
+                                       dir=os.path.dirname(filename) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                numpy.savez(fout, **arrays)
+            os.rename(tmpname, filename)
+        except:
+            if os.path.isfile(tmpname):
+                os.remove(tmpname)
+            raise
+
+
+def read_plan(filename):
+    """Read a MosaicPlan written by MosaicPlan.save"""
+    arrays = numpy.load(filename)
+    plan = MosaicPlan(str(arrays['key']), int(arrays['order']))
+    for name in arrays.files:
+        if name.startswith('coords'):
+            ccd = int(name[6:])
+            plan.coords[ccd] = arrays[name].astype(float)
+            plan.flux[ccd] = float(arrays['flux%i' % ccd])
+    arrays.close()
+    return plan
+
+
+def plan_key(instrume, ccdsum, shapes, gap, xshift, yshift, rotation,
+             order):
+    """Return the key of the MosaicPlan for an instrument, binning, the
+       shapes of the tiled CCD images, the CCD geometry and the order of
+       the interpolation
+    """
+    setup = (instrume.strip(), ccdsum.strip(), tuple(shapes), gap,
+             tuple(xshift), tuple(yshift), tuple(rotation), order)
+    return hashlib.md5(repr(setup)).hexdigest()
+
+
+class PlanCache:
+
+    """PlanCache is a least recently used cache of MosaicPlans.  Up to
+    maxsize plans are kept in memory.  If cachedir is set, plans are also
+    written to that directory so they can be used by later sessions, and
+    only the maxdisk most recently used plans are kept there.
+    """
+
+    def __init__(self, maxsize=4, cachedir=None, maxdisk=20):
+        self.maxsize = maxsize
+        self.cachedir = cachedir
+        self.maxdisk = maxdisk
+        self.plans = []
+
+    def filename(self, key):
+        return os.path.join(self.cachedir, 'mosaicplan_%s.npz' % key)
+
+    def get(self, key):
+        """Return the plan for key or None if it is not in the cache"""
+        for plan in self.plans:
+            if plan.key == key:
+                self.plans.remove(plan)
+                self.plans.insert(0, plan)
+                self.touch(key)
+                return plan
+
+        if self.cachedir and os.path.isfile(self.filename(key)):
+            try:
+                plan = read_plan(self.filename(key))
+            except Exception:
+                return None
+            self.touch(key)
+            self.add(plan)
+            return plan
+        return None
+
+    def touch(self, key):
+        """Mark the plan file for key as recently used.  Other processes
+           sharing cachedir may remove it at any time, so errors are ignored
+        """
+        if not self.cachedir:
+            return
+        try:
+            os.utime(self.filename(key), None)
+        except OSError:
+            pass
+
+    def put(self, plan):
+        """Add a plan to the cache and, if cachedir is set, write it"""
+        self.add(plan)
+        if self.cachedir:
+            # the directory may be created by another process at any time
+            try:
+                os.makedirs(self.cachedir)
+            except OSError:
+                pass
+            try:
+                plan.save(self.filename(plan.key))
+            except (IOError, OSError):
+                return
+            self.prune()
+
+    def add(self, plan):
+        self.plans = [p for p in self.plans if p.key != plan.key]
+        self.plans.insert(0, plan)
+        del self.plans[self.maxsize:]
+
+    def prune(self):
+        """Remove all but the maxdisk most recently used plans on disk"""
+        files = []
+        for f in glob.glob(os.path.join(self.cachedir, 'mosaicplan_*.npz')):
+            try:
+                files.append((os.path.getmtime(f), f))
+            except OSError:
+                pass
+        files.sort(reverse=True)
+        for mtime, f in files[self.maxdisk:]:
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+
+    def clear(self):
+        self.plans = []
+
+
+# the plans used by make_mosaic.  Set plan_cache.cachedir with set_cachedir
+# to keep the plans on disk between sessions
+plan_cache = PlanCache()
+
+
+def set_cachedir(cachedir):
+    """Set the directory where the mosaic plans are kept.  If cachedir is
+       empty, the plans are only kept in memory
+    """
+    if cachedir is not None:
+        cachedir = os.path.expanduser(cachedir.strip())
+    plan_cache.cachedir = cachedir or None
+
+
 def tran_func(a, xshift, yshift, xmag, ymag, xrot, yrot):
     xtran = ymag * a[0] * cos(yrot * pi / 180.0) \
         - xmag * a[1] * sin(xrot * pi / 180) \
@@ -636,7 +966,7 @@ def tran_func(a, xshift, yshift, xmag, ymag, xrot, yrot):
 
 # -----------------------------------------------------------
 # main code
-if not iraf.deftask('saltmosaic'):
+if iraf is not None and not iraf.deftask('saltmosaic'):
     parfile = iraf.osfn("saltred$saltmosaic.par")
     t = iraf.IrafTaskFactory(
         taskname="saltmosaic",
@@ -62,8 +62,15 @@ from __future__ import with_statement
 
 from pyraf import iraf
 import os, glob, time 
+import hashlib
+import cPickle
 from astropy.io import fits
 
+try:
+   import sqlite3
+except ImportError:
+   sqlite3 = None
+
 import saltsafekey as saltkey
 import saltsafeio as saltio
 from saltsafelog import logging
@@ -87,7 +94,7 @@ scamformatList=['I']
 
 debug=True
 
-def saltobslog(images,outfile,clobber=False,logfile='salt.log',verbose=True):
+def saltobslog(images,outfile,nthreads=1,indexfile=None,clobber=False,logfile='salt.log',verbose=True):
   """Create the observation log from the input files"""
 
   #start the logging
@@ -98,7 +105,7 @@ def saltobslog(images,outfile,clobber=False,logfile='salt.log',verbose=True):
 
 
        #create the header dictionary
-       headerDict=obslog(infiles, log)
+       headerDict=obslog(infiles, log, nthreads=nthreads, indexfile=saltio.checkfornone(indexfile))
 
        #clobber the output if it exists
        if (clobber and os.path.isfile(outfile)):
@@ -149,10 +156,17 @@ def createobslogfits(headerDict):
 # -----------------------------------------------------------
 # read keyword and append to list
 
-def obslog(infiles, log=None):
+def obslog(infiles, log=None, nthreads=1, indexfile=None):
    """For a set of input files, create a dictionary contain all the header 
       information from the files.  Will print things to a saltlog if log is
       not None
+
+      Only the primary header of each file is read.  If nthreads is more 
+      than one, the headers are read by that many threads.
+
+      If indexfile is given, the record for each file is stored in that 
+      index and only files that are new or have changed since the last run
+      are read.
     
       returns Dictionary
    """
@@ -162,45 +176,131 @@ def obslog(infiles, log=None):
    for k in scamheaderList: headerDict[k]=[]
    for k in rssheaderList: headerDict[k]=[]
 
-   # interate over and open image files
+   #read the record for each file
    infiles.sort()
-   for infile in infiles:
-
-       #open the file
-       struct = saltio.openfits(infile)
-
-       # instrument
-       scam = False
-       rss = False
-       instrume = saltkey.get('INSTRUME', struct[0])
-       if (instrume=='RSS'): rss = True
-       if (instrume=='SALTICAM'): scam=True
-
+   makerecord=lambda infile, header: obslogrecord(infile, header, log=log)
+   records=None
+   if indexfile and sqlite3 is not None:
+       try:
+           index=ObslogIndex(indexfile)
+           records=index.records(infiles, makerecord, nthreads=nthreads)
+           index.close()
+       except (SaltIOError, sqlite3.Error), e:
+           if log: log.warning('Not using the obslog index because %s' % e)
+   if records is None:
+       headers=saltio.readprimaryheaders(infiles, nthreads=nthreads)
+       records=[makerecord(infile, header) for infile, header in zip(infiles, headers)]
+
+   # add the records to the dictionary
+   keys=headerList[1:]+scamheaderList[1:]+rssheaderList[1:]
+   for infile, record in zip(infiles, records):
        #add in the image name
        headerDict['FILENAME'].append(os.path.basename(infile))
-
-       # ingest primary keywords from files in the image list
-       for k,f in zip(headerList[1:], formatList[1:]):
-           default=finddefault(f)
-           headerDict[k].append(getkey(struct[0], k, default=default, log=log, warn=True))
-
-       # ingest scam specific primary keywords from files in the image list
-       for k,f in zip(scamheaderList[1:], scamformatList[1:]):
-           default=finddefault(f)
-           headerDict[k].append(getkey(struct[0], k, default=default, log=log, warn=scam))
-
-       # ingest rss specific primary keywords from files in the image list
-       for k,f in zip(rssheaderList[1:], rssformatList[1:]):
-           default=finddefault(f)
-           headerDict[k].append(getkey(struct[0], k, default=default, log=log, warn=rss))
-
-       # close image files
-       saltio.closefits(struct)
+       for k, value in zip(keys, record): headerDict[k].append(value)
 
        if log: log.message('SALTOBSLOG -- read %s' % infile, with_header=False)
 
    return headerDict
 
+def obslogrecord(infile, header, log=None):
+   """Return the list of values for the observation log from the primary 
+      header of infile.  The values are for the keywords in headerList, 
+      scamheaderList and rssheaderList, excluding the first of each.
+   """
+   #only the header is needed from the file
+   struct = [fits.PrimaryHDU(header=header)]
+
+   # instrument
+   scam = False
+   rss = False
+   instrume = saltkey.get('INSTRUME', struct[0], file=infile)
+   if (instrume=='RSS'): rss = True
+   if (instrume=='SALTICAM'): scam=True
+
+   record=[]
+
+   # ingest primary keywords from files in the image list
+   for k,f in zip(headerList[1:], formatList[1:]):
+       default=finddefault(f)
+       record.append(getkey(struct[0], k, default=default, log=log, warn=True, infile=infile))
+
+   # ingest scam specific primary keywords from files in the image list
+   for k,f in zip(scamheaderList[1:], scamformatList[1:]):
+       default=finddefault(f)
+       record.append(getkey(struct[0], k, default=default, log=log, warn=scam, infile=infile))
+
+   # ingest rss specific primary keywords from files in the image list
+   for k,f in zip(rssheaderList[1:], rssformatList[1:]):
+       default=finddefault(f)
+       record.append(getkey(struct[0], k, default=default, log=log, warn=rss, infile=infile))
+
+   return record
+
+class ObslogIndex:
+   """ObslogIndex is a persistent index of the header records of a set of
+      files.  It is stored in an sqlite database, with the size, 
+      modification time and a checksum of the primary header of each file.
+      Only files that are new or have changed since they were indexed are
+      read again, so rerunning on a night that is in progress only reads 
+      the new files.
+
+      table is the name of the table in the database, so that records of
+      different kinds can be kept in the same file.
+   """
+
+   def __init__(self, indexfile, table='obslog'):
+       self.indexfile=indexfile
+       self.table=table
+       try:
+           self.conn=sqlite3.connect(indexfile)
+           self.conn.execute('CREATE TABLE IF NOT EXISTS %s (path TEXT PRIMARY KEY, '
+                             'size INTEGER, mtime REAL, checksum TEXT, record BLOB)' % table)
+       except sqlite3.Error, e:
+           raise SaltIOError('Cannot open the obslog index %s because %s' % (indexfile, e))
+
+   def records(self, infiles, makerecord, nthreads=1):
+       """Return the record for each file in infiles.  If a file has not 
+          changed since it was indexed, the stored record is returned.
+          Otherwise its primary header is read and, unless the header is 
+          the same as the one that was indexed, makerecord(infile, header) 
+          is called to create the record.
+
+          returns list of records in the same order as infiles
+       """
+       paths=[os.path.abspath(infile) for infile in infiles]
+       stats=[os.stat(infile) for infile in infiles]
+       stored={}
+       for row in self.conn.execute('SELECT path, size, mtime, checksum, record FROM %s' % self.table):
+           stored[row[0]]=row[1:]
+
+       #find the files that are new or have changed
+       records=[None]*len(infiles)
+       changed=[]
+       for i, (path, st) in enumerate(zip(paths, stats)):
+           row=stored.get(path)
+           if row is not None and row[0]==st.st_size and row[1]==st.st_mtime:
+               records[i]=cPickle.loads(str(row[3]))
+           else:
+               changed.append(i)
+
+       #read the headers of those files and update the index
+       headers=saltio.readprimaryheaders([infiles[i] for i in changed], nthreads=nthreads)
+       for i, header in zip(changed, headers):
+           checksum=hashlib.md5(header.tostring()).hexdigest()
+           row=stored.get(paths[i])
+           if row is not None and row[2]==checksum:
+               records[i]=cPickle.loads(str(row[3]))
+           else:
+               records[i]=makerecord(infiles[i], header)
+           self.conn.execute('INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?, ?)' % self.table,
+                             (paths[i], stats[i].st_size, stats[i].st_mtime, checksum,
+                              buffer(cPickle.dumps(records[i], 2))))
+       self.conn.commit()
+       return records
+
+   def close(self):
+       self.conn.close()
+
 def finddefault(f):
    """return the default value given a format"""
    if f.count('A'): 
@@ -211,20 +311,19 @@ def finddefault(f):
        default=-999.99
    return default
 
-def getkey(struct,keyword,default,warn=True, log=None):
+def getkey(struct,keyword,default,warn=True, log=None, infile=None):
    """Return the keyword value.  Throw a warning if it doesn't work """
 
+   if infile is None: infile=struct._file.name
    try:
-        value = saltkey.get(keyword, struct)
+        value = saltkey.get(keyword, struct, file=infile)
         if isinstance(default, str):  value=value.strip()
    except SaltIOError:
         value = default
-        infile=struct._file.name
         message = 'WARNING: cannot find keyword %s in %s' %(keyword, infile)
         if warn and log: log.message(message, with_header=False)
    if (str(value).strip() == ''): value = default
    if (type(value) != type(default)):
-        infile=struct._file.name
         message='WARNING: Type mismatch for %s for  %s in %s[0]' % (str(value), keyword, infile)
         message += '/n '+str(type(value)) + ' '+str(type(default))
         if warn and log: log.message(message, with_header=False)
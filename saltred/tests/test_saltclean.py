@@ -0,0 +1,101 @@
+"""Regression tests for saltclean"""
+import os
+import sys
+import glob
+
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(here, '..'), os.path.join(here, '..', '..', 'lib')]
+datadir = os.path.join(here, '..', '..', 'data', 'scam')
+
+import pyfits
+import saltclean
+
+
+def makeraw(filename, ccdtype, seed, ny=60, nx=40, nover=8):
+    """Write a small SALTICAM-like raw frame with two CCDs of two
+       amplifiers each, binned 2x2, to filename
+    """
+    rs = np.random.RandomState(seed)
+    level = {'ZERO': 0, 'FLAT': 20000, 'OBJECT': 1000}[ccdtype]
+    obstype = {'ZERO': 'BIAS', 'FLAT': 'FLAT', 'OBJECT': 'OBJECT'}[ccdtype]
+    phdu = pyfits.PrimaryHDU()
+    for key, value in [('INSTRUME', 'SALTICAM'), ('DETMODE', 'NORMAL'),
+                       ('OBSMODE', 'IMAGING'), ('CCDTYPE', ccdtype),
+                       ('OBSTYPE', obstype), ('OBJECT', obstype),
+                       ('NCCDS', 2), ('NEXTEND', 4), ('CCDSUM', '2 2'),
+                       ('GAINSET', 'FAINT'), ('ROSPEED', 'SLOW'),
+                       ('FILTER', 'CLEAR'), ('DATE-OBS', '2011-07-01'),
+                       ('TIME-OBS', '20:00:00'), ('EXPTIME', 1.0),
+                       ('NWINDOW', 0)]:
+        phdu.header[key] = value
+    hdus = [phdu]
+    for amp in range(1, 5):
+        data = 300 + rs.normal(0, 3, (ny, nx + nover))
+        light = level * (1 + 0.01 * rs.normal(size=(ny, nx)))
+        if amp % 2:
+            biassec = '[1:%i,1:%i]' % (nover, ny)
+            datasec = '[%i:%i,1:%i]' % (nover + 1, nover + nx, ny)
+            data[:, nover:] += light
+        else:
+            biassec = '[%i:%i,1:%i]' % (nx + 1, nx + nover, ny)
+            datasec = '[1:%i,1:%i]' % (nx, ny)
+            data[:, :nx] += light
+        hdu = pyfits.ImageHDU(data.astype(np.float32))
+        x1 = (amp - 1) * 2 * nx + 1
+        c1 = ((amp - 1) % 2) * 2 * nx + 1
+        for key, value in [('CCDSUM', '2 2'), ('CCDNAMPS', 2),
+                           ('BIASSEC', biassec), ('DATASEC', datasec),
+                           ('DETSEC', '[%i:%i,1:%i]' % (x1, x1 + 2 * nx - 1, 2 * ny)),
+                           ('CCDSEC', '[%i:%i,1:%i]' % (c1, c1 + 2 * nx - 1, 2 * ny)),
+                           ('AMPSEC', '[1:%i,1:%i]' % (2 * nx, 2 * ny)),
+                           ('GAIN', 1.5), ('RDNOISE', 3.0)]:
+            hdu.header[key] = value
+        hdus.append(hdu)
+    pyfits.HDUList(hdus).writeto(filename)
+
+
+def runclean(tmpdir, rawfiles, nproc, geotran):
+    outpath = str(tmpdir.join('out%i' % nproc)) + '/'
+    os.mkdir(outpath)
+    saltclean.saltclean(','.join(rawfiles), outpath,
+                        obslogfile=outpath + 'obslog.fits',
+                        gaindb=os.path.join(datadir, 'SALTICAMamps.dat'),
+                        xtalkfile=os.path.join(datadir, 'SALTICAMxtalk.dat'),
+                        geomfile=os.path.join(datadir, 'SALTICAMgeom.dat'),
+                        geotran=geotran, nproc=nproc, clobber=True,
+                        logfile=outpath + 'saltclean.log', verbose=False)
+    return outpath
+
+
+def test_saltclean_parallel_matches_serial(tmpdir):
+    rawdir = tmpdir.mkdir('raw')
+    rawfiles = []
+    for n, ccdtype in enumerate(['ZERO'] * 3 + ['FLAT'] * 3 + ['OBJECT'] * 2):
+        filename = str(rawdir.join('S201107010%03i.fits' % (n + 1)))
+        makeraw(filename, ccdtype, n)
+        rawfiles.append(filename)
+
+    # geotran is not used by the worker processes, so the parallel run
+    # mosaics the frames in memory even though geotran is set
+    serial = runclean(tmpdir, rawfiles, 1, False)
+    parallel = runclean(tmpdir, rawfiles, 3, True)
+
+    products = sorted([os.path.basename(f) for f in glob.glob(serial + '*.fits')
+                       if not f.endswith('obslog.fits')])
+    assert [p for p in products if p.startswith('mbxgp')]
+    assert [p for p in products if 'Bias' in p]
+    assert [p for p in products if 'Flat' in p]
+    assert products == sorted([os.path.basename(f) for f in glob.glob(parallel + '*.fits')
+                               if not f.endswith('obslog.fits')])
+    for p in products:
+        a = pyfits.open(serial + p)
+        b = pyfits.open(parallel + p)
+        assert len(a) == len(b)
+        for ha, hb in zip(a, b):
+            if ha.data is None:
+                assert hb.data is None
+            else:
+                assert ha.data.dtype == hb.data.dtype
+                assert (ha.data == hb.data).all()
@@ -0,0 +1,87 @@
+"""Regression tests for saltcrclean"""
+import os
+import sys
+
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(here, '..'), os.path.join(here, '..', '..', 'lib')]
+
+import pyfits
+import saltcrclean
+
+
+def makestruct(seed, shape=(200, 200), ncr=3000):
+    """Return a SALT-like structure with a single SCI extension containing
+       noise and cosmic rays of a range of strengths
+    """
+    rs = np.random.RandomState(seed)
+    data = rs.normal(100, 5, shape)
+    y = rs.randint(0, shape[0], ncr)
+    x = rs.randint(0, shape[1], ncr)
+    data[y, x] += rs.uniform(10, 300, ncr)
+    struct = pyfits.HDUList([pyfits.PrimaryHDU(),
+                             pyfits.ImageHDU(data, name='SCI')])
+
+    class DummyFile:
+        name = 'test.fits'
+    struct[0]._file = DummyFile()
+    return struct
+
+
+def crfast_loop(arr, mean, bsigma, thresh, mbox, flux_ratio):
+    """The original pixel by pixel implementation of crfast"""
+    mbox = max(3, mbox)
+    mbox = int(mbox / 2)
+    ylen = len(arr)
+    xlen = len(arr[0])
+    crarr = 0.0 * arr
+    rarr = arr - mean
+    darr = np.where(rarr > bsigma * thresh)
+    for i in range(len(darr[0])):
+        y = darr[0][i]
+        x = darr[1][i]
+        y, x, mpix = saltcrclean.idcray(rarr, flux_ratio, y, x, ylen, xlen, mbox)
+        if mpix is not None:
+            crarr[y, x] = mpix + mean
+    return crarr
+
+
+def test_crfast_matches_loop():
+    for seed in range(30):
+        arr = makestruct(seed, shape=(150, 170), ncr=500)[1].data
+        mean, median, std = saltcrclean.saltstat.iterstat(arr, 3, 3)
+        for mbox in [3, 5]:
+            crarr = saltcrclean.crfast(arr, mean, std, 5, mbox, 0.2)
+            ref = crfast_loop(arr, mean, std, 5, mbox, 0.2)
+            assert (ref > 0).any()
+            assert (crarr == ref).all()
+
+
+def test_multicrclean_median_matches_crclean():
+    for seed in range(3):
+        for maxiter in [1, 3]:
+            for mbox, bbox in [(5, 11), (3, 10), (7, 25)]:
+                a = saltcrclean.crclean(makestruct(seed), crtype='median',
+                                        mbox=mbox, bbox=bbox, maxiter=maxiter)
+                b = saltcrclean.multicrclean(makestruct(seed), crtype='median',
+                                             mbox=mbox, bbox=bbox,
+                                             maxiter=maxiter, nproc=2,
+                                             tsize=40)
+                assert (a[1].data == b[1].data).all()
+
+
+def test_mapfile_falls_back_when_shm_is_full(monkeypatch):
+    class StatVFS:
+        f_bavail = 1
+        f_frsize = 4096
+    monkeypatch.setattr(saltcrclean.os, 'statvfs', lambda path: StatVFS())
+    fname = saltcrclean.mapfile(np.ones((100, 100)))
+    try:
+        assert not fname.startswith('/dev/shm')
+    finally:
+        os.remove(fname)
+    a = saltcrclean.crclean(makestruct(0), crtype='fast')
+    b = saltcrclean.multicrclean(makestruct(0), crtype='fast', nproc=2,
+                                 tsize=40)
+    assert (a[1].data == b[1].data).all()
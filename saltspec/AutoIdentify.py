@@ -23,6 +23,7 @@ import os
 import sys
 import time
 import numpy as np
+import multiprocessing as mp
 
 from pyraf import iraf
 import saltprint
@@ -49,7 +50,7 @@ autoidentify_options = ['Zeropoint', 'Matchlines', 'MatchZero']
 def AutoIdentify(xarr, specarr, slines, sfluxes, ws, method='Zeropoint',
                  rstep=1, istart=None, nrows=1, res=2, dres=0.1, dsigma=5,
                  sigma=5, smooth=0, niter=5, mdiff=20, dc=20, ndstep=20, farr=None,
-                 subback=0, oneline=False, log=None, verbose=True):
+                 subback=0, oneline=False, nproc=1, log=None, verbose=True):
     """Automatically find the wavlength solution for the entire image.  The following
        methods are used:
 
@@ -63,7 +64,7 @@ def AutoIdentify(xarr, specarr, slines, sfluxes, ws, method='Zeropoint',
 
        FullXCor--Provides a full cross correlation for all the coefficients
 
-
+       The rows are solved by nproc processes, see runsolution.
 
     """
     ImageSolution = {}
@@ -73,7 +74,7 @@ def AutoIdentify(xarr, specarr, slines, sfluxes, ws, method='Zeropoint',
         func = st.findzeropoint
         ImageSolution = runsolution(xarr, specarr, slines, sfluxes, ws, func, fline=False, oneline=oneline,
                                     rstep=rstep, istart=istart, nrows=nrows, res=res, smooth=smooth, dres=dres, farr=farr,
-                                    dsigma=dsigma, dniter=niter, log=log, verbose=verbose, dc=dc, ndstep=ndstep)
+                                    dsigma=dsigma, dniter=niter, nproc=nproc, log=log, verbose=verbose, dc=dc, ndstep=ndstep)
 
     # use a line matching algorithm to match the lines
     # in the image with those in the line list
@@ -87,7 +88,7 @@ def AutoIdentify(xarr, specarr, slines, sfluxes, ws, method='Zeropoint',
         wdiff = 20
         ImageSolution = runsolution(xarr, specarr, slines, sfluxes, ws, func, fline=True, oneline=oneline,
                                     rstep=rstep, istart=istart, nrows=nrows, res=res, subback=subback, smooth=smooth, dres=dres, farr=farr,
-                                    dsigma=dsigma, dniter=niter, log=log, verbose=verbose, mdiff=mdiff, wdiff=wdiff, sigma=sigma, niter=niter)
+                                    dsigma=dsigma, dniter=niter, nproc=nproc, log=log, verbose=verbose, mdiff=mdiff, wdiff=wdiff, sigma=sigma, niter=niter)
 
     # first fit a zeropoint, then match the lines, and then
     # find the rest of the points by using only the zeropoint
@@ -104,7 +105,7 @@ def AutoIdentify(xarr, specarr, slines, sfluxes, ws, method='Zeropoint',
         func = st.findzeropoint
         ImageSolution = runsolution(xarr, specarr, slines, sfluxes, ws, func, fline=False, oneline=oneline,
                                     rstep=rstep, istart=istart, nrows=nrows, res=res, subback=subback, smooth=smooth, dres=dres, farr=farr,
-                                    dsigma=dsigma, dniter=niter, log=log, verbose=verbose, dc=dc, ndstep=ndstep)
+                                    dsigma=dsigma, dniter=niter, nproc=nproc, log=log, verbose=verbose, dc=dc, ndstep=ndstep)
 
     if method == 'FullXcor':
         func = st.findxcor
@@ -114,7 +115,7 @@ def AutoIdentify(xarr, specarr, slines, sfluxes, ws, method='Zeropoint',
         dcoef[0] = dc
         ImageSolution = runsolution(xarr, specarr, slines, sfluxes, ws, func, fline=True, oneline=oneline,
                                     rstep=rstep, istart=istart, nrows=nrows, res=res, subback=subback, smooth=smooth, dres=dres, farr=farr,
-                                    dsigma=dsigma, dniter=niter, log=log, verbose=verbose, dcoef=dcoef, ndstep=ndstep)
+                                    dsigma=dsigma, dniter=niter, nproc=nproc, log=log, verbose=verbose, dcoef=dcoef, ndstep=ndstep)
 
     return ImageSolution
 
@@ -122,11 +123,17 @@ def AutoIdentify(xarr, specarr, slines, sfluxes, ws, method='Zeropoint',
 def runsolution(xarr, specarr, slines, sfluxes, ws, func, ivar=None,
                 fline=True, oneline=False, farr=None, rstep=20,
                 istart=None, nrows=1, dsigma=5, dniter=5, subback=0, smooth=0, res=2.0,
-                dres=0.1, log=None, verbose=True, **kwargs):
+                dres=0.1, nproc=1, log=None, verbose=True, **kwargs):
     """Starting in the middle of the image, it will determine the solution
        by working its way out to either edge and compiling all the results into
        ImageSolution.  The image solution is only saved if the sigma is less than dres.
 
+       If nproc is not 1, the central row is solved first and the rows are
+       then solved in blocks of nproc rows by nproc processes, working out
+       from the centre in both directions at once.  Every row in a block
+       starts from the nearest solution found in the previous blocks.  If
+       nproc is None, one process is used for each cpu.
+
        xarr--Full range in x of pixels to solve for
 
        specarr--Input 2D flux
@@ -194,6 +201,11 @@ def runsolution(xarr, specarr, slines, sfluxes, ws, func, ivar=None,
     if log is not None:
         log.message('%5s %3s %4s' % ('Line', 'N', 'RMS'), with_header=False)
 
+    if nproc != 1:
+        return runwavefront(xarr, specarr, swarr, sfarr, ws, func, istart, rstep,
+                            nrows, min_lines, dsigma, dniter, smooth, subback, dres,
+                            nproc, log, verbose, kwargs)
+
     for i in range(0, int(0.5 * len(specarr)), rstep):
         for k in [istart - i, istart + i]:
 
@@ -237,6 +249,85 @@ def runsolution(xarr, specarr, slines, sfluxes, ws, func, ivar=None,
     return ImageSolution
 
 
+def runwavefront(xarr, specarr, swarr, sfarr, ws, func, istart, rstep, nrows,
+                 min_lines, dsigma, dniter, smooth, subback, dres, nproc, log,
+                 verbose, kwargs):
+    """Solve the rows in blocks on a pool of processes, starting with the
+       central row and working out to either edge.  Each row in a block is
+       seeded from the nearest solution in ImageSolution at the start of the
+       block, so the rows in a block can be solved in any order.
+    """
+    ImageSolution = {}
+
+    # the rows are taken in the same order as in the serial loop
+    rows = []
+    for i in range(0, int(0.5 * len(specarr)), rstep):
+        for k in [istart - i, istart + i]:
+            if k not in rows:
+                rows.append(k)
+
+    if nproc is None:
+        nproc = mp.cpu_count()
+    args = (xarr, swarr, sfarr, func, min_lines, dsigma, dniter, smooth, subback, kwargs)
+    pool = mp.Pool(nproc, initrow, (args,))
+    try:
+        # the central row is solved on its own and the rest in blocks
+        nblock = 1
+        while rows:
+            block = rows[:nblock]
+            rows = rows[nblock:]
+            nblock = nproc
+            tasks = [(k, apext.makeflat(specarr, k, k + nrows),
+                      getwsfromIS(k, ImageSolution, default_ws=ws)) for k in block]
+
+            for k, fws in pool.map(solverow, tasks):
+                if fws is None:
+                    continue
+                if fws.sigma(fws.func.x, fws.func.y) < dres:
+                    ImageSolution[k] = fws
+                if verbose and log is not None:
+                    msg = "%5i %3i %3.2f" % (k, fws.func.mask.sum(),
+                                             fws.sigma(fws.func.x, fws.func.y))
+                    log.message(msg, with_header=False)
+    finally:
+        pool.close()
+        pool.join()
+
+    return ImageSolution
+
+
+# the arguments that are the same for every row solved by solverow
+_rowargs = None
+
+
+def initrow(args):
+    global _rowargs
+    _rowargs = args
+
+
+def solverow(task):
+    """Find the solution for a single row in a worker process.  task is the
+       row number, the flux in the row and the starting solution.
+
+       returns row, solution
+    """
+    k, farr, lws = task
+    xarr, swarr, sfarr, func, min_lines, dsigma, dniter, smooth, subback, kwargs = _rowargs
+
+    if smooth > 0:
+        farr = st.smooth_spectra(xarr, farr, sigma=smooth)
+
+    # continuum correct the spectrum if possible
+    try:
+        farr = st.flatspectrum(xarr, farr, mode='poly', order=subback)
+    except:
+        return k, None
+
+    fws = solution(xarr, farr, swarr, sfarr, lws, func,
+                   min_lines=min_lines, dsigma=dsigma, dniter=dniter, **kwargs)
+    return k, fws
+
+
 def solution(xarr, farr, sl, sf, ws, func, min_lines=2,
              dsigma=5, dniter=3, pad=50, **kwargs):
     """Extract a single line and calculate the wavelneght solution"""
@@ -0,0 +1,244 @@
+import os
+import bisect
+import datetime
+import numpy as np
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+
+class SolutionDatabase(dict):
+
+    """SolutionDatabase is a dictionary of wavelength solutions in the same
+    format as the one created by specrectify.readsolascii:
+
+    name: [timeobs, instrume, grating, grang, arang, filtername, slitid,
+           function, order, wsrow, wscoef, domain]
+
+    The solutions are also indexed by the instrument setup and sorted by
+    time, so the solutions that match an observation can be found without
+    comparing every entry in the dictionary.
+
+    If dbfile is given, the solutions read from each file are also stored in
+    an sqlite database.  If the file has not changed since it was stored,
+    the solutions are read from the database instead of parsing the file
+    again, and the coefficient arrays are only read when a solution is used.
+    """
+
+    # tolerance used to match the grating and camera angles
+    angtol = 0.01
+
+    def __init__(self, dbfile=None):
+        dict.__init__(self)
+        self.dbfile = dbfile
+        self.index = {}
+        self.lazy = {}
+        self.conn = None
+
+    # -------------------------------------------------------------------
+    # dictionary access
+
+    def __setitem__(self, name, sol):
+        if name in self:
+            self.unindex(name)
+        self.lazy.pop(name, None)
+        dict.__setitem__(self, name, sol)
+        self.addindex(name, sol)
+
+    def __delitem__(self, name):
+        self.unindex(name)
+        self.lazy.pop(name, None)
+        dict.__delitem__(self, name)
+
+    def __getitem__(self, name):
+        if name in self.lazy:
+            self.loadcoef(name)
+        return dict.__getitem__(self, name)
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+    def values(self):
+        return [self[name] for name in self]
+
+    def items(self):
+        return [(name, self[name]) for name in self]
+
+    def itervalues(self):
+        for name in self:
+            yield self[name]
+
+    def iteritems(self):
+        for name in self:
+            yield name, self[name]
+
+    # -------------------------------------------------------------------
+    # setup index
+
+    def bucket(self, angle):
+        return int(np.floor(angle / self.angtol))
+
+    def setupkey(self, sol):
+        return (sol[1], sol[2], sol[5], self.bucket(sol[3]), self.bucket(sol[4]))
+
+    def addindex(self, name, sol):
+        entries = self.index.setdefault(self.setupkey(sol), [])
+        bisect.insort(entries, (sol[0], name))
+
+    def unindex(self, name):
+        sol = dict.__getitem__(self, name)
+        entries = self.index.get(self.setupkey(sol), [])
+        if (sol[0], name) in entries:
+            entries.remove((sol[0], name))
+
+    def match(self, instrume, grating, grang, arang, filtername, slitid=None):
+        """Return the names of the solutions that match the setup, sorted
+           by time
+        """
+        gb = self.bucket(grang)
+        ab = self.bucket(arang)
+        entries = []
+        for i in range(gb - 2, gb + 3):
+            for j in range(ab - 2, ab + 3):
+                for t, name in self.index.get((instrume, grating, filtername, i, j), []):
+                    sol = dict.__getitem__(self, name)
+                    if abs(sol[3] - grang) > self.angtol:
+                        continue
+                    if abs(sol[4] - arang) > self.angtol:
+                        continue
+                    if slitid is not None and sol[6] != slitid:
+                        continue
+                    entries.append((t, name))
+        entries.sort()
+        return [name for t, name in entries]
+
+    def timeobs(self, name):
+        """Return the time of a solution without reading its coefficients"""
+        return dict.__getitem__(self, name)[0]
+
+    def nearest(self, names, timeobs):
+        """Return the name from a time sorted list of names that is closest
+           in time to timeobs
+        """
+        if not names:
+            return None
+        times = [self.timeobs(name) for name in names]
+        i = bisect.bisect_left(times, timeobs)
+        if i == 0:
+            return names[0]
+        if i == len(names):
+            return names[-1]
+        if timeobs - times[i - 1] <= times[i] - timeobs:
+            return names[i - 1]
+        return names[i]
+
+    # -------------------------------------------------------------------
+    # persistent storage
+
+    def connect(self):
+        """Open the database, returning None if it can not be used"""
+        if self.conn is not None:
+            return self.conn
+        if not self.dbfile or sqlite3 is None:
+            return None
+        try:
+            self.conn = sqlite3.connect(self.dbfile)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS files '
+                              '(path TEXT PRIMARY KEY, size INTEGER, mtime REAL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS solutions '
+                              '(name TEXT, path TEXT, timeobs TEXT, instrume TEXT, '
+                              'grating TEXT, grang REAL, arang REAL, filter TEXT, '
+                              'slitid TEXT, function TEXT, ord INTEGER, domain TEXT, '
+                              'ncoef INTEGER, wsrow BLOB, wscoef BLOB)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS solpath ON solutions (path)')
+        except sqlite3.Error:
+            self.conn = None
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def filestat(self, solfile):
+        st = os.stat(solfile)
+        return os.path.abspath(solfile), st.st_size, st.st_mtime
+
+    def readfile(self, solfile):
+        """Enter the solutions stored for solfile.  Returns False if they
+           are not in the database or the file has changed since they were
+           stored
+        """
+        conn = self.connect()
+        if conn is None:
+            return False
+        try:
+            path, size, mtime = self.filestat(solfile)
+            row = conn.execute('SELECT size, mtime FROM files WHERE path=?',
+                               (path,)).fetchone()
+            if row is None or row[0] != size or row[1] != mtime:
+                return False
+            rows = conn.execute('SELECT rowid, name, timeobs, instrume, grating, grang, '
+                                'arang, filter, slitid, function, ord, domain '
+                                'FROM solutions WHERE path=?', (path,)).fetchall()
+        except (OSError, sqlite3.Error):
+            return False
+
+        for row in rows:
+            rowid, name = row[0], row[1]
+            timeobs = datetime.datetime.strptime(row[2], '%Y-%m-%d %H:%M:%S')
+            if row[11] is None:
+                domain = None
+            else:
+                domain = [float(x) for x in row[11].split(',')]
+            self[name] = [timeobs, row[3], row[4], row[5], row[6], row[7], row[8],
+                          row[9], row[10], None, None, domain]
+            self.lazy[name] = rowid
+        return True
+
+    def writefile(self, solfile, soldict):
+        """Enter the solutions in soldict, which were read from solfile, and
+           store them in the database
+        """
+        for name in soldict:
+            self[name] = soldict[name]
+
+        conn = self.connect()
+        if conn is None:
+            return
+        try:
+            path, size, mtime = self.filestat(solfile)
+            conn.execute('DELETE FROM solutions WHERE path=?', (path,))
+            for name in soldict:
+                sol = soldict[name]
+                wscoef = np.array(sol[10], dtype=float)
+                if sol[11] is None:
+                    domain = None
+                else:
+                    domain = ','.join([repr(float(x)) for x in sol[11]])
+                conn.execute('INSERT INTO solutions VALUES '
+                             '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (name, path, sol[0].strftime('%Y-%m-%d %H:%M:%S'),
+                              sol[1], sol[2], sol[3], sol[4], sol[5], sol[6],
+                              sol[7], sol[8], domain, wscoef.shape[-1],
+                              buffer(np.asarray(sol[9], dtype=float).tostring()),
+                              buffer(wscoef.tostring())))
+            conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)',
+                         (path, size, mtime))
+            conn.commit()
+        except (OSError, sqlite3.Error):
+            conn.rollback()
+
+    def loadcoef(self, name):
+        """Read the coefficient arrays for a solution from the database"""
+        rowid = self.lazy.pop(name)
+        row = self.connect().execute('SELECT ncoef, wsrow, wscoef FROM solutions '
+                                     'WHERE rowid=?', (rowid,)).fetchone()
+        sol = dict.__getitem__(self, name)
+        sol[9] = np.frombuffer(row[1], dtype=float).copy()
+        wscoef = np.frombuffer(row[2], dtype=float).reshape(-1, row[0])
+        sol[10] = [c.copy() for c in wscoef]
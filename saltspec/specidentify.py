@@ -67,7 +67,7 @@ debug = True
 def specidentify(images, linelist, outfile, guesstype='rss', guessfile='',
                  automethod='Matchlines', function='poly', order=3, rstep=100,
                  rstart='middlerow', mdiff=5, thresh=3, niter=5, smooth=0,
-                 subback=0, inter=True, startext=0,  clobber=False, 
+                 subback=0, inter=True, startext=0, nproc=1, clobber=False, 
                  textcolor='black', preprocess=False,  logfile='salt.log', verbose=True):
 
     with logging(logfile, debug) as log:
@@ -224,7 +224,7 @@ def specidentify(images, linelist, outfile, guesstype='rss', guessfile='',
                     ImageSolution = identify(data, slines, sfluxes, xarr, ystart, ws=ws, function=function,
                                              order=order, rstep=rstep,  mdiff=mdiff, thresh=thresh, niter=niter,
                                              method=automethod, res=res, dres=dres, smooth=smooth, inter=inter, filename=img,
-                                             subback=0, textcolor=textcolor, preprocess=preprocess, log=log, verbose=verbose)
+                                             subback=0, textcolor=textcolor, preprocess=preprocess, nproc=nproc, log=log, verbose=verbose)
 
                     if outfile and len(ImageSolution):
                         writeIS(ImageSolution, outfile, dateobs=dateobs, utctime=utctime, instrume=instrume,
@@ -236,7 +236,7 @@ def specidentify(images, linelist, outfile, guesstype='rss', guessfile='',
 def identify(data, slines, sfluxes, xarr, istart, ws=None, function='poly', order=3,
              rstep=1, nrows=1, mdiff=5, thresh=3, niter=5, dc=3, ndstep=50, dsigma=5,
              method='Zeropoint', res=2, dres=0.2, filename=None, smooth=0, inter=True,
-             subback=0, textcolor='green', preprocess=False, log=None, verbose=True):
+             subback=0, textcolor='green', preprocess=False, nproc=1, log=None, verbose=True):
     """For a given image, find the solution for each row in the file.  Use the appropriate first guess and
        guess type along with the appropriate function and order for the fit.
 
@@ -263,6 +263,7 @@ def identify(data, slines, sfluxes, xarr, istart, ws=None, function='poly', orde
        subback--order for function to subtract off background
        inter--run in interactive mode
        textcolor--color for wavelengths
+       nproc--number of processes used to find the solutions automatically
        verbose--print out the results
 
        returns
@@ -285,7 +286,7 @@ def identify(data, slines, sfluxes, xarr, istart, ws=None, function='poly', orde
         ImageSolution = AutoIdentify(xarr, data, slines, sfluxes, ws,
                                      rstep=rstep, method=method, istart=istart, nrows=nrows, mdiff=mdiff,
                                      dsigma=dsigma, res=res, dres=2 * dres, dc=dc, ndstep=ndstep, sigma=thresh,
-                                     subback=subback, smooth=smooth, niter=niter, log=log, verbose=verbose)
+                                     subback=subback, smooth=smooth, niter=niter, nproc=nproc, log=log, verbose=verbose)
 
     return ImageSolution
 
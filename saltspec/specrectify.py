@@ -54,6 +54,7 @@ from saltsafelog import logging, SaltLog
 from PySpectrograph.Models import RSSModel
 
 import WavelengthSolution
+from SolutionDatabase import SolutionDatabase
 import spectools as st
 from spectools import SALTSpecError
 
@@ -68,7 +69,7 @@ import pylab as pl
 def specrectify(images, outimages, outpref, solfile=None, caltype='line',
                 function='polynomial', order=3, inttype='linear', w1=None,
                 w2=None, dw=None, nw=None, blank=0, conserve=False, nearest=False,
-                clobber=True, logfile='salt.log', verbose=True):
+                soldb=None, clobber=True, logfile='salt.log', verbose=True):
 
     with logging(logfile, debug) as log:
 
@@ -90,7 +91,7 @@ def specrectify(images, outimages, outpref, solfile=None, caltype='line',
         # read in the wavelength solutions and enter them into
         # there own format
         if caltype == 'line':
-            soldict = entersolution(solfile)
+            soldict = entersolution(solfile, dbfile=soldb or None)
         else:
             soldict = None
 
@@ -216,69 +217,63 @@ def rectify(hdu, soldict, caltype='line', function='poly', order=3, inttype='int
             else:
                 bpmext = None
 
-            # for each line in the data, determine the wavelength solution
-            # for a given line in the image
-            for j in range(len(hdu[i].data)):
-                # find the wavelength solution for the data
-                w_arr = findsol(xarr, soldict, j, caltype, nearest, timeobs, exptime, instrume, grating, grang, arang, filtername,
-                                slit, xbin, ybin, slitid, function, order)
-
-                # apply that wavelength solution to the data
-                if w_arr is not None:
-                    try:
-                        hdu[i].data[
-                            j,
-                            :] = st.interpolate(
-                            nw_arr,
-                            w_arr,
-                            hdu[i].data[
-                                j,
-                                :],
-                            inttype,
-                            left=blank,
-                            right=blank)
-                    except Exception as e:
-                        hdu[i].data[j, :] = hdu[i].data[j, :] * 0.0 + blank
-                        msg = 'In row %i, solution cannot be found due to %s' % (
-                            i, e)
+            # for caltype line, compute the wavelength solution for all the
+            # rows at once and resample each plane in a single step
+            w_map = None
+            if caltype == 'line' and inttype == 'interp':
+                w_map = findwavemap(xarr, soldict, len(hdu[i].data), nearest, timeobs, exptime,
+                                    instrume, grating, grang, arang, filtername, slitid)
+
+            if w_map is not None:
+                rows = np.isfinite(w_map).all(axis=1)
+                w_map = w_map[rows]
+                hdu[i].data[rows] = interpolaterows(nw_arr, w_map, hdu[i].data[rows],
+                                                    left=blank, right=blank)
+                hdu[i].data[~rows] = blank
+                if varext:
+                    hdu[varext].data[rows] = interpolaterows(nw_arr, w_map, hdu[varext].data[rows],
+                                                             left=blank, right=blank)
+                if bpmext:
+                    hdu[bpmext].data[rows] = interpolaterows(nw_arr, w_map, hdu[bpmext].data[rows],
+                                                             left=blank, right=blank)
+
+            # otherwise, for each line in the data, determine the wavelength
+            # solution for a given line in the image
+            else:
+                for j in range(len(hdu[i].data)):
+                    # find the wavelength solution for the data
+                    w_arr = findsol(xarr, soldict, j, caltype, nearest, timeobs, exptime, instrume, grating, grang, arang, filtername,
+                                    slit, xbin, ybin, slitid, function, order)
 
-                    # correct the variance frame
-                    if varext:
+                    # apply that wavelength solution to the data
+                    if w_arr is not None:
                         try:
-                            hdu[varext].data[
-                                j,
-                                :] = st.interpolate(
-                                nw_arr,
-                                w_arr,
-                                hdu[varext].data[
-                                    j,
-                                    :],
-                                inttype,
-                                left=blank,
-                                right=blank)
+                            hdu[i].data[j, :] = st.interpolate(nw_arr, w_arr, hdu[i].data[j, :], inttype,
+                                                               left=blank, right=blank)
                         except Exception as e:
+                            hdu[i].data[j, :] = hdu[i].data[j, :] * 0.0 + blank
                             msg = 'In row %i, solution cannot be found due to %s' % (
                                 i, e)
 
-                    # correct the BPM frame
-                    if bpmext:
-                        try:
-                            hdu[bpmext].data[
-                                j,
-                                :] = st.interpolate(
-                                nw_arr,
-                                w_arr,
-                                hdu[bpmext].data[
-                                    j,
-                                    :],
-                                inttype,
-                                left=blank,
-                                right=blank)
-                        except Exception as e:
-                            msg = 'In row %i, solution cannot be found due to %s' % (
-                                i, e)
-                else:
-                    hdu[i].data[j, :] = hdu[i].data[j, :] * 0.0 + blank
+                        # correct the variance frame
+                        if varext:
+                            try:
+                                hdu[varext].data[j, :] = st.interpolate(nw_arr, w_arr, hdu[varext].data[j, :], inttype,
+                                                                        left=blank, right=blank)
+                            except Exception as e:
+                                msg = 'In row %i, solution cannot be found due to %s' % (
+                                    i, e)
+
+                        # correct the BPM frame
+                        if bpmext:
+                            try:
+                                hdu[bpmext].data[j, :] = st.interpolate(nw_arr, w_arr, hdu[bpmext].data[j, :], inttype,
+                                                                        left=blank, right=blank)
+                            except Exception as e:
+                                msg = 'In row %i, solution cannot be found due to %s' % (
+                                    i, e)
+                    else:
+                        hdu[i].data[j, :] = hdu[i].data[j, :] * 0.0 + blank
 
             if conserve:
                 hdu[i].data = hdu[i].data / dw
@@ -389,6 +384,94 @@ def findsol(xarr, soldict, y_i, caltype, nearest, timeobs, exptime, instrume, gr
 
     return w_arr
 
+def findwavemap(xarr, soldict, nrows, nearest, timeobs, exptime,
+                instrume, grating, grang, arang, filtername, slitid):
+    """Find the wavelength solution for every row of an image at once.  This
+       follows the same logic as findlinesol, but evaluates the coefficients
+       for all rows together and returns a 2-D array of wavelengths with one
+       row per image row.  Rows without a solution are set to nan.
+
+       Returns None if the solutions can not be evaluated this way, in which
+       case findsol should be used for each row instead.
+    """
+    yarr = np.arange(nrows, dtype=float)
+
+    # find the solutions that match the observation
+    if len(soldict) == 1:
+        sol_list = soldict.values()
+    else:
+        sol_list = [soldict[sol] for sol in findmatches(
+            soldict, nearest, timeobs, exptime, instrume, grating, grang, arang, filtername, slitid)]
+    if len(sol_list) < 1:
+        return None
+    for sol in sol_list:
+        if sol[7] not in ['poly', 'polynomial', 'legendre', 'chebyshev']:
+            return None
+
+    # calculate the coefficients for each of the solutions
+    t = timeobs + datetime.timedelta(seconds=exptime)
+    time_list = [subtracttime(sol[0], t) for sol in sol_list]
+    coef_list = [findcoefs(yarr, sol[9], sol[10]) for sol in sol_list]
+    id_min = np.array(time_list).argmin()
+    function = sol_list[id_min][7]
+    order = int(sol_list[id_min][8])
+    domain = sol_list[id_min][11]
+    coef = coef_list[id_min]
+    basis = solutionbasis(xarr, function, order, coef.shape[1], domain)
+    if len(sol_list) == 1 or nearest:
+        return np.dot(coef, basis.T)
+
+    # calculate the time weighted average of the solutions and then
+    # recalculate the solution using the same functional form as the best
+    # function
+    w_ave = np.zeros((nrows, len(xarr)))
+    wei = np.zeros((nrows, 1))
+    for i, sol in enumerate(sol_list):
+        if function in ['legendre', 'chebyshev']:
+            sbasis = solutionbasis(xarr, sol[7], int(sol[8]), coef_list[i].shape[1], sol[11])
+        else:
+            sbasis = solutionbasis(xarr, sol[7], int(sol[8]), coef_list[i].shape[1])
+        rows = np.isfinite(coef_list[i]).all(axis=1)
+        w_ave[rows] += np.dot(coef_list[i][rows], sbasis.T) / time_list[i] ** 2
+        wei[rows] += 1.0 / time_list[i] ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w_ave = w_ave / wei
+
+    # for the purposes of speed, the arrays are sparsely sampled
+    j = max(1, int(len(xarr) / order / 8))
+    if function in ['legendre', 'chebyshev']:
+        fbasis = solutionbasis(xarr, function, order, order + 1, [xarr.min(), xarr.max()])
+    else:
+        fbasis = solutionbasis(xarr, function, order, order + 1)
+    rows = np.isfinite(coef).all(axis=1)
+    coef = np.zeros((nrows, order + 1)) * np.nan
+    coef[rows] = np.linalg.lstsq(fbasis[::j], w_ave[rows][:, ::j].T, rcond=-1)[0].T
+    if coef.shape[1] != basis.shape[1]:
+        basis = solutionbasis(xarr, function, order, order + 1, domain)
+    return np.dot(coef, basis.T)
+
+
+def solutionbasis(xarr, function, order, ncoef, domain=None):
+    """Return an array with the value of each term of a wavelength solution
+       at each point in xarr.  Multiplying this by the coefficients gives the
+       wavelength at each point.
+    """
+    ws = WavelengthSolution.WavelengthSolution(
+        xarr,
+        xarr,
+        function=function,
+        order=order)
+    if domain is not None:
+        ws.func.func.domain = domain
+    basis = np.zeros((len(xarr), ncoef), dtype=float)
+    for k in range(ncoef):
+        coef = np.zeros(ncoef, dtype=float)
+        coef[k] = 1.0
+        ws.set_coef(coef)
+        basis[:, k] = ws.value(xarr)
+    return basis
+
+
 # -----------------------------------------------------------------------------
 # set the output axis wavelenght values
 
@@ -405,6 +488,52 @@ def createoutputxaxis(wstart, wend, nw):
     return warr
 
 
+def interpolaterows(x, xp, fp, left=None, right=None):
+    """Linearly interpolate each row of fp onto x.  The values in each row of
+       fp are sampled at the positions in the same row of xp, which must be
+       increasing.  This gives the same result as calling np.interp on each
+       row, but all rows are done at once.
+    """
+    nrows, npts = xp.shape
+    if nrows == 0:
+        return np.zeros((0, len(x)), dtype=float)
+    fp = np.asarray(fp, dtype=float)
+    xlo = xp[:, :1]
+    xhi = xp[:, -1:]
+
+    # offset each row so all the rows can be searched together
+    span = max(xhi.max(), x.max()) - min(xlo.min(), x.min()) + 1.0
+    offset = span * np.arange(nrows, dtype=float)[:, None]
+    j = np.searchsorted((xp - xlo + offset).ravel(),
+                        (x[None, :] - xlo + offset).ravel(), side='right')
+    j = j.reshape(nrows, len(x)) - npts * np.arange(nrows)[:, None] - 1
+    j = j.clip(0, max(npts - 2, 0))
+    r = np.arange(nrows)[:, None]
+    k = (j + 1).clip(0, npts - 1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (fp[r, k] - fp[r, j]) / (xp[r, k] - xp[r, j])
+        y = slope * (x[None, :] - xp[r, j]) + fp[r, j]
+
+    # handle the end points as np.interp does
+    xarr = x[None, :] * np.ones((nrows, 1))
+    mask = (xarr == xhi)
+    y[mask] = (fp[:, -1:] * np.ones((1, len(x))))[mask]
+    if left is None:
+        left = fp[:, :1] * np.ones((1, len(x)))
+    else:
+        left = np.ones((nrows, len(x))) * left
+    if right is None:
+        right = fp[:, -1:] * np.ones((1, len(x)))
+    else:
+        right = np.ones((nrows, len(x))) * right
+    mask = (xarr < xlo)
+    y[mask] = left[mask]
+    mask = (xarr > xhi)
+    y[mask] = right[mask]
+    return y
+
+
 def calcsol(xarr, y_i, instrume, grating, grang, arang,
             filtername, slit, xbin, ybin, function, order):
     rss = RSSModel.RSSModel(grating_name=grating.strip(), gratang=grang,
@@ -450,27 +579,18 @@ def findlinesol(soldict, yc, nearest, timeobs, exptime,
     order_list = []
     domain_list = []
     coef_list = []
-    for sol in soldict:
-        if matchobservations(
-                soldict[sol], instrume, grating, grang, arang, filtername, slitid):
-            # right at the same time
-            if (soldict[sol][0] - timeobs).seconds == 0.0:
-                function = soldict[sol][7]
-                order = soldict[sol][8]
-                coef = findcoef(yc, soldict[sol][9], soldict[sol][10])
-                domain = soldict[sol][11]
-                return function, order, coef, domain
-            else:
-                t = timeobs + datetime.timedelta(seconds=exptime)
-                time_list.append(subtracttime(soldict[sol][0], t))
-                function_list.append(soldict[sol][7])
-                order_list.append(soldict[sol][8])
-                domain_list.append(soldict[sol][11])
-                coef_list.append(
-                    findcoef(
-                        yc,
-                        soldict[sol][9],
-                        soldict[sol][10]))
+    t = timeobs + datetime.timedelta(seconds=exptime)
+    for sol in findmatches(soldict, nearest, timeobs, exptime,
+                           instrume, grating, grang, arang, filtername, slitid):
+        time_list.append(subtracttime(soldict[sol][0], t))
+        function_list.append(soldict[sol][7])
+        order_list.append(soldict[sol][8])
+        domain_list.append(soldict[sol][11])
+        coef_list.append(
+            findcoef(
+                yc,
+                soldict[sol][9],
+                soldict[sol][10]))
 
     if len(time_list) == 1:
         function = function_list[0]
@@ -534,6 +654,39 @@ def findlinesol(soldict, yc, nearest, timeobs, exptime,
 
     return function, order, coef, domain
 
+# -----------------------------------------------------------------------------
+# Find the solutions that match an observation
+
+
+def findmatches(soldict, nearest, timeobs, exptime,
+                instrume, grating, grang, arang, filtername, slitid):
+    """Return the names of the solutions in soldict that match the setup of
+       the observation.  If a solution was taken at the same time as the
+       observation, only that solution is returned.  If nearest is set and
+       soldict is a SolutionDatabase, only the solution closest in time is
+       returned.
+
+       For a SolutionDatabase, the times are taken from the index so the
+       coefficients are only read for the solutions that are used.
+    """
+    if isinstance(soldict, SolutionDatabase):
+        names = soldict.match(instrume, grating, grang, arang, filtername, slitid)
+        times = [soldict.timeobs(sol) for sol in names]
+    else:
+        names = [sol for sol in soldict if matchobservations(
+            soldict[sol], instrume, grating, grang, arang, filtername, slitid)]
+        times = [soldict[sol][0] for sol in names]
+
+    # right at the same time
+    for sol, soltime in zip(names, times):
+        if (soltime - timeobs).seconds == 0.0:
+            return [sol]
+
+    if nearest and len(names) > 1 and isinstance(soldict, SolutionDatabase):
+        t = timeobs + datetime.timedelta(seconds=exptime)
+        names = [soldict.nearest(names, t)]
+    return names
+
 # -----------------------------------------------------------------------------
 # Determine if two observations are the same
 
@@ -591,27 +744,44 @@ def findcoef(yc, wsrow, wscoef):
     return coef
 
 
-def entersolution(solfiles):
+def findcoefs(yarr, wsrow, wscoef):
+    """Find the coefficients for each row in yarr.  This is the same as
+       findcoef, but returns an array with one set of coefficients per
+       row.  Rows that are off the edges of wsrow are set to nan.
+    """
+    coefarr = np.array(wscoef, dtype=float)
+    if len(coefarr) == 1:
+        return coefarr[0] * np.ones((len(yarr), 1))
+
+    # fit each of the coefficients as a function of row and evaluate them
+    yc = np.asarray(yarr, dtype=float)[:, None]
+    tk = np.polyfit(wsrow, coefarr, 2)
+    coef = (tk[0] * yc + tk[1]) * yc + tk[2]
+
+    # If it is off the edges, then set it to nan
+    coef[(yc[:, 0] < wsrow.min()) | (yc[:, 0] > wsrow.max())] = np.nan
+    return coef
+
+
+def entersolution(solfiles, dbfile=None):
     """For each solution in the list, enter the information about that solution
        into the file.  The following information will be entered in:
        name, time, grating, grating angle, camera angle, function, order, solution
 
-       return dict
+       If dbfile is given, the solutions are stored in that database and are
+       read from there on later runs unless the solution file has changed.
+
+       return SolutionDatabase
     """
-    soldict = {}
+    soldict = SolutionDatabase(dbfile)
 
     if isinstance(solfiles, str):
-        solfile = solfiles
+        solfiles = [solfiles]
+    for solfile in solfiles:
         if solfile[-4:] == 'fits':
             print 'Not supported yet'
-        else:
-            soldict = readsolascii(solfile, soldict)
-    else:
-        for solfile in solfiles:
-            if solfile[-4:] == 'fits':
-                print 'Not supported yet'
-            else:
-                soldict = readsolascii(solfile, soldict)
+        elif not soldict.readfile(solfile):
+            soldict.writefile(solfile, readsolascii(solfile, {}))
 
     return soldict
 
@@ -71,25 +71,18 @@ def specselfid(images, outimages, outpref, refimage=None, ystart='middlerow',
                         sdata = hdu[i].data
                     else:
                         sdata = rhdu[i].data
-                    hdu[i].data = selfid(
-                        hdu[i].data,
-                        sdata,
-                        ystart=ystart,
-                        rstep=rstep)
+
+                    # the same shifts are applied to all the extensions
+                    shifts = findshifts(sdata, ystart=ystart)
+                    hdu[i].data = applyshifts(hdu[i].data, shifts)
                     if saltkey.found('VAREXT', hdu[i]):
                         varext = saltkey.get('VAREXT', hdu[i])
-                        hdu[varext].data = selfid(
-                            hdu[varext].data,
-                            sdata,
-                            ystart=ystart,
-                            rstep=rstep)
+                        hdu[varext].data = applyshifts(
+                            hdu[varext].data, shifts)
                     if saltkey.found('BPMEXT', hdu[i]):
                         bpmext = saltkey.get('BPMEXT', hdu[i])
-                        hdu[bpmext].data = selfid(
-                            hdu[bpmext].data,
-                            sdata,
-                            ystart=ystart,
-                            rstep=rstep)
+                        hdu[bpmext].data = applyshifts(
+                            hdu[bpmext].data, shifts)
 
             # write out the oimg
             saltio.writefits(hdu, oimg, clobber=clobber)
@@ -100,77 +93,121 @@ def selfid(data, sdata, ystart='middlerow', rstep=3):
        itself.   The first step is
        to extract the line itself and then run specidentify on the data
     """
+    return applyshifts(data, findshifts(sdata, ystart=ystart))
+
+
+def findshifts(sdata, ystart='middlerow', maxshift=2.0, niter=2):
+    """Find the zeropoint shift of every row of sdata relative to the
+       fiducial row ystart.
+
+       All of the rows are cross-correlated with the fiducial row at once
+       through their Fourier transforms along the rows.  As in findxcor,
+       the correlation at each whole pixel lag is normalized by the flux of
+       the shifted fiducial row, and the shift is only searched for within
+       maxshift pixels.  The shift is then refined to a fraction of a pixel
+       with a parabola through the peak, followed by niter Newton steps on
+       the correlation evaluated from the Fourier transforms at the
+       fractional lag.
+
+       returns an array with the shift of each row, in the sense that
+       row j at x matches the fiducial row at x+shift
+    """
     # setup the fiducial line
     if ystart == 'middlerow':
-        ystart = int(0.5 * len(data))
+        ystart = int(0.5 * len(sdata))
     else:
         ystart = int(ystart)
 
+    sdata = np.asarray(sdata, dtype=float)
+    ny, nx = sdata.shape
     sfluxes = sdata[ystart, :]
-    xarr = np.arange(len(data[0]))
-    function = 'polynomial'
-    order = 2
-    blank = 0
-    inttype = 'interp'
-
-    ws = WavelengthSolution.WavelengthSolution(
-        xarr,
-        xarr,
-        function=function,
-        order=order)
-    ws.fit()
-    ndstep = 50
-    nw_arr = xarr
-    for j in range(0, ystart):
-        dcoef = [2.0, 0.0, 0.0]
-        nws = st.findxcor(
-            xarr,
-            sdata[
-                j,
-                :],
-            xarr,
-            sfluxes,
-            ws,
-            dcoef=dcoef,
-            ndstep=ndstep,
-            best=False,
-            inttype=inttype,
-            debug=False)
-        data[
-            j,
-            :] = zeroshift(
-            data[
-                j,
-                :],
-            xarr,
-            nws,
-            blank=blank,
-            inttype=inttype)
-    for j in range(ystart, len(data) - 1):
-        dcoef = [2.0, 0.0, 0.0]
-        nws = st.findxcor(
-            xarr,
-            sdata[
-                j,
-                :],
-            xarr,
-            sfluxes,
-            ws,
-            dcoef=dcoef,
-            ndstep=ndstep,
-            best=False,
-            inttype=inttype,
-            debug=False)
-        data[
-            j,
-            :] = zeroshift(
-            data[
-                j,
-                :],
-            xarr,
-            nws,
-            blank=blank,
-            inttype=inttype)
+
+    # the cross power spectrum of each row with the fiducial row.  The rows
+    # are padded so that the correlation does not wrap around at the lags
+    # that are used
+    nlag = int(np.ceil(maxshift)) + 1
+    nfft = fftsize(nx + 2 * nlag)
+    power = np.fft.rfft(sdata, nfft, axis=1).conj() * np.fft.rfft(sfluxes, nfft)
+    weight = np.zeros(power.shape[1]) + 2.0 / nfft
+    weight[0] = weight[-1] = 1.0 / nfft
+    power *= weight
+    omega = 2 * np.pi * np.arange(power.shape[1]) / nfft
+
+    # the correlation at whole pixel lags from -nlag to nlag
+    lags = np.arange(-nlag, nlag + 1)
+    cc = np.dot(power, np.exp(1j * np.outer(omega, lags))).real
+
+    # normalize by the flux of the fiducial row that overlaps each row
+    csum = np.concatenate(([0], np.cumsum(sfluxes ** 2)))
+    norm = csum[np.clip(nx + lags, 0, nx)] - csum[np.clip(lags, 0, nx)]
+    norm[norm <= 0] = np.inf
+    cc = cc / norm ** 0.5
+
+    # find the peak within maxshift
+    inside = (abs(lags) <= maxshift)
+    i = np.where(inside, cc, -np.inf).argmax(axis=1)
+    shifts = lags[i].astype(float)
+
+    # refine it with a parabola through the peak and its neighbours
+    rows = np.arange(ny)
+    c0 = cc[rows, i - 1]
+    c1 = cc[rows, i]
+    c2 = cc[rows, i + 1]
+    d = c0 - 2 * c1 + c2
+    peak = (d < 0)
+    shifts[peak] += np.clip(0.5 * (c0[peak] - c2[peak]) / d[peak], -0.5, 0.5)
+
+    # and then to the peak of the correlation between the pixels
+    preal = power.real[peak]
+    pimag = power.imag[peak]
+    for k in range(niter):
+        phase = np.outer(shifts[peak], omega)
+        cos = np.cos(phase)
+        sin = np.sin(phase)
+        dc = np.dot(preal * sin + pimag * cos, omega)
+        d2c = np.dot(preal * cos - pimag * sin, omega ** 2)
+        step = -dc / np.where(d2c > 0, d2c, np.inf)
+        shifts[peak] += np.clip(step, -0.5, 0.5)
+
+    return np.clip(shifts, -maxshift, maxshift)
+
+
+def fftsize(n):
+    """Return the smallest number that is at least n and has no prime
+       factors larger than 5, for which the FFT is fast
+    """
+    while True:
+        m = n
+        for p in [2, 3, 5]:
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+
+def applyshifts(data, shifts, blank=0):
+    """Apply the zeropoint shifts from findshifts to each row of data with
+       linear interpolation, in the same way as zeroshift.  The rows with
+       the same whole pixel shift are resampled together.  The data are
+       changed in place and returned.
+    """
+    ny, nx = data.shape
+    kshift = np.floor(shifts).astype(int)
+    fshift = shifts - kshift
+    m = max(abs(kshift).max() + 1, 1)
+    pad = np.zeros((ny, nx + 2 * m))
+    pad[:, m:m + nx] = data
+    x = np.arange(nx)
+    out = np.empty((ny, nx))
+    for k in np.unique(kshift):
+        rows = np.where(kshift == k)[0]
+        f = fshift[rows][:, None]
+        f1 = pad[rows, m - k - 1:m - k - 1 + nx]
+        f2 = pad[rows, m - k:m - k + nx]
+        edge = (x < k + f) | (x > nx - 1 + k + f)
+        out[rows] = np.where(edge, blank, f2 + (f1 - f2) * f)
+    data[:] = out
     return data
 
 
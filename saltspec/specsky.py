@@ -29,10 +29,8 @@ import saltsafeio as saltio
 from saltsafelog import logging
 import spectools as st
 from spectools import SALTSpecError
-import saltstat as stats
 
 from PySpectrograph.Spectra import apext
-from PySpectrograph.Utilities.fit import interfit
 
 
 import pylab as pl
@@ -44,7 +42,7 @@ debug = True
 # core routine
 
 def specsky(images, outimages, outpref, method='normal', section=None,
-            function='polynomial', order=2,
+            function='polynomial', order=2, niter=3,
             clobber=True, logfile='salt.log', verbose=True):
 
     with logging(logfile, debug) as log:
@@ -80,7 +78,8 @@ def specsky(images, outimages, outpref, method='normal', section=None,
                 method=method,
                 section=section,
                 funct=function,
-                order=order)
+                order=order,
+                niter=niter)
 
             # write out the image
             if clobber and os.path.isfile(ofile):
@@ -88,7 +87,8 @@ def specsky(images, outimages, outpref, method='normal', section=None,
             hdu.writeto(ofile)
 
 
-def skysubtract(hdu, method='normal', section=[], funct='polynomial', order=2):
+def skysubtract(hdu, method='normal', section=[], funct='polynomial', order=2,
+                niter=3):
     """For a given image, extract a measurement of the sky from
        the image and then subtract that measurement from the
        overall image
@@ -119,13 +119,12 @@ def skysubtract(hdu, method='normal', section=[], funct='polynomial', order=2):
             # creat the xarr for the purposes of extracting the data
             xarr = np.arange(len(data_arr[0]))
 
-            # TODO:  The variance array does not fully work at the moment
-            var_arr = None
-
             if method == 'normal':
-                sdata = normalsky(xarr, data_arr, var_arr, section)
+                # TODO:  The variance array does not fully work at the moment
+                sdata = normalsky(xarr, data_arr, None, section)
             elif method == 'fit':
-                sdata = fitsky(xarr, data_arr, var_arr, section)
+                sdata = fitsky(xarr, data_arr, var_arr, function=funct,
+                               order=order, niter=niter)
 
             # subtract the data
             hdu[i].data = data_arr - sdata
@@ -156,23 +155,73 @@ def normalsky(xarr, data_arr, var_arr, section):
     return ap.ldata
 
 
-def fitsky(xarr, data, var_arr, function='polynomial', order=2, thresh=3):
+def fitsky(xarr, data, var_arr, function='polynomial', order=2, thresh=3,
+           niter=3):
     """For each column, fit a function to the column after rejecting
        sources and then create a sky image from that
+
+       All of the columns are fit together.  The basis functions are
+       evaluated once along the rows, and the weighted least squares
+       problem for each column is solved from its normal equations.
+       Sources are first rejected from each column by their distance from
+       the median, and then the fit is iterated niter times rejecting
+       points that are more than thresh times the rms away from the fit.
+       If var_arr is given and niter is not 0, each pixel is weighted by
+       its inverse variance.  With niter=0, a single unweighted fit is made,
+       as in earlier versions.  Columns without enough good pixels for the
+       fit are set to their median.
     """
-    sdata = 0.0 * data
-    for i in xarr:
-        yarr = data[:, i]
-        yind = np.arange(len(yarr))
-        m = np.median(yarr)
-        s = stats.median_absolute_deviation(yarr)
-        mask = (abs(yarr - m) < thresh * s)
-        try:
-            it = interfit(yind[mask], yarr[mask], function='poly', order=2)
-            it.fit()
-            sdata[:, i] = it(yind)
-        except:
-            sdata[:, i] = 0.0 * sdata[:, i] + m
+    data = np.asarray(data, dtype=float)
+    nrows, ncols = data.shape
+    ncoef = order + 1
+
+    # set up the basis functions on the normalized row number
+    yind = np.linspace(-1, 1, nrows)
+    if function in ['poly', 'polynomial']:
+        basis = np.polynomial.polynomial.polyvander(yind, order)
+    elif function == 'legendre':
+        basis = np.polynomial.legendre.legvander(yind, order)
+    elif function == 'chebyshev':
+        basis = np.polynomial.chebyshev.chebvander(yind, order)
+    else:
+        msg = '%s is not a supported function for fitting the sky' % function
+        raise SALTSpecError(msg)
+    # products of the basis functions for the normal equations
+    bprod = (basis[:, :, None] * basis[:, None, :]).reshape(nrows, -1).T
+
+    if var_arr is None or niter == 0:
+        weight = np.ones((nrows, ncols))
+    else:
+        var_arr = np.asarray(var_arr, dtype=float)
+        weight = np.where(var_arr > 0, 1.0 / np.where(var_arr > 0, var_arr, 1), 0)
+
+    # reject the sources
+    m = np.median(data, axis=0)
+    s = np.median(abs(data - m), axis=0)
+    mask = (abs(data - m) < thresh * s) & (weight > 0)
+
+    sdata = np.zeros((nrows, ncols)) + m
+    for k in range(niter + 1):
+        w = weight * mask
+        good = (mask.sum(axis=0) >= ncoef)
+        if not good.any():
+            break
+        a = np.dot(bprod, w[:, good]).T.reshape(-1, ncoef, ncoef)
+        b = np.dot(basis.T, (w * data)[:, good]).T
+        coef = np.linalg.solve(a, b[:, :, None])[:, :, 0]
+        sdata[:, good] = np.dot(basis, coef.T)
+        sdata[:, ~good] = m[~good]
+        if k == niter:
+            break
+
+        # reject points away from the fit
+        resid = (data - sdata) * weight ** 0.5
+        npts = np.maximum(mask.sum(axis=0) - ncoef, 1)
+        rms = ((resid ** 2 * mask).sum(axis=0) / npts) ** 0.5
+        newmask = (abs(resid) <= thresh * rms) & (weight > 0)
+        if (newmask == mask).all():
+            break
+        mask = newmask
     return sdata
 
 
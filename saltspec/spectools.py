@@ -422,6 +422,66 @@ def mod_coef(coef, dcoef, index, ndstep):
     return dlist
 
 
+def coef_grid(coef, dcoef, ndstep):
+    """Return an array with one row for each set of coefficients in the
+       grid searched by findxcor.  The rows are in the same order as the
+       list returned by mod_coef.
+    """
+    steps = []
+    for c, d in zip(coef, dcoef):
+        if d == 0:
+            steps.append(np.array([c], dtype=float))
+        else:
+            steps.append(c + np.arange(-d, d, 2 * d / float(ndstep)))
+    if not steps:
+        return np.zeros((0, 0), dtype=float)
+    grid = np.meshgrid(*steps, indexing='ij')
+    return np.array([g.ravel() for g in grid]).T
+
+
+def xcor_grid(xarr, farr, swarr, sfarr, ws, darr, nchunk=2 ** 20):
+    """Calculate the normalized correlation between farr and the artificial
+       spectrum for each set of coefficients in darr.
+
+       As the wavelength solution is linear in its coefficients, the
+       wavelengths for a block of coefficients are found with a single
+       matrix product, and all of them are resampled with one call to
+       np.interp.  The blocks are limited to about nchunk pixels.
+
+       returns None if the function of ws is not linear in its coefficients
+    """
+    if ws.function not in ['poly', 'polynomial', 'legendre', 'chebyshev']:
+        return None
+
+    # calculate the value of each term in the wavelength solution
+    try:
+        nws = copy.deepcopy(ws)
+    except:
+        return None
+    ncoef = darr.shape[1]
+    basis = np.zeros((ncoef, len(xarr)), dtype=float)
+    for k in range(ncoef):
+        coef = np.zeros(ncoef, dtype=float)
+        coef[k] = 1.0
+        nws.set_coef(coef)
+        basis[k] = nws.value(xarr)
+
+    farr = np.asarray(farr, dtype=float)
+    xx = np.dot(farr, farr)
+    cc_arr = np.zeros(len(darr), dtype=float)
+    nrows = max(1, nchunk // max(len(xarr), 1))
+    for i in range(0, len(darr), nrows):
+        warr = np.dot(darr[i:i + nrows], basis)
+        asfarr = np.interp(warr.ravel(), swarr, sfarr, left=0.0, right=0.0)
+        asfarr = asfarr.reshape(warr.shape)
+        d = xx * (asfarr * asfarr).sum(axis=1)
+        xy = np.dot(asfarr, farr)
+        cc = cc_arr[i:i + nrows]
+        mask = (d > 0)
+        cc[mask] = xy[mask] / d[mask] ** 0.5
+    return cc_arr
+
+
 def makeartificial(sw, sf, fmax, res, dw, pad=10, nkern=200, wrange=None):
     """For a given line list with fluxes, create an artifical spectrum"""
     if wrange is None:
@@ -573,36 +633,43 @@ def findxcor(xarr, farr, swarr, sfarr, ws, dcoef=None, ndstep=20, best=False,
     if dcoef is None:
         dcoef = ws.coef * 0.0 + 1.0
 
-    dlist = mod_coef(ws.coef, dcoef, 0, ndstep)
-    # loop through them and deteremine the best cofficient
-    cc_arr = np.zeros(len(dlist), dtype=float)
-    
-    for i in range(len(dlist)):
-        # set the coeficient
-        nws.set_coef(dlist[i])
+    darr = coef_grid(ws.coef, dcoef, ndstep)
+
+    # calculate the correlation for all of the coefficients at once
+    cc_arr = None
+    if inttype == 'interp':
+        cc_arr = xcor_grid(xarr, farr, swarr, sfarr, ws, darr)
+
+    # otherwise loop through them and deteremine the best cofficient
+    if cc_arr is None:
+        cc_arr = np.zeros(len(darr), dtype=float)
+        for i in range(len(darr)):
+            # set the coeficient
+            nws.set_coef(darr[i])
+
+            # set the wavelegnth coverage
+            warr = nws.value(xarr)
 
-        # set the wavelegnth coverage
-        warr = nws.value(xarr)
+            # resample the artificial spectrum at the same wavelengths as the
+            # observed spectrum
+            asfarr = interpolate(
+                warr, swarr, sfarr, type=inttype, left=0.0, right=0.0)
 
-        # resample the artificial spectrum at the same wavelengths as the
-        # observed spectrum
-        asfarr = interpolate(
-            warr, swarr, sfarr, type=inttype, left=0.0, right=0.0)
+            # calculate the correlation value
+            cc_arr[i] = ncor(farr, asfarr)
 
-        # calculate the correlation value
-        cc_arr[i] = ncor(farr, asfarr)
-        if debug:
-            print(cc_arr[i], " ".join(["%f" % k for k in dlist[i]]))
+    if debug:
+        for i in range(len(darr)):
+            print(cc_arr[i], " ".join(["%f" % k for k in darr[i]]))
 
     # now set the best coefficients
     i = cc_arr.argmax()
-    bcoef = dlist[i]
+    bcoef = darr[i].copy()
     nws.set_coef(bcoef)
     if best:
         return nws
 
     # interpoloate over the values to determine the best value
-    darr = np.array(dlist)
     for j in range(len(nws.coef)):
         if dcoef[j] != 0.0:
             i = cc_arr.argsort()[::-1]
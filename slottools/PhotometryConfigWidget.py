@@ -82,6 +82,7 @@ class PhotometryConfigWidget(QtGui.QWidget):
         # Set default parameters
         self.imlist=imlist
         self.number=number
+        self.index=None
         self.config=config
         self.amp={'target' : 1, 'comparison' : 1 }
 
@@ -236,6 +237,9 @@ class PhotometryConfigWidget(QtGui.QWidget):
 
         # If an image list is given
         if self.imlist is not None:
+            # Index the exposures in the image list
+            self.index=saltsafeio.build_exposure_index(self.imlist)
+
             # Connect image selection spinBox to event handlers
             self.connect(self.ui.imageSpinBox, QtCore.SIGNAL('valueChanged(int)'), self.loadImage)
             self.connect(self.ui.imageSpinBox, QtCore.SIGNAL('valueChanged(int)'), self.redraw)
@@ -267,16 +271,16 @@ class PhotometryConfigWidget(QtGui.QWidget):
         
         *number* is the image number to be loaded.
 
-        This function uses `saltsafeio.getexposure` to get the correct
-        exposure from a list of fits files containing an arbitrary number
-        of extensions.
+        This function uses `saltsafeio.get_indexed_exposure` to get the 
+        correct exposure from a list of fits files containing an arbitrary 
+        number of extensions.
         """
 
         # Emit signal
         self.emit(QtCore.SIGNAL("imageNumberUpdated(int)"), number)
 
         # Load image from file
-        self.img=saltsafeio.get_exposure(self.imlist,number)
+        self.img=saltsafeio.get_indexed_exposure(self.imlist,self.index,number)
 
         # Display image
         self.imdisplay.loadImage(self.img)
@@ -106,8 +106,16 @@ class SlotViewWindow(QtGui.QMainWindow):
         self.zbox=[]
         self.npoint=4
         self.id=0
-        self.nframes=len(self.struct)
-        self.header=self.struct[int(self.pid[self.id])].header
+        self.index=saltsafeio.build_exposure_index([self.infile])
+        self.cube=(len(self.index)==1 and len(self.index[0][5])==3)
+        if self.cube:
+            # the frames are in a single cube extension
+            self.frames=self.struct['FRAMES'].data
+            self.nframes=self.index[0][5][0]+1
+        else:
+            self.hduindex=dict([(entry[1], i+1) for i, entry in enumerate(self.index)])
+            self.nframes=max(self.hduindex)+1
+        self.header=self.getheader(self.id)
         self.goodframes=self.dtime*0+1
         if self.phottype=='circular': self.npoint=24
 
@@ -190,7 +198,7 @@ class SlotViewWindow(QtGui.QMainWindow):
            self.thread.start()
        if key=='t' and x is not None and y is not None:
            tr=self.radius
-           imarr=self.struct[int(self.pid[self.id])].data
+           imarr=self.getimage(self.id)
            timage, tx, ty  = st.calcdrift(imarr, x, y, tr, self.naxis1, self.naxis2)
            if tx >= 0 and ty >= 0:
                 self.tx[self.id]=tx
@@ -198,7 +206,7 @@ class SlotViewWindow(QtGui.QMainWindow):
            self.updatepage()
        if key=='c' and x is not None and y is not None:
            r=self.radius
-           imarr=self.struct[int(self.pid[self.id])].data
+           imarr=self.getimage(self.id)
            cimage, cx, cy  = st.calcdrift(imarr, x, y, r, self.naxis1, self.naxis2)
            if cx >= 0 and cy >= 0:
                 self.cx[self.id]=cx
@@ -226,7 +234,7 @@ class SlotViewWindow(QtGui.QMainWindow):
        y['target']=self.ty[self.id]
        x['comparison']=self.cx[self.id]
        y['comparison']=self.cy[self.id]
-       image=self.struct[int(self.pid[self.id])].data
+       image=self.getimage(self.id)
 
        #these will need to be changed
        gain=1
@@ -251,7 +259,7 @@ class SlotViewWindow(QtGui.QMainWindow):
        self.stopplay=True
        while i < self.nframes-1 and self.stopplay:
            self.id=i
-           imarr=self.struct[int(self.pid[self.id])].data
+           imarr=self.getimage(self.id)
            carray, fx,fy = st.finddrift(imarr, self.cx[self.id-1], self.cy[self.id-1], self.radius,  \
                 self.naxis1, self.naxis2, self.sigdet, self.contpix, self.sigback, self.driftlimit, self.niter)
            if 0 <= fx < self.naxis1 and 0 <= fy < self.naxis2:
@@ -427,7 +435,7 @@ class SlotViewWindow(QtGui.QMainWindow):
        self.imdisplay.setColormap(cmap)
 
        # Set scale mode for dynamic range
-       imarr=self.struct[int(self.pid[self.id])].data
+       imarr=self.getimage(self.id)
        self.imdisplay.scale=scale
        self.imdisplay.contrast=contrast
        self.imdisplay.aspect='auto'
@@ -516,10 +524,24 @@ class SlotViewWindow(QtGui.QMainWindow):
        infoLayout.addWidget(self.NameValueLabel, 0, 1, 1, 1)
        infoLayout.addWidget(self.timeValueLabel, 0, 2, 1, 1)
    
+   def getimage(self, i):
+       """Return the image for frame i of the light curve"""
+       if self.cube:
+           return saltsafeio.get_indexed_exposure([self.infile], self.index, 1, int(self.pid[i])-1)
+       return saltsafeio.get_indexed_exposure([self.infile], self.index, self.hduindex[int(self.pid[i])])
+
+   def getheader(self, i):
+       """Return the header for frame i of the light curve"""
+       if self.cube:
+           header=saltsafeio.get_indexed_header(self.index, 1)
+           header['UTC-OBS']=self.frames['UTC-OBS'][int(self.pid[i])-1]
+           return header
+       return saltsafeio.get_indexed_header(self.index, self.hduindex[int(self.pid[i])])
+
    def get_time(self):
        #set the time
        try:
-            utime=self.struct[int(self.pid[self.id])].header['UTC-OBS']
+            utime=self.getheader(self.id)['UTC-OBS']
        except:
             utime=''
        return utime
@@ -592,7 +614,7 @@ class SlotViewWindow(QtGui.QMainWindow):
        self.timeValueLabel.setText("%s" % self.get_time())
 
        #update the image
-       imarr=self.struct[int(self.pid[self.id])].data
+       imarr=self.getimage(self.id)
        self.imdisplay.loadImage(imarr)
        
        #update the boxes
@@ -52,12 +52,14 @@ import pyfits
 debug=True
 
 def slotback(images,outfits,extension,imgtype='image',subbacktype='median',
-             sigback=3,mbin=7,sorder=3,niter=5,ampperccd=2,ignorexp=6,
+             sigback=3,mbin=7,sorder=3,niter=5,bgsample=2000,ampperccd=2,ignorexp=6,
              clobber=False,logfile='salt.log',verbose=True):
 
     with logging(logfile,debug) as log:
         # set up the variables
         order=sorder
+        nsample=None
+        if bgsample>0: nsample=bgsample
         plotfreq=0.01
         ftime=plotfreq
     
@@ -161,7 +163,7 @@ def slotback(images,outfits,extension,imgtype='image',subbacktype='median',
                     # background subtraction
                     if not subbacktype=='none':
                        try:
-                           narray=subbackground(array, sigback, mbin, order, niter, subbacktype)
+                           narray=subbackground(array, sigback, mbin, order, niter, subbacktype, nsample=nsample)
                        except:
                            log.warning('Image '+infile+' extention '+str(i)+' is blank, skipping')
                            continue
@@ -41,10 +41,12 @@ from salterror import SaltError
 from saltstat import median_image
 import numpy as np
 
-def subbackground(image, sig, nbin, order, iter, type):
+def subbackground(image, sig, nbin, order, iter, type, nsample=2000):
     """Calculate and subtract a global background from an image
     using a number of different methods.  This is assuming that
-    slotmode data is being used.
+    slotmode data is being used.  The clipped statistics of the image
+    are estimated from a subsample of nsample pixels, or from all of the
+    pixels if nsample is None.
 
     return data array
     """
@@ -54,7 +56,10 @@ def subbackground(image, sig, nbin, order, iter, type):
 
     # calculate the image statistics
     if np.size(image)>0:
-        mean, median, stddev=saltstat.iterstat(image,sig,iter)
+        if nsample is None:
+            mean, median, stddev=saltstat.iterstat(image,sig,iter)
+        else:
+            mean, median, stddev=saltstat.iterstat(image,sig,iter,method='approx',nsample=nsample)
     if stddev==0:
         raise SaltError('Standard deviation = 0')
 
@@ -97,14 +102,87 @@ def med_row_image(arr):
 
     returns arr
     """
-    nrows=len(arr)
-
     try:
-        marr=np.zeros((nrows,1),dtype=float)
-        for i in range(nrows):
-            marr[i]=np.median(arr[i])
+        marr=np.median(arr, axis=1)[:,np.newaxis].astype(float)
     except Exception, e:
         raise SaltError('Could not calculate median row values ' + e)
 
     return marr
 
+
+def subbackgroundcube(cube, sig, nbin, order, iter, type, nsample=2000):
+    """Calculate and subtract a global background from each frame in a 
+    cube of slotmode frames with shape (nframes, naxis2, naxis1).  This 
+    gives the same result as subbackground on each frame, but all of the 
+    frames are processed at once.  Only the none, median and median-row 
+    types are supported.
+
+    returns data cube, blank 
+    where blank is True for frames with a standard deviation of zero,
+    which subbackground would reject
+    """
+    blank=np.zeros(len(cube), dtype=bool)
+
+    # return the same cube if no background subtraction is required
+    if type=='none': return cube, blank
+
+    if type not in ['median', 'median-row']:
+        raise SaltError('Background type %s is not supported for a cube of frames' % type)
+
+    # calculate the image statistics of each frame
+    mean, stddev=iterstatcube(cube, sig, iter, nsample=nsample)
+    blank=(stddev==0)
+    mean=mean[:,np.newaxis,np.newaxis]
+    stddev=stddev[:,np.newaxis,np.newaxis]
+
+    # Create a row median image for each frame
+    cube_mrow=np.median(cube, axis=2)[:,:,np.newaxis]
+
+    if type == 'median-row':
+        cube_back=cube*0.0+cube_mrow
+
+    # Replace bright objects in the frame with the median value of that row
+    # and median smooth each frame
+    if type == 'median':
+        with np.errstate(invalid='ignore'):
+            mask=((cube-mean) < sig*stddev)*(cube-mean > -sig*stddev)
+        cube_sig=cube*mask+(1-mask)*cube_mrow
+        cube_back=median_cube(cube_sig,nbin)
+
+    return cube-cube_back, blank
+
+def iterstatcube(cube, sig, niter, nsample=None):
+    """Calculate the sigma clipped mean and standard deviation of each 
+    frame in a cube in the same way as saltstat.iterstat.  If nsample is
+    given, the same subsample of each frame is used as by saltstat.iterstat
+    with method='approx'
+
+    returns mean, std
+    """
+    n=len(cube)
+    if nsample is None:
+        arr=cube.reshape(n, -1)
+    else:
+        arr=np.array([saltstat.subsample(frame, nsample) for frame in cube], dtype=float)
+    mean=arr.mean(axis=1)
+    std=arr.std(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for i in range(niter):
+            mask=(abs(arr-mean[:,np.newaxis]) < sig*std[:,np.newaxis])
+            npix=mask.sum(axis=1)
+            mean=(arr*mask).sum(axis=1)/npix
+            std=np.sqrt((((arr-mean[:,np.newaxis])*mask)**2).sum(axis=1)/npix)
+    return mean, std
+
+def median_cube(cube, nbin):
+    """Median smooth each frame in a cube with a filter size set by bin
+
+    returns cube
+    """
+    from scipy.ndimage.filters import median_filter
+    try:
+        cube=median_filter(cube,size=(1,nbin,nbin))
+    except Exception, e:
+        raise SaltError('Could not median filter image because %s' % e)
+
+    return cube
@@ -76,18 +76,25 @@ from pyraf.iraf import pysalt
 import saltsafekey
 import saltsafeio
 import slottool
-from slotbackground import subbackground
+from slotbackground import subbackground, subbackgroundcube
 from saltsafelog import logging
 from salterror import SaltError, SaltIOError
 
 debug=True
 
 def slotphot(images,outfile,srcfile,newfits=None,phottype='square', 
-             subbacktype='median',sigback=3,mbin=7,sorder=3,niter=5,sigdet=5,
+             subbacktype='median',sigback=3,mbin=7,sorder=3,niter=5,bgsample=2000,sigdet=5,
              contpix=10,ampperccd=2,ignorexp=6,driftlimit=10.,finddrift=True,
-             outtype='ascii',reltime=True,clobber=True,logfile='salt.log',
+             batchsize=1000,outtype='ascii',reltime=True,clobber=True,logfile='salt.log',
              verbose=True):
-    """Perform photometry on listed SALT slotmode *images*."""
+    """Perform photometry on listed SALT slotmode *images*.
+
+    The frames are processed in batches of *batchsize* frames, which are
+    stacked into a cube so the background subtraction, drift tracking and
+    photometry are done for the whole batch at once.  If batchsize is one,
+    or the photometry or background type is not supported for a batch, 
+    each frame is processed on its own.
+    """
 
     with logging(logfile,debug) as log:
         # set up the variables
@@ -109,6 +116,10 @@ def slotphot(images,outfile,srcfile,newfits=None,phottype='square',
         nframes = 0
         bin=mbin
         order=sorder
+        nsample=None
+        if bgsample>0: nsample=bgsample
+        batch=(batchsize>1 and phottype in ['square', 'circular'] and 
+               subbacktype in ['none', 'median', 'median-row'])
 
         # is the input file specified?
         saltsafeio.filedefined('Input',images)
@@ -138,6 +149,8 @@ def slotphot(images,outfile,srcfile,newfits=None,phottype='square',
                 lc = open(outfile,'a')
             except:
                 raise SaltIOError('Cannot open ouput file '+outfile)
+        else:
+            lc=None
 
         # is the extraction region defintion file specified?
         saltsafeio.filedefined('Extraction region defintion',srcfile)
@@ -205,27 +218,17 @@ def slotphot(images,outfile,srcfile,newfits=None,phottype='square',
                 else:
                     raise SaltIOError('Newfits file exists, use clobber')
 
-            try:
-                hdu=pyfits.PrimaryHDU()
-                hdu.header=struct[0].header
-                hdu.header['NCCDS']=1
-                hdu.header['NSCIEXT']=ntotal-ignorexp
-                hdu.header['NEXTEND']=ntotal-ignorexp
-                hduList=pyfits.HDUList(hdu)
-                hduList.verify()
-                hduList.writeto(writenewfits)
-            except:
-                raise SaltIOError('Could not create newfits file, '+writenewfits)
+            # the frames are written to a single cube extension
+            cubeout=slottool.FrameCubeWriter(writenewfits, struct[0].header, ntotal-ignorexp, naxis1, naxis2)
+        else:
+            cubeout=None
 
         # Close image file
         saltsafeio.closefits(struct)
 
-        # Read newfits file back in for updating
-        if writenewfits:
-            try:
-                hduList=pyfits.open(writenewfits,mode='update')
-            except:
-                raise SaltIOError('Cannot open newfits file '+writenewfits+' for updating.')
+        # open the binary light curve, which is written in blocks of frames
+        if outtype=='binary':
+            lc=slottool.LightCurveWriter(outfile, time0, reltime)
 
         # set up the arrays
         j=0
@@ -254,6 +257,89 @@ def slotphot(images,outfile,srcfile,newfits=None,phottype='square',
 
             struct=pyfits.open(infile)
 
+            # Process the frames in batches, stacking the frames into a
+            # cube so each step is done for all of the frames at once
+            if batch:
+                frames=[i for i in range(nframes) if not (infile==infiles[0] and i < ignorexp)]
+                p_n+=nframes-len(frames)
+                for k in range(0, len(frames), batchsize):
+                    exts=[amp['comparison']+i*nstep for i in frames[k:k+batchsize]]
+                    nexts=len(exts)
+
+                    # Show progress
+                    if verbose:
+                        p_n+=nexts
+                        p_new=int((p_n-1)*p_one)
+                        if p_new!=p_old:
+                            ctext='Percentage Complete: %d\r' % p_new
+                            sys.stdout.write(ctext)
+                            sys.stdout.flush()
+                            p_old=p_new
+
+                    # read in the frames
+                    cube=np.zeros((nexts, naxis2, naxis1), dtype='float')
+                    headers=[]
+                    ftime=np.zeros(nexts, dtype='float')
+                    rdnoise=np.zeros(nexts, dtype='float')
+                    for n, ext in enumerate(exts):
+                        header, cube[n], ftime[n], rdnoise[n]=readframe(struct, ext, infile)
+                        headers.append(header)
+
+                    # background subtraction
+                    cube, blank=subbackgroundcube(cube, sigback, bin, order, niter, subbacktype, nsample=nsample)
+                    for n in np.where(blank)[0]:
+                        log.warning('Image '+infile+' extention '+str(exts[n])+' is blank, skipping')
+                    keep=np.where(~blank)[0]
+                    if len(keep)<nexts:
+                        cube=cube[keep]
+                        exts=[exts[n] for n in keep]
+                        headers=[headers[n] for n in keep]
+                        ftime=ftime[keep]
+                        rdnoise=rdnoise[keep]
+                    nexts=len(exts)
+
+                    # x-y fit to the comparison star in each frame
+                    if finddrift and nexts:
+                        fx, fy=slottool.finddriftcube(cube, x['comparison'], y['comparison'], r['comparison'], x_o['comparison'], y_o['comparison'], naxis1, naxis2, sigdet, contpix, sigback, driftlimit, niter)
+
+                    # update the x,y values frame by frame
+                    for n in range(nexts):
+                        time[j+n]=ftime[n]
+                        if finddrift:
+                            drift=updatedrift(fx[n], fy[n], x, y, x_o, y_o, naxis1, naxis2)
+                            if drift is None:
+                                msg='No comparison object found in image file ' + infile+' on extension %i skipping.' % exts[n]
+                                log.warning(msg)
+                            else:
+                                dx[j+n], dy[j+n]=drift
+                        tgt_x[j+n]=x['target']
+                        tgt_y[j+n]=y['target']
+                        cmp_x[j+n]=x['comparison']
+                        cmp_y[j+n]=y['comparison']
+
+                    # do photometry
+                    s=slice(j, j+nexts)
+                    bx={'target':tgt_x[s], 'comparison':cmp_x[s]}
+                    by={'target':tgt_y[s], 'comparison':cmp_y[s]}
+                    tflux[s],terr[s],cflux[s],cerr[s],ratio[s],rerr[s],good=slottool.dophotcube(phottype, cube, bx, by, r, br1, br2, rdnoise, naxis1, naxis2)
+                    for n in np.where(~good)[0]:
+                        msg='Could not do photometry on extension %i in image %s skipping.' % (exts[n], infile)
+                        log.warning(msg)
+
+                    # record results and write newfits file
+                    for n in range(nexts):
+                        writeframe(lc, outtype, cubeout, j, time[j], {'target':tgt_x[j], 'comparison':cmp_x[j]},
+                                   {'target':tgt_y[j], 'comparison':cmp_y[j]},
+                                   (tflux[j], terr[j], cflux[j], cerr[j], ratio[j], rerr[j]), time0, reltime,
+                                   cube[n], infile, exts[n], headers[n], log)
+
+                        # increment counter
+                        j+=1
+
+                # close FITS file
+                saltsafeio.closefits(struct)
+                continue
+
             # Skip through the frames and process each frame individually
             for i in range(nframes):
                 # Show progress
@@ -268,35 +354,21 @@ def slotphot(images,outfile,srcfile,newfits=None,phottype='square',
 
                 if not (infile==infiles[0] and i < ignorexp):
 
-                    ext=amp['comparison']+i*nstep
-                    try:
-                        header=struct[ext].header
-                        array=struct[ext].data
-                        array=array*1.0
-                    except:
-                        msg='Unable to open extension %i in image %s' % (ext, infile)
-                        raise SaltIOError(msg)
-
                     # starti the analysis of each frame
-                    # get the time
-                    time[j]=slottool.getobstime(struct[ext],infile+'['+str(ext)+']')
+                    # get the data, time and readout noise
+                    ext=amp['comparison']+i*nstep
+                    header, array, time[j], rdnoise=readframe(struct, ext, infile)
 
-                    # gain and readout noise
+                    # gain
                     try:
                         gain=float(header['GAIN'])
                     except:
-                        gain=1
                         raise SaltIOError('Gain not specified in image header')
-                    try:
-                        rdnoise=float(header['RDNOISE'])
-                    except:
-                        rdnoise=0
-                        raise SaltIOError('RDNOISE not specified in image header')
 
                     # background subtraction
                     if not subbacktype=='none':
                         try:
-                            array=subbackground(array, sigback, bin, order, niter, subbacktype)
+                            array=subbackground(array, sigback, bin, order, niter, subbacktype, nsample=nsample)
                         except SaltError:
                             log.warning('Image '+infile+' extention '+str(ext)+' is blank, skipping')
                             continue
@@ -304,25 +376,12 @@ def slotphot(images,outfile,srcfile,newfits=None,phottype='square',
                     # x-y fit to the comparison star and update the x,y values
                     if finddrift:
                         carray, fx,fy=slottool.finddrift(array, x['comparison'], y['comparison'], r['comparison'], naxis1, naxis2, sigdet, contpix, sigback, driftlimit, niter)
-                        if fx > -1  and fy > -1:
-                            if fx < naxis1 and fy < naxis2:
-                                dx[j]=x['comparison']-fx
-                                dy[j]=y['comparison']-fy
-                                x['comparison']=fx
-                                y['comparison']=fy
-                                x['target']=x['target']-dx[j]
-                                y['target']=y['target']-dy[j]
-                            else:
-                                dx[j]=0
-                                dy[j]=0
-                                x['comparison']=x_o['comparison']
-                                y['comparison']=y_o['comparison']
-                                x['target']=x_o['target']
-                                y['target']=y_o['target']
-                        else:
+                        drift=updatedrift(fx, fy, x, y, x_o, y_o, naxis1, naxis2)
+                        if drift is None:
                             msg='No comparison object found in image file ' + infile+' on extension %i skipping.' % ext
                             log.warning(msg)
-                            pass
+                        else:
+                            dx[j], dy[j]=drift
 
                     # do photometry
                     try:
@@ -336,22 +395,11 @@ def slotphot(images,outfile,srcfile,newfits=None,phottype='square',
                     cmp_x[j]=x['comparison']
                     cmp_y[j]=y['comparison']
 
-                    # record results
+                    # record results and write newfits file
                     # TODO! This should be removed in favor of the write all to disk in the end
-                    if outtype=='ascii':
-                        slottool.writedataout(lc, j+1, time[j], x, y, tflux[j], terr[j], cflux[j],cerr[j],ratio[j],rerr[j],time0, reltime)
-
-                    # write newfits file
-                    if writenewfits:
-                        # add original name and extension number to header
-                        try:
-                            hdue=pyfits.ImageHDU(array)
-                            hdue.header=header
-                            hdue.header.update('ONAME',infile,'Original image name')
-                            hdue.header.update('OEXT',ext,'Original extension number')
-                            hduList.append(hdue)
-                        except:
-                            log.warning('Could not update image in newfits '+infile+' '+str(ext))
+                    writeframe(lc, outtype, cubeout, j, time[j], x, y,
+                               (tflux[j], terr[j], cflux[j], cerr[j], ratio[j], rerr[j]), time0, reltime,
+                               array, infile, ext, header, log)
 
                     # increment counter
                     j+=1
@@ -362,14 +410,13 @@ def slotphot(images,outfile,srcfile,newfits=None,phottype='square',
         # close newfits file
         if writenewfits:
             try:
-                hduList.flush()
-                hduList.close()
+                cubeout.close()
             except:
                 raise SaltIOError('Cannot close newfits file.')
 
         # write to output
-        if outtype=='ascii':
-            # close output ascii file
+        if outtype in ['ascii', 'binary']:
+            # close output file
             try:
                 lc.close()
             except:
@@ -402,6 +449,66 @@ def slotphot(images,outfile,srcfile,newfits=None,phottype='square',
             except:
                 raise SaltIOError('Could not write to fits table.')
 
+def readframe(struct, ext, infile):
+    """Read a frame from extension ext of the open image struct
+
+       returns the header, the data as floats, the time of the frame
+       and the read noise
+    """
+    try:
+        header=struct[ext].header
+        array=struct[ext].data*1.0
+    except:
+        msg='Unable to open extension %i in image %s' % (ext, infile)
+        raise SaltIOError(msg)
+    time=slottool.getobstime(struct[ext],infile+'['+str(ext)+']')
+    try:
+        rdnoise=float(header['RDNOISE'])
+    except:
+        raise SaltIOError('RDNOISE not specified in image header')
+    return header, array, time, rdnoise
+
+def updatedrift(fx, fy, x, y, x_o, y_o, naxis1, naxis2):
+    """Move the target and comparison positions in x and y with the 
+       comparison star found at fx, fy.  If the star is outside of the 
+       frame, the positions are reset to the original ones in x_o and y_o.
+
+       returns the drift dx, dy or None if no star was found
+    """
+    if fx > -1  and fy > -1:
+        if fx < naxis1 and fy < naxis2:
+            dx=x['comparison']-fx
+            dy=y['comparison']-fy
+            x['comparison']=fx
+            y['comparison']=fy
+            x['target']=x['target']-dx
+            y['target']=y['target']-dy
+            return dx, dy
+        x['comparison']=x_o['comparison']
+        y['comparison']=y_o['comparison']
+        x['target']=x_o['target']
+        y['target']=y_o['target']
+        return 0, 0
+    return None
+
+def writeframe(lc, outtype, cubeout, j, time, x, y, phot, time0, reltime, array, infile, ext, header, log):
+    """Write the results of frame j to the light curve and, if cubeout is
+       given, the frame to the newfits file.  phot holds the target flux,
+       its error, the comparison flux, its error, the ratio and its error.
+    """
+    tflux, terr, cflux, cerr, ratio, rerr=phot
+    if outtype=='ascii':
+        slottool.writedataout(lc, j+1, time, x, y, tflux, terr, cflux, cerr, ratio, rerr, time0, reltime)
+    elif outtype=='binary':
+        lc.write(j+1, time, x, y, tflux, terr, cflux, cerr, ratio, rerr)
+
+    # record the original name and extension number
+    if cubeout is not None:
+        try:
+            cubeout.write(j, array, infile, ext, header['UTC-OBS'])
+        except:
+            log.warning('Could not update image in newfits '+infile+' '+str(ext))
+
 # -----------------------------------------------------------
 # main code
 
@@ -39,6 +39,8 @@ TODO--
 # Ensure python 2.5 compatibility
 from __future__ import with_statement
 
+import os
+import pyfits
 from pyraf import iraf
 import saltsafekey as saltkey
 import saltsafeio as saltio
@@ -47,17 +49,28 @@ import saltstat
 from salterror import SaltError, SaltIOError
 
 import numpy as np
+from collections import OrderedDict
 
 def calcstat(image, sig, iter):
     """Calculate the image statistics"""
     imsize=np.size(image)
     if imsize<=0: return 0
 
-    mean=np.average(image)
-    stddev=np.sqrt(np.sum((image-mean)**2)/imsize)
+    clip=saltstat.clipstat(image)
+    mean, stddev=clip.stats()
     for i in range(iter):
-        mean=saltstat.mean2dclip(image,mean, stddev, sig)
-        stddev=saltstat.std2dclip(image,mean, stddev, sig)
+        last=(mean, stddev)
+        clip.select(mean, sig*stddev)
+        if clip.count() > 0:
+            mean=clip.stats()[0]
+        else:
+            mean=0
+        clip.select(mean, sig*stddev)
+        if clip.count() > 0:
+            stddev=clip.stats()[1]
+        else:
+            stddev=0
+        if (mean, stddev)==last: break
 
     return mean, stddev
 
@@ -231,6 +244,120 @@ def getobstime(struct, infile):
 
     return time
 
+def utc2obstime(utclist):
+    """Return the time since noon the previous day in seconds for each of
+    a list of UTC-OBS values, in the same way as getobstime
+
+    returns numpy array
+    """
+    try:
+        hms=np.array([utc.split(':') for utc in utclist], dtype=float)
+        hour=hms[:,0].astype(int)
+        time=hour*3600.+hms[:,1].astype(int)*60.+hms[:,2]
+    except (AttributeError, ValueError, IndexError), e:
+        raise SaltIOError('UTC-OBS keyword not recognized because %s' % e)
+    return np.where(hour>12, time-43200., time+43200.)
+
+
+def circlearea(x, y, r):
+    """Return the area of the part of a circle of radius r centred on the 
+    origin where u<=x and v<=y.  x and y can be arrays.
+    """
+    def integral(u):
+        #integral of sqrt(r**2-u**2)
+        u=np.clip(u, -r, r)
+        return 0.5*(u*np.sqrt(r**2-u**2)+r**2*np.arcsin(u/r))
+
+    x=np.clip(x, -r, r)
+    w=np.sqrt(np.maximum(r**2-y**2, 0))
+    xw=np.clip(x, -w, w)
+
+    # the chord between -w and w is cut off at y
+    area=y*(xw+w)+integral(xw)-integral(-w)
+
+    # above y=0, the full chord is included outside of -w to w
+    full=2*(integral(np.clip(x, -r, -w))-integral(-r)+integral(np.clip(x, w, r))-integral(w))
+    return np.where(y>=0, area+full, area)
+
+def circleweights(r, dx, dy, nstamp):
+    """Calculate the exact fraction of each pixel that is inside a circle
+    of radius r.  The pixels are in a stamp of 2*nstamp+1 pixels on a side
+    and the centre of the circle is offset by dx, dy from the centre of 
+    the central pixel.  dx and dy can be arrays, in which case a stamp is 
+    returned for each of them.
+
+    returns weights
+    """
+    dx=np.asarray(dx, dtype=float)[...,np.newaxis,np.newaxis]
+    dy=np.asarray(dy, dtype=float)[...,np.newaxis,np.newaxis]
+    k=np.arange(-nstamp, nstamp+2)-0.5
+    u=k[np.newaxis,:]-dx
+    v=k[:,np.newaxis]-dy
+    area=circlearea(u, v, r)
+    w=area[...,1:,1:]-area[...,1:,:-1]-area[...,:-1,1:]+area[...,:-1,:-1]
+    return np.maximum(w, 0)
+
+class ApertureCache:
+    """ApertureCache keeps the weights of circular apertures so they are
+    only calculated once.  The weights depend on where the centre of the
+    aperture is within a pixel, and the offset from the centre of the pixel
+    is binned into nsub bins in x and y.  The weights for the maxsize 
+    apertures that were used most recently are kept.
+    """
+
+    def __init__(self, nsub=100, maxsize=256):
+        self.nsub=nsub
+        self.maxsize=maxsize
+        self.weights=OrderedDict()
+
+    def offset(self, xc):
+        """Return the central pixel and the offset bin of a position"""
+        cx=np.floor(np.asarray(xc)+0.5).astype(int)
+        b=np.clip(np.floor((xc-cx+0.5)*self.nsub).astype(int), 0, self.nsub-1)
+        return cx, b
+
+    def bincentre(self, b):
+        """Return the offset at the centre of an offset bin"""
+        return (b+0.5)/self.nsub-0.5
+
+    def circle(self, r, xc, yc):
+        """Return the weights of a circular aperture of radius r centred
+        on xc, yc.  
+
+        returns weights, x1, y1
+        where x1, y1 are the position of the first pixel of the weights
+        """
+        cx, bx=self.offset(xc)
+        cy, by=self.offset(yc)
+        nstamp=int(np.ceil(r))+1
+        key=(r, int(bx), int(by))
+        if key in self.weights:
+            w=self.weights.pop(key)
+        else:
+            w=circleweights(r, self.bincentre(bx), self.bincentre(by), nstamp)
+            if len(self.weights)>=self.maxsize:
+                self.weights.popitem(last=False)
+        self.weights[key]=w
+        return w, int(cx)-nstamp, int(cy)-nstamp
+
+# weights of the apertures used for photometry
+apcache=ApertureCache()
+
+def stampsum(array, w, x1, y1):
+    """Return the weighted sum of the pixels in array under a stamp of 
+    weights starting at x1, y1, and the sum of the weights.  Pixels of 
+    the stamp that are off the array are not included.
+
+    returns flux, area
+    """
+    ny, nx=array.shape
+    sx1=max(x1, 0)
+    sy1=max(y1, 0)
+    sx2=min(x1+w.shape[1], nx)
+    sy2=min(y1+w.shape[0], ny)
+    if sx2<=sx1 or sy2<=sy1: return 0, 0
+    ws=w[sy1-y1:sy2-y1,sx1-x1:sx2-x1]
+    return (array[sy1:sy2,sx1:sx2]*ws).sum(), ws.sum()
 
 def calcstarbackground(array, x, y, br1, br2, gain, rdnoise, naxis1, naxis2):
     """Determines the sky background around a single star.
@@ -296,8 +423,10 @@ def calcstarbackground(array, x, y, br1, br2, gain, rdnoise, naxis1, naxis2):
 
     return bflux, berr, npix
 
-def sqapphot(array, xc, yc, rc, br1, br2,gain, rdnoise,  naxis1, naxis2):
-    """Perform square aperture photometry
+def sqapphot(array, xc, yc, rc, br1, br2,gain, rdnoise,  naxis1, naxis2, background=None):
+    """Perform square aperture photometry.  If background is given, it is
+    the result of calcstarbackground for this star and is not calculated
+    again.
 
     returns flux, flux_err
     """
@@ -315,7 +444,9 @@ def sqapphot(array, xc, yc, rc, br1, br2,gain, rdnoise,  naxis1, naxis2):
 
     flux=array[y1:y2,x1:x2].sum()
     # calculate the background flux
-    bflux, berr, npix=calcstarbackground(array, xc, yc, br1, br2, gain, rdnoise, naxis1, naxis2)
+    if background is None:
+        background=calcstarbackground(array, xc, yc, br1, br2, gain, rdnoise, naxis1, naxis2)
+    bflux, berr, npix=background
 
     # calculate the flux
     flux=flux-area*bflux
@@ -324,19 +455,16 @@ def sqapphot(array, xc, yc, rc, br1, br2,gain, rdnoise,  naxis1, naxis2):
     return  flux, flux_err
 
 def capphot(array, xc, yc, rc, br1, br2,gain, rdnoise,  naxis1, naxis2):
-    """Perform circular aperture photometry
+    """Perform circular aperture photometry.  Each pixel is weighted by 
+    the fraction of it that is inside the aperture.
 
     return flux, flux_err
     """
 
     # calculate the flux
     try:
-        i=len(array)
-        j=len(array[0])
-        y,x=np.indices((i,j))
-        r=np.sqrt((x-xc)**2+(y-yc)**2)
-        mask=(r<rc)
-        area=mask.sum()
+        w, x1, y1=apcache.circle(rc, xc, yc)
+        flux, area=stampsum(array, w, x1, y1)
     except:
         area=0
 
@@ -345,7 +473,6 @@ def capphot(array, xc, yc, rc, br1, br2,gain, rdnoise,  naxis1, naxis2):
         flux_err=0
         raise SaltError('No data in the specified array')
 
-    flux=(array*mask).sum()
     # calculate the background flux
     bflux, berr, npix=calcstarbackground(array, xc, yc, br1, br2, gain, rdnoise, naxis1, naxis2)
 
@@ -372,11 +499,14 @@ def cogphot(array, xc, yc, rc, br1, br2,gain, rdnoise,  naxis1, naxis2):
     flux_err=np.zeros(rc,dtype='float')
     rstep=(br2-min_rad)/rc
 
+    # the background is the same for all of the apertures
+    background=calcstarbackground(array, xc, yc, br1, br2, gain, rdnoise, naxis1, naxis2)
+
     best_sn=0
     best_i=-1
     for i in range(rc):
         rad[i]=min_rad+i*rstep
-        flux[i], flux_err[i]=sqapphot(array, xc, yc, rad[i], br1, br2, gain, rdnoise, naxis1, naxis2)
+        flux[i], flux_err[i]=sqapphot(array, xc, yc, rad[i], br1, br2, gain, rdnoise, naxis1, naxis2, background)
         s_n=flux[i]/flux_err[i]
         if s_n > best_sn:
             best_sn=s_n
@@ -544,6 +674,276 @@ def calcratio(target_flux, target_flux_err, compar_flux, compar_flux_err):
 
     return ratio, ratio_err
 
+def checkedges(x, x0, x1):
+    """Determine if the values in x are over the edge of an image, in
+    the same way as checkedge
+
+    returns array of int
+    """
+    x=np.trunc(np.asarray(x, dtype=float)).astype(int)
+    return np.clip(x, x0, x1)
+
+def windowcube(cube, x1, x2, y1, y2):
+    """Extract the window [y1:y2,x1:x2] from each frame in a cube, where
+    the limits are arrays with one value for each frame.  The windows are
+    padded to the size of the largest one.
+
+    returns sub, mask
+    where mask is True for the pixels that are in the window
+    """
+    n, ny, nx=cube.shape
+    w=max(int((x2-x1).max()), 0) if n else 0
+    h=max(int((y2-y1).max()), 0) if n else 0
+    xs=x1[:,np.newaxis]+np.arange(w)
+    ys=y1[:,np.newaxis]+np.arange(h)
+    mask=(ys<y2[:,np.newaxis])[:,:,np.newaxis]*(xs<x2[:,np.newaxis])[:,np.newaxis,:]
+    xs=np.clip(xs, 0, nx-1)
+    ys=np.clip(ys, 0, ny-1)
+    sub=cube[np.arange(n)[:,np.newaxis,np.newaxis], ys[:,:,np.newaxis], xs[:,np.newaxis,:]]
+    return sub*mask, mask
+
+def boxsumcube(cube, x1, x2, y1, y2):
+    """Return the sum and the number of pixels in the window [y1:y2,x1:x2]
+    of each frame in a cube
+    """
+    sub, mask=windowcube(cube, x1, x2, y1, y2)
+    return sub.sum(axis=2).sum(axis=1), mask.sum(axis=2).sum(axis=1)
+
+def calcstatcube(cube, sig, iter):
+    """Calculate the image statistics of each frame in a cube in the same
+    way as calcstat
+
+    returns mean, stddev
+    """
+    n=len(cube)
+    arr=cube.reshape(n, -1)
+    npix=arr.shape[1]
+    mean=arr.mean(axis=1)
+    stddev=np.sqrt(((arr-mean[:,np.newaxis])**2).sum(axis=1)/npix)
+    for i in range(iter):
+        mask=(abs(arr-mean[:,np.newaxis]) < sig*stddev[:,np.newaxis])
+        nmask=mask.sum(axis=1)
+        mean=np.where(nmask>0, (arr*mask).sum(axis=1)/np.maximum(nmask, 1), 0)
+        mask=(abs(arr-mean[:,np.newaxis]) < sig*stddev[:,np.newaxis])
+        nmask=mask.sum(axis=1)
+        cmean=(arr*mask).sum(axis=1)/np.maximum(nmask, 1)
+        cstd=np.sqrt((((arr-cmean[:,np.newaxis])*mask)**2).sum(axis=1)/np.maximum(nmask, 1))
+        stddev=np.where(nmask>0, cstd, 0)
+    return mean, stddev
+
+def calcdriftcube(cube, x, y, r, naxis1, naxis2, threshold=None):
+    """Given a central x-y for each frame in a cube, calculate the drift
+    in the same way as calcdrift.  If threshold is given, the number of
+    pixels in each window above the threshold for that frame is also 
+    returned.
+
+    returns cx, cy, nobj
+    """
+    x1=checkedges(x-r,0,naxis1)
+    x2=checkedges(x+r,0,naxis1)
+    y1=checkedges(y-r,0,naxis2)
+    y2=checkedges(y+r,0,naxis2)
+    sub, mask=windowcube(cube, x1, x2, y1, y2)
+    tot=sub.sum(axis=2).sum(axis=1)
+    ok=(tot!=0)
+    tot=np.where(ok, tot, 1)
+    fx=(sub*np.arange(sub.shape[2])).sum(axis=2).sum(axis=1)/tot
+    fy=(sub.sum(axis=2)*np.arange(sub.shape[1])).sum(axis=1)/tot
+    ok=ok*(fx>=0)*(fy>=0)
+    cx=np.where(ok, x1+fx, -1)
+    cy=np.where(ok, y1+fy, -1)
+
+    nobj=None
+    if threshold is not None:
+        nobj=((sub>threshold[:,np.newaxis,np.newaxis])*mask).sum(axis=2).sum(axis=1)
+    return cx, cy, nobj
+
+def finddriftcube(cube, cx, cy, cr, x_o, y_o, naxis1, naxis2, sigdet, cpix, sigback, driftlimit, iter, maxpass=10):
+    """Follow the comparison star through a cube of frames, starting from
+    cx, cy in the first frame.  The position found in each frame is the
+    same as finddrift would find, starting from the position it was 
+    updated to in the previous frame.  The position is updated to the one
+    that was found, reset to x_o, y_o if that is off the frame, or kept if
+    the star was not found.  
+
+    Each frame depends on the frame before, so all of the frames are 
+    first searched from a guess of their starting position and the search
+    is repeated from the updated positions until they no longer change.
+    As the result of each search only depends on the pixel windows it 
+    used, this usually takes two or three passes.  After maxpass passes,
+    the remaining frames are searched one at a time.
+
+    returns fx, fy 
+    where fx, fy are the positions found in each frame, or -1 if the star
+    was not found
+    """
+    n=len(cube)
+    mean,stddev=calcstatcube(cube,sigback,iter)
+    if driftlimit>0:
+        dr=int(driftlimit)
+    else:
+        dr=cr
+
+    sx=np.zeros(n)+cx
+    sy=np.zeros(n)+cy
+    fx=np.zeros(n)
+    fy=np.zeros(n)
+    k=0
+    npass=0
+    while k<n:
+        if npass<maxpass:
+            m=n-k
+        else:
+            m=1
+        npass+=1
+        s=slice(k,k+m)
+
+        # First to the fast search for the object, assuming it is roughly in the same position
+        cx2, cy2, nobj=calcdriftcube(cube[s], sx[s], sy[s], dr, naxis1, naxis2, sigdet*stddev[s])
+        fast=(cx2 >= 0) * (cy2 >= 0) * (nobj > cpix)
+        tx=cx2.copy()
+        ty=cy2.copy()
+        for i in range(iter):
+            tx, ty, nobj=calcdriftcube(cube[s], tx, ty, dr, naxis1, naxis2)
+        fx[s]=np.where(fast, tx, -1)
+        fy[s]=np.where(fast, ty, -1)
+
+        # search the frames where it was not found in the same position
+        for i in np.where(~fast)[0]:
+            carray, fx[k+i], fy[k+i]=finddrift(cube[k+i], sx[k+i], sy[k+i], cr, naxis1, naxis2, sigdet, cpix, sigback, driftlimit, iter)
+
+        # update the starting positions of the following frames
+        found=(fx[s] > -1) * (fy[s] > -1)
+        onframe=(fx[s] < naxis1) * (fy[s] < naxis2)
+        nx=np.where(found, np.where(onframe, fx[s], x_o), sx[s])
+        ny=np.where(found, np.where(onframe, fy[s], y_o), sy[s])
+        changed=np.append((nx[:-1]!=sx[k+1:k+m]) + (ny[:-1]!=sy[k+1:k+m]), True)
+        sx[k+1:k+m+1]=nx[:n-k-1]
+        sy[k+1:k+m+1]=ny[:n-k-1]
+        k+=1+int(np.argmax(changed))
+
+    return fx, fy
+
+def calcstarbackgroundcube(cube, x, y, br1, br2, rdnoise, naxis1, naxis2):
+    """Determines the sky background around a single star in each frame
+    of a cube in the same way as calcstarbackground.  The positions and 
+    rdnoise are arrays with one value for each frame.
+
+    returns bflux, berr, npix
+    """
+    try:
+        if len(br1)==2 and len(br2)==2:
+            mode='region'
+        else:
+            raise SaltIOError('Expected scalar or list of length 2, got lists of length '+str(len(br1))+' '+str(len(br2)))
+    except TypeError:
+        mode='annulus'
+
+    if mode=='annulus':
+        bflux1, barea1=boxsumcube(cube, checkedges(x-br1,0,naxis1), checkedges(x+br1,0,naxis1),
+                                  checkedges(y-br1,0,naxis2), checkedges(y+br1,0,naxis2))
+        bflux2, barea2=boxsumcube(cube, checkedges(x-br2,0,naxis1), checkedges(x+br2,0,naxis1),
+                                  checkedges(y-br2,0,naxis2), checkedges(y+br2,0,naxis2))
+        npix=barea2-barea1
+        flux=bflux2-bflux1
+    else:
+        flux, npix=boxsumcube(cube, checkedges(x-br1[0],0,naxis1), checkedges(x+br2[0],0,naxis1),
+                              checkedges(y-br1[1],0,naxis2), checkedges(y+br2[1],0,naxis2))
+
+    good=(npix>0)
+    npix=np.where(good, npix, 1)
+    bflux=np.where(good, flux/npix, 0)
+    berr=np.where(good, np.sqrt(abs(bflux)+npix*rdnoise**2)/npix, 0)
+    return bflux, berr, np.where(good, npix, 0)
+
+def sqapphotcube(cube, xc, yc, rc, br1, br2, rdnoise, naxis1, naxis2):
+    """Perform square aperture photometry on each frame in a cube
+
+    returns flux, flux_err, good
+    where good is False for frames that sqapphot would reject
+    """
+    flux, area=boxsumcube(cube, checkedges(xc-rc,0,naxis1), checkedges(xc+rc,0,naxis1),
+                          checkedges(yc-rc,0,naxis2), checkedges(yc+rc,0,naxis2))
+    return aperturecube(flux, area, cube, xc, yc, br1, br2, rdnoise, naxis1, naxis2)
+
+def capphotcube(cube, xc, yc, rc, br1, br2, rdnoise, naxis1, naxis2):
+    """Perform circular aperture photometry on each frame in a cube, with 
+    the same weights as capphot
+
+    returns flux, flux_err, good
+    where good is False for frames that capphot would reject
+    """
+    cx, bx=apcache.offset(xc)
+    cy, by=apcache.offset(yc)
+    nstamp=int(np.ceil(rc))+1
+    w=circleweights(rc, apcache.bincentre(bx), apcache.bincentre(by), nstamp)
+    flux, area=stampsumcube(cube, w, cx-nstamp, cy-nstamp)
+    return aperturecube(flux, area, cube, xc, yc, br1, br2, rdnoise, naxis1, naxis2)
+
+def stampsumcube(cube, w, x1, y1):
+    """Return the weighted sum of the pixels under a stamp of weights 
+    starting at x1, y1 in each frame of a cube, and the sum of the 
+    weights that are on the frame
+
+    returns flux, area
+    """
+    n, ny, nx=cube.shape
+    xs=x1[:,np.newaxis]+np.arange(w.shape[2])
+    ys=y1[:,np.newaxis]+np.arange(w.shape[1])
+    mask=((ys>=0)*(ys<ny))[:,:,np.newaxis]*((xs>=0)*(xs<nx))[:,np.newaxis,:]
+    sub=cube[np.arange(n)[:,np.newaxis,np.newaxis], np.clip(ys, 0, ny-1)[:,:,np.newaxis], 
+             np.clip(xs, 0, nx-1)[:,np.newaxis,:]]
+    w=w*mask
+    return (sub*w).sum(axis=2).sum(axis=1), w.sum(axis=2).sum(axis=1)
+
+def aperturecube(flux, area, cube, xc, yc, br1, br2, rdnoise, naxis1, naxis2):
+    """Subtract the background from the flux in an aperture of area pixels
+    in each frame of a cube
+
+    returns flux, flux_err, good
+    """
+    bflux, berr, npix=calcstarbackgroundcube(cube, xc, yc, br1, br2, rdnoise, naxis1, naxis2)
+    good=(area>0)*(npix>0)
+    flux=flux-area*bflux
+    flux_err=np.sqrt(abs(flux)+area*rdnoise**2+area*berr**2+area**2*berr**2/np.maximum(npix,1))
+    return np.where(good, flux, 0), np.where(good, flux_err, 0), good
+
+def dophotcube(phottype, cube, x, y, r, br1, br2, rdnoise, naxis1, naxis2):
+    """Perform photometry on each frame in a cube.  This is the same as
+    dophot, but x, y and rdnoise are arrays with one value for each frame.
+    Only square and circular photometry are supported.
+
+    returns target_flux, target_flux_err, compar_flux, compar_flux_err, ratio, ratio_err, good
+    where all of the values are zero for frames where good is False
+    """
+    if phottype=='square':
+        apphot=sqapphotcube
+    elif phottype=='circular':
+        apphot=capphotcube
+    else:
+        raise SaltError('Photometry Type %s is not supported for a cube of frames' % phottype)
+
+    target_flux, target_flux_err, tgood=apphot(cube, x['target'], y['target'], r['target'], br1['target'], br2['target'], rdnoise, naxis1, naxis2)
+    compar_flux, compar_flux_err, cgood=apphot(cube, x['comparison'], y['comparison'], r['comparison'], br1['comparison'], br2['comparison'], rdnoise, naxis1, naxis2)
+    ratio, ratio_err=calcratiocube(target_flux, target_flux_err, compar_flux, compar_flux_err)
+
+    good=tgood*cgood
+    results=[np.where(good, v, 0) for v in [target_flux, target_flux_err, compar_flux, compar_flux_err, ratio, ratio_err]]
+    return tuple(results)+(good,)
+
+def calcratiocube(target_flux, target_flux_err, compar_flux, compar_flux_err):
+    """Calculate the flux ratio for arrays of fluxes in the same way as 
+    calcratio
+
+    return ratio, ratio_err
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio=np.where(compar_flux>0, target_flux/compar_flux, 0)
+        ratio_err=np.where((compar_flux>0)*(target_flux>0),
+                           ratio*np.sqrt((target_flux_err/target_flux)**2+(compar_flux_err/compar_flux)**2),
+                           ratio*np.sqrt(target_flux_err**2+compar_flux_err**2))
+    return ratio, ratio_err
+
 def writedataout(lout, index, time, x, y, target_flux, target_flux_err, compar_flux, compar_flux_err, ratio, ratio_err, time0, reltime):
     """Write the data out to a file"""
 
@@ -567,6 +967,174 @@ def writedataout(lout, index, time, x, y, target_flux, target_flux_err, compar_f
     except:
         raise SaltIOError('Unable to write to the output file')
 
+# columns of a binary light curve, in the same order as the ascii light curve
+lccolumns=['index', 'time', 'ratio', 'ratio_err', 'tgt_x', 'tgt_y', 'tgt_flux', 'tgt_err',
+           'cmp_x', 'cmp_y', 'cmp_flux', 'cmp_err']
+lcmagic='SLOTLC'
+lcheadersize=2880
+
+class LightCurveWriter:
+    """Write a light curve to a binary file.  The file starts with an ascii
+    header of lcheadersize bytes describing the columns, followed by one
+    record of little-endian doubles per frame.  The records are written
+    in blocks of blocksize frames, so the file can be read with 
+    readlcbinary while it is still being written.
+    """
+
+    def __init__(self, outfile, time0, reltime, blocksize=1000):
+        self.time0=time0
+        self.reltime=reltime
+        self.blocksize=blocksize
+        self.dtype=np.dtype([(name, '<f8') for name in lccolumns])
+        self.rows=[]
+        self.nrows=0
+
+        header='%s 1\nCOLUMNS %s\nFORMAT <f8\nTIME0 %r\nRELTIME %s\n' % \
+               (lcmagic, ' '.join(lccolumns), float(time0), bool(reltime))
+        try:
+            self.lout=open(outfile, 'wb')
+            self.lout.write(header.ljust(lcheadersize))
+            self.lout.flush()
+        except IOError, e:
+            raise SaltIOError('Cannot open output file %s because %s' % (outfile, e))
+
+    def write(self, index, time, x, y, target_flux, target_flux_err, compar_flux, compar_flux_err, ratio, ratio_err):
+        """Add frames to the light curve.  The arguments are the same as 
+        for writedataout, but they can also be arrays with a value for 
+        each frame.
+        """
+        if self.reltime: time=time-self.time0
+        values=[index, time, ratio, ratio_err, x['target'], y['target'], target_flux, target_flux_err,
+                x['comparison'], y['comparison'], compar_flux, compar_flux_err]
+        values=[np.atleast_1d(v) for v in values]
+        rows=np.zeros(len(values[0]), dtype=self.dtype)
+        for name, v in zip(lccolumns, values):
+            rows[name]=v
+        self.rows.append(rows)
+        self.nrows+=len(rows)
+        if self.nrows>=self.blocksize: self.flush()
+
+    def flush(self):
+        """Write the frames that have been added to the file"""
+        if not self.rows: return
+        try:
+            self.lout.write(np.concatenate(self.rows).tostring())
+            self.lout.flush()
+        except IOError, e:
+            raise SaltIOError('Unable to write to the output file because %s' % e)
+        self.rows=[]
+        self.nrows=0
+
+    def close(self):
+        self.flush()
+        self.lout.close()
+
+def readlcbinary(lcfile, start=0):
+    """Read a binary light curve written by LightCurveWriter, starting at 
+    frame start.  Only complete frames are returned, so the file can be 
+    read again as it grows.
+
+    returns record array with the fields in lccolumns
+    """
+    try:
+        lin=open(lcfile, 'rb')
+        header=lin.read(lcheadersize)
+        lin.close()
+        keys=dict([line.split(' ', 1) for line in header.strip().split('\n')])
+        if lcmagic not in keys: raise ValueError('not a binary light curve')
+        dtype=np.dtype([(name, keys['FORMAT']) for name in keys['COLUMNS'].split()])
+        nrows=(os.path.getsize(lcfile)-lcheadersize)/dtype.itemsize
+    except Exception, e:
+        raise SaltIOError('Cannot read light curve %s because %s' % (lcfile, e))
+
+    if nrows<=start: return np.zeros(0, dtype=dtype)
+    return np.memmap(lcfile, dtype=dtype, mode='r', offset=lcheadersize+start*dtype.itemsize, shape=(nrows-start,))
+
+def islcbinary(lcfile):
+    """Return True if lcfile is a binary light curve"""
+    try:
+        lin=open(lcfile, 'rb')
+        magic=lin.read(len(lcmagic))
+        lin.close()
+    except IOError:
+        return False
+    return magic==lcmagic
+
+class FrameCubeWriter:
+    """Write the frames used for the photometry to a fits file with a single
+    image cube extension of up to nframes frames.  The file is created at 
+    its full size and each frame is written directly to its place in the 
+    cube.  When the file is closed, the cube is cut to the frames that were
+    written and the original image name, extension and time of each frame
+    are written to a FRAMES table extension.
+    """
+
+    def __init__(self, outfile, header, nframes, naxis1, naxis2):
+        self.outfile=outfile
+        self.nframes=nframes
+        self.nwritten=0
+        self.framebytes=8*naxis1*naxis2
+        self.oname=['']*nframes
+        self.oext=np.zeros(nframes, dtype=int)
+        self.utcobs=['']*nframes
+
+        # create the primary and cube headers
+        phdu=pyfits.PrimaryHDU(header=header)
+        phdu.header['NCCDS']=1
+        phdu.header['NSCIEXT']=1
+        phdu.header['NEXTEND']=2
+        phdu.header['NFRAMES']=nframes
+        chdu=pyfits.ImageHDU(np.zeros((1,1,1)), name='SCI')
+        chdu.header['NAXIS1']=naxis1
+        chdu.header['NAXIS2']=naxis2
+        chdu.header['NAXIS3']=nframes
+        self.pheader=phdu.header
+        self.cheader=chdu.header
+
+        try:
+            self.fout=open(outfile, 'wb')
+            self.fout.write(self.pheader.tostring())
+            self.fout.write(self.cheader.tostring())
+            self.offset=self.fout.tell()
+            size=int(np.ceil(nframes*self.framebytes/2880.0))*2880
+            self.fout.seek(self.offset+size-1)
+            self.fout.write('\0')
+        except IOError, e:
+            raise SaltIOError('Could not create newfits file %s because %s' % (outfile, e))
+
+    def write(self, k, array, oname, oext, utcobs):
+        """Write array as frame k of the cube"""
+        self.fout.seek(self.offset+k*self.framebytes)
+        self.fout.write(np.asarray(array, dtype='>f8').tostring())
+        self.oname[k]=oname
+        self.oext[k]=oext
+        self.utcobs[k]=utcobs
+        self.nwritten=max(self.nwritten, k+1)
+
+    def close(self):
+        """Set the size of the cube to the frames that were written, remove
+        the space for the other frames and write the FRAMES table
+        """
+        n=self.nwritten
+        self.pheader['NFRAMES']=n
+        self.cheader['NAXIS3']=n
+        try:
+            self.fout.seek(0)
+            self.fout.write(self.pheader.tostring())
+            self.fout.write(self.cheader.tostring())
+            size=int(np.ceil(n*self.framebytes/2880.0))*2880
+            self.fout.truncate(self.offset+size)
+            self.fout.close()
+        except IOError, e:
+            raise SaltIOError('Could not write newfits file %s because %s' % (self.outfile, e))
+
+        oname=self.oname[:n]
+        c1=pyfits.Column(name='ONAME',format='%iA' % max([len(x) for x in oname]+[1]),array=oname)
+        c2=pyfits.Column(name='OEXT',format='J',array=self.oext[:n])
+        c3=pyfits.Column(name='UTC-OBS',format='16A',array=self.utcobs[:n])
+        tbhdu=pyfits.BinTableHDU.from_columns([c1,c2,c3], name='FRAMES')
+        pyfits.append(self.outfile, tbhdu.data, tbhdu.header)
+
 def readsrcfile(srcfile): 
     """Read in the src file and return the parameters extracted from that file
 
@@ -685,10 +1253,15 @@ def readsrcfile(srcfile):
     return amp, x, y, x_o, y_o, r, br1, br2
 
 def readlcfile(lcfile):
-    """Read in the lightcurve file
+    """Read in the lightcurve file, which can be either an ascii or a binary
+    light curve
 
     """
     saltio.fileexists(lcfile)
+
+    if islcbinary(lcfile):
+        data=readlcbinary(lcfile)
+        return tuple([np.array(data[name]) for name in lccolumns])
     
     try:
         id, time, ratio, rerr, tx, ty, tflux, terr, cx, cy, cflux, cerr=np.loadtxt(lcfile, unpack=True)
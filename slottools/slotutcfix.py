@@ -164,7 +164,8 @@ def slotutcfix(images,update,outfile,ampperccd,ignorexp,droplimit,inter,plotdata
         if verbose:
             log.message('Reading in files to create list of UTC values.')
 
-        j=0
+        # The UTC values are read straight from the header records of the 
+        # frames through the exposure index of each file
         for n,infile in enumerate(infiles):
             # Show progress
             if verbose:
@@ -173,24 +174,21 @@ def slotutcfix(images,update,outfile,ampperccd,ignorexp,droplimit,inter,plotdata
                 sys.stdout.write(ctext)
                 sys.stdout.flush()
 
-            struct=saltsafeio.openfits(infile)
-            if not len(struct)-1==nextend:
+            if not len(saltsafeio.indexfits(infile))==nextend:
                 raise SaltIOError(infile,' has a different number of extensions from the first file')
 
-            # Skip through the frames and read in the utc
-            istart=1
-            if infile==infiles[0]:
-                istart=ignorexp*amplifiers+1
-            for i in range(istart,len(struct), amplifiers):
-                try:
-                    utc_list.append(saltsafekey.get('UTC-OBS', struct[i], infile))
-                    utc_arr[j]=slottool.getobstime(struct[i], infile)
-                    j += 1
-                except Exception, e:
-                    raise SaltIOError('Unable to create array of UTC times.  Please check the number of extensions in the files')
-
-            # close FITS file
-            saltsafeio.closefits(struct)
+            utc_list += saltsafeio.get_indexed_keyword(frameindex(infile, infiles, amplifiers, ignorexp), 'UTC-OBS')
+
+            # close the memory map of the file so a run over a full night
+            # does not keep a file open for each of its files
+            saltsafeio.closemaps(infile)
+
+        try:
+            if None in utc_list or len(utc_list)>nunique:
+                raise SaltIOError('UTC-OBS keyword missing')
+            utc_arr[:len(utc_list)]=slottool.utc2obstime(utc_list)
+        except SaltIOError, e:
+            raise SaltIOError('Unable to create array of UTC times.  Please check the number of extensions in the files')
 
         # set up the other important arrays
         try:
@@ -220,27 +218,7 @@ def slotutcfix(images,update,outfile,ampperccd,ignorexp,droplimit,inter,plotdata
         if verbose:
             log.message('Calculating correct values')
 
-        i_start = abs(utc_arr-t_start).argmin()
-        t_diff=utc_arr*0.0+real_expt
-        nd=utc_arr*0.0
-        ndrop=0
-        for i in range(len(utc_arr)):
-            if utc_arr[i] >= t_start:
-                t_new=t_start+real_expt*(i-i_start+ndrop)
-                t_diff[i]=utc_arr[i]-t_new
-                while (t_diff[i]>real_expt and nd[i] < droplimit):
-                    nd[i]+= 1
-                    t_new=t_start+real_expt*(i-i_start+ndrop+nd[i])
-                    t_diff[i]=utc_arr[i]-t_new
-                if (nd[i]<droplimit):
-                    ndrop += nd[i]
-            else:
-                t_new=t_start+real_expt*(i-i_start)
-                t_diff[i]=utc_arr[i]-t_new
-                while (t_diff[i]>real_expt and nd[i] < droplimit):
-                    nd[i]+= 1
-                    t_new=t_start+real_expt*(i-i_start-nd[i])
-                    t_diff[i]=utc_arr[i]-t_new
+        t_diff, nd, ndrop=countdrops(utc_arr, t_start, real_expt, droplimit)
 
         # calculate the corrected timestamp by counting 6 record files forward and
         # 8 recored + unrecorded files back--or just 8*t_exp forward.
@@ -250,14 +228,10 @@ def slotutcfix(images,update,outfile,ampperccd,ignorexp,droplimit,inter,plotdata
         # first make the array of new times
         new_arr=utc_arr-t_diff
 
-        # Next loop through them to find the corrected time
-        corr_arr=utc_arr*0.0
-
-        for i in range(len(new_arr)):
-            if i+6 < len(new_arr)-1:
-                corr_arr[i]=new_arr[i+6]-8*real_expt
-            else:
-                corr_arr[i]=new_arr[i]-2*real_expt
+        # Next find the corrected time
+        corr_arr=new_arr-2*real_expt
+        nfwd=max(len(new_arr)-7, 0)
+        corr_arr[:nfwd]=new_arr[6:6+nfwd]-8*real_expt
 
         t_diff=utc_arr-corr_arr
 
@@ -300,33 +274,21 @@ def slotutcfix(images,update,outfile,ampperccd,ignorexp,droplimit,inter,plotdata
                     sys.stdout.write(ctext)
                     sys.stdout.flush()
 
-                struct=saltsafeio.openupdatefits(infile)
+                findex=frameindex(infile, infiles, amplifiers, ignorexp, allamps=True)
+                nf=len(findex)/amplifiers
+                utc_old=utc_list[j:j+nf]
+                utc_new=utc_old
 
-                # Skip through the frames and read in the utc
-                istart=1
-                if infile==infiles[0]:
-                    istart=ignorexp*amplifiers+1
-                for i in range(istart,len(struct), amplifiers):
-                    for k in range(0,amplifiers):
-                        if update:
-                            struct[i+k]=updateheaders(struct[i+k],i+k, t_diff[j], real_expt, utc_list[j], infile)
-
-                    if outfile:
-                        utc_new=saltsafekey.get('UTC-OBS', struct[i+k], infile)
-                        utc_new_sec=slottool.getobstime(struct[i], infile)
-                        fout.write('%25s %2i %12s %12s %7.3f  %5.4f %4i \n' % (infile, i, utc_list[j], utc_new, utc_new_sec, t_diff[j], nd[j] ))
-                    j += 1
-
-                # Housekeeping key words
+                # update the headers of all the frames in the file at once
                 if update:
-                    history = 'SALTUTCFIX -- '
-                    history += 'images='+infile+' '
-                    saltsafekey.housekeeping(struct[0],'SLOTUTC','UTC has been corrected',history,infile)
+                    utc_new=updateheaders(infile, findex, amplifiers, t_diff[j:j+nf], real_expt, utc_old)
 
-                # update fits file
-                if update:
-                    saltsafeio.updatefits(struct)
-                    saltsafeio.closefits(struct)
+                if outfile:
+                    utc_new_sec=slottool.utc2obstime(utc_new)
+                    for f in range(nf):
+                        i=findex[f*amplifiers][1]
+                        fout.write('%25s %2i %12s %12s %7.3f  %5.4f %4i \n' % (infile, i, utc_old[f], utc_new[f], utc_new_sec[f], t_diff[j+f], nd[j+f] ))
+                j += nf
 
         # close outfile
         if outfile:
@@ -336,51 +298,145 @@ def slotutcfix(images,update,outfile,ampperccd,ignorexp,droplimit,inter,plotdata
         if plotdata:
             plt.show()
 
-def updateheaders(struct, ext, tdiff, real_expt, utc, infile):
+def frameindex(infile, infiles, amplifiers, ignorexp, allamps=False):
+    """Return the exposure index entries of the frames in a file that are
+    used for the timing.  Only the first amplifier of each frame is 
+    returned unless allamps is set.
+    """
+    index=saltsafeio.indexfits(infile)
+    istart=0
+    if infile==infiles[0]:
+        istart=ignorexp*amplifiers
+    if allamps:
+        nf=(len(index)-istart+amplifiers-1)/amplifiers
+        return index[istart:istart+nf*amplifiers]
+    return index[istart::amplifiers]
+
+def updateheaders(infile, findex, amplifiers, t_diff, real_expt, utc_list):
+    """Update the UTC of the frames in a file.  The headers are written in
+    place when they have room for the new keywords, otherwise the file is
+    updated through pyfits.
+
+    returns the list of new UTC values
+    """
     # exit if tdiff wasn't updated
-    if tdiff == real_expt:
-        msg='No adequate correction found for frame %i in file %s' % (ext, infile)
+    bad=np.flatnonzero(t_diff==real_expt)
+    if len(bad):
+        msg='No adequate correction found for frame %i in file %s' % (findex[bad[0]*amplifiers][1], infile)
         raise SaltError(msg)
 
-        return struct
-
-    # calculate the new utc value
-    try:
-        ntime=salttime.sex2dec(utc)
-        ntime=ntime-tdiff/3600.0
-        newutc=salttime.dec2sex(ntime)
-    except Exception,e:
-        msg='Could not update UTC in %i header of image %s because %s' % (ext, infile, e)
-        raise SaltError(msg)
-
-        return struct
+    # calculate the new utc values
+    newutc=[]
+    for f in range(len(utc_list)):
+        try:
+            ntime=salttime.sex2dec(utc_list[f])
+            ntime=ntime-t_diff[f]/3600.0
+            newutc.append(salttime.dec2sex(ntime))
+        except Exception,e:
+            msg='Could not update UTC in %i header of image %s because %s' % (findex[f*amplifiers][1], infile, e)
+            raise SaltError(msg)
+
+    # check the headers
+    if len(findex)!=len(utc_list)*amplifiers:
+        raise SaltIOError('Frame missing from list of times')
+    for utc, hutc in zip(np.repeat(utc_list, amplifiers), saltsafeio.get_indexed_keyword(findex, 'UTC-OBS')):
+        if utc!=hutc:
+            raise SaltIOError('Frame missing from list of times')
 
     # update the headers
-    if utc==saltsafekey.get('UTC-OBS', struct):
-        expt_string='%5.4f' % real_expt
-        td_string='%5.4f' % tdiff
-        if not saltsafekey.found('DUTC', struct):
-            try:
-                saltsafekey.put('UTC-OBS', newutc, struct, infile)
-                saltsafekey.put('TIME-OBS', newutc, struct, infile)
-                saltsafekey.new('DWETIME', expt_string, 'Dwell Time', struct, infile)
-                saltsafekey.new('DUTC', td_string, 'Change in UTC time', struct, infile)
-            except Exception, e:
-                msg='Could not update %i header of image %s because %s' % (ext, infile, e)
-                raise SaltIOError(msg)
+    updates=[]
+    expt_string='%5.4f' % real_expt
+    dutc_list=saltsafeio.get_indexed_keyword(findex, 'DUTC')
+
+    # the memory map is closed before the file is changed
+    saltsafeio.closemaps(infile)
+    for k, dutc in enumerate(dutc_list):
+        f=k/amplifiers
+        cards=[('UTC-OBS', newutc[f], None), ('TIME-OBS', newutc[f], None)]
+        if dutc is None:
+            cards+=[('DWETIME', expt_string, 'Dwell Time'), ('DUTC', '%5.4f' % t_diff[f], 'Change in UTC time')]
         else:
-            try:
-                saltsafekey.put('UTC-OBS', newutc, struct, infile)
-                saltsafekey.put('TIME-OBS', newutc, struct, infile)
-                saltsafekey.put('DWETIME', real_expt, struct, infile)
-                saltsafekey.put('DUTC', tdiff, struct, infile)
-            except Exception, e:
-                msg='Could not update %i header of image %s because %s' % (ext, infile, e)
-                raise SaltError(msg)
-    else:
-        raise SaltIOError('Frame missing from list of times')
-
-    return struct
+            cards+=[('DWETIME', real_expt, None), ('DUTC', t_diff[f], None)]
+        updates.append((findex[k][2], cards))
+
+    # Housekeeping key words
+    history = 'SALTUTCFIX -- '
+    history += 'images='+infile+' '
+    now=time.asctime(time.localtime())
+    updates.append((0, [('SAL-TLM', now, None), ('SLOTUTC', now, 'UTC has been corrected'), ('HISTORY', history, None)]))
+
+    if saltsafeio.updatefitsheaders(infile, updates):
+        return newutc
+
+    struct=saltsafeio.openupdatefits(infile)
+    for entry, (hoffset, cards) in zip(findex, updates):
+        hdu=struct[entry[1]]
+        for key, value, comment in cards:
+            if comment is None:
+                saltsafekey.put(key, value, hdu, infile)
+            else:
+                saltsafekey.new(key, value, comment, hdu, infile)
+    saltsafekey.housekeeping(struct[0],'SLOTUTC','UTC has been corrected',history,infile)
+    saltsafeio.updatefits(struct)
+    saltsafeio.closefits(struct)
+    return newutc
+
+def countdrops(utc_arr, t_start, real_expt, droplimit):
+    """Count the number of frames that have been dropped before each frame
+    and find the difference between the UTC of each frame and the time
+    expected from the dwell time.
+
+    A frame is placed at the first frame number after t_start for which
+    it is no more than one dwell time late.  The number of frames dropped
+    before a frame is then the running maximum of the number of frames 
+    each frame is late by.  Frames that are droplimit or more frames late
+    are not counted and frames before t_start are not counted.
+
+    returns t_diff, nd, ndrop
+    """
+    n=len(utc_arr)
+    i_start=abs(utc_arr-t_start).argmin()
+    step=np.arange(n)-i_start
+    after=(utc_arr>=t_start)
+
+    # find the first frame number at which each frame is no more than one
+    # dwell time late
+    c=np.ceil((utc_arr-t_start)/real_expt)-1
+    late=(utc_arr-(t_start+real_expt*c)>real_expt)
+    while late.any():
+        c[late]+=1
+        late=(utc_arr-(t_start+real_expt*c)>real_expt)
+    early=(utc_arr-(t_start+real_expt*(c-1))<=real_expt)
+    while early.any():
+        c[early]-=1
+        early=(utc_arr-(t_start+real_expt*(c-1))<=real_expt)
+    a=np.where(after, c-step, -np.inf)
+
+    # the number of frames dropped before each frame
+    prev=np.zeros(n)
+    ndrop=0.0
+    i=0
+    while i<n and droplimit>0:
+        run=np.maximum.accumulate(np.maximum(a[i:], ndrop))
+        prev[i]=ndrop
+        prev[i+1:]=run[:-1]
+        bad=np.flatnonzero(a[i:]-prev[i:]>=droplimit)
+        if not len(bad):
+            ndrop=run[-1]
+            break
+        i+=bad[0]
+        ndrop=prev[i]
+        i+=1
+
+    nd=np.clip(a-prev, 0, droplimit)
+    t_diff=utc_arr-(t_start+real_expt*(step+prev+nd))
+
+    # frames before t_start
+    if droplimit>0:
+        nd[~after]=np.where(utc_arr-(t_start+real_expt*step)>real_expt, droplimit, 0)[~after]
+    t_diff[~after]=(utc_arr-(t_start+real_expt*(step-nd)))[~after]
+
+    return t_diff, nd, ndrop
 
 def calculate_realexptime(id_arr, utc_arr, dsec_arr, diff_arr, req_texp, utc_list):
     """Calculates the real exposure time.
@@ -434,21 +490,20 @@ def find_real_time(dt, t_min, t_max):
     returns float
     """
     t_e=np.arange(t_min,t_max,0.0001)
-    ysum=t_e*0.0
-    for i in range(len(t_e)):
-        ysum[i]=ntime_func(dt, t_e[i])
+    ysum=ntime_func(dt, t_e)
     return t_e, ysum
 
 def ntime_func(dt, t_e):
     """Merit function to determine best time
-    Weighted for the number of objects in each step
+    Weighted for the number of objects in each step.  t_e can be an array
+    of times.
 
-    return float
+    return float or array
     """
-    y=0
+    y=0*np.asarray(t_e, dtype=float)
     for j in range(len(dt)):
         i=dt[j]/t_e
-        y += abs(i-round(i))
+        y += abs(i-np.round(i))
     return y
 
 # -----------------------------------------------------------